@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notificationevent',
+            index=models.Index(fields=['user_id', 'timestamp'], name='event_user_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notificationevent',
+            index=models.Index(fields=['timestamp'], name='event_ts_idx'),
+        ),
+    ]
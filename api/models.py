@@ -13,5 +13,12 @@ class NotificationEvent(models.Model):
     dedupe_key = models.CharField(max_length=255, blank=True, null=True)
     expires_at = models.DateTimeField(blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # Per-user event history (dedupe, fatigue and replay by user).
+            models.Index(fields=['user_id', 'timestamp'], name='event_user_ts_idx'),
+            models.Index(fields=['timestamp'], name='event_ts_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user_id} - {self.event_type} - {self.title}"
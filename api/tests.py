@@ -0,0 +1,66 @@
+import json
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from audit.models import DecisionRecord
+from .models import NotificationEvent
+
+URL = '/api/events/evaluate-batch/'
+
+
+def payload(title, user_id='u1'):
+    return {'user_id': user_id, 'event_type': 'update', 'title': title, 'channel': 'push',
+            'timestamp': timezone.now().isoformat()}
+
+
+class EvaluateBatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def post(self, body, content_type='application/json'):
+        return self.client.post(URL, body, content_type=content_type)
+
+    def test_json_array(self):
+        items = [payload('Your invoice is ready'), payload('Your invoice is ready'),
+                 payload('Build 4821 failed on main', user_id='u2')]
+        response = self.post(json.dumps(items))
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['count'], 3)
+        self.assertEqual([r['classification'] for r in body['results']], ['NOW', 'NEVER', 'NOW'])
+        self.assertEqual(body['results'][1]['explanation'], 'Exact duplicate within configured window.')
+
+        events = list(NotificationEvent.objects.order_by('id'))
+        self.assertEqual([r['event_id'] for r in body['results']], [e.id for e in events])
+        self.assertEqual(DecisionRecord.objects.count(), 3)
+        self.assertEqual(DecisionRecord.objects.get(event=events[1]).duplicate_result, 'exact')
+
+    def test_ndjson_body(self):
+        lines = [json.dumps(payload(title, user_id=f'u{i}'))
+                 for i, title in enumerate(['Your invoice is ready', 'Weekly team digest'])]
+        response = self.post('\n'.join(lines[:1] + [''] + lines[1:]) + '\n', 'application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual(NotificationEvent.objects.count(), 2)
+
+    def test_malformed_ndjson_line(self):
+        response = self.post(json.dumps(payload('Your invoice is ready')) + '\n{oops\n', 'application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('line 2', response.json()['detail'])
+
+    def test_invalid_item_rejects_the_whole_batch(self):
+        bad = payload('Weekly team digest')
+        del bad['channel']
+        response = self.post(json.dumps([payload('Your invoice is ready'), bad]))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(NotificationEvent.objects.exists())
+
+    def test_body_must_be_a_list(self):
+        self.assertEqual(self.post(json.dumps(payload('Your invoice is ready'))).status_code, 400)
+
+    @override_settings(ENGINE_MAX_BATCH_SIZE=1)
+    def test_batch_size_limit(self):
+        items = [payload('Your invoice is ready'), payload('Weekly team digest')]
+        response = self.post(json.dumps(items))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(NotificationEvent.objects.exists())
@@ -1,10 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import NotificationEventViewSet
+from .views import NotificationEventViewSet, evaluate_async
 
 router = DefaultRouter()
 router.register(r'events', NotificationEventViewSet, basename='event')
 
 urlpatterns = [
+    path('events/evaluate-async/', evaluate_async, name='event-evaluate-async'),
     path('', include(router.urls)),
 ]
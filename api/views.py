@@ -1,14 +1,35 @@
+import json
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from .models import NotificationEvent
+from .parsers import NDJSONParser
 from .serializers import NotificationEventSerializer
-from engine.services import decide_notification
+from engine.aio import run_db
+from engine.ingest import get_ingest_queue
+from engine.services import adecide_notification, decide_notification, decide_notifications
 
 class NotificationEventViewSet(viewsets.ModelViewSet):
     queryset = NotificationEvent.objects.all()
     serializer_class = NotificationEventSerializer
 
+    def create(self, request, *args, **kwargs):
+        """With ENGINE_QUEUE on, queue the event for the drain workers and answer 202."""
+        queue = get_ingest_queue()
+        if queue is None:
+            return super().create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        partition, offset = queue.append([serializer.validated_data])[0]
+        return Response({'status': 'accepted', 'partition': partition, 'offset': offset},
+                        status=status.HTTP_202_ACCEPTED)
+
     @action(detail=False, methods=['post'], url_path='evaluate')
     def evaluate(self, request):
         serializer = self.get_serializer(data=request.data)
@@ -21,3 +42,60 @@ class NotificationEventViewSet(viewsets.ModelViewSet):
             'explanation': explanation,
             'event_id': event.id
         }, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'], url_path='evaluate-batch',
+            parser_classes=[JSONParser, NDJSONParser])
+    def evaluate_batch(self, request):
+        """Evaluate a JSON array or NDJSON stream of events in one request."""
+        items = request.data
+        if not isinstance(items, list):
+            return Response({'detail': 'Expected a list of events.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        max_size = getattr(settings, 'ENGINE_MAX_BATCH_SIZE', 50000)
+        if len(items) > max_size:
+            return Response({'detail': f'Batch exceeds the maximum of {max_size} events.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.get_serializer(data=items, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        batch_size = getattr(settings, 'ENGINE_BULK_BATCH_SIZE', 1000)
+        with transaction.atomic():
+            events = NotificationEvent.objects.bulk_create(
+                [NotificationEvent(**data) for data in serializer.validated_data],
+                batch_size=batch_size,
+            )
+            results = decide_notifications(events)
+
+        return Response({
+            'count': len(events),
+            'results': [{
+                'classification': classification,
+                'explanation': explanation,
+                'event_id': event.id
+            } for event, (classification, explanation) in zip(events, results)]
+        }, status=status.HTTP_200_OK)
+
+
+@csrf_exempt
+@require_POST
+async def evaluate_async(request):
+    """Async counterpart of the ``evaluate`` action for ASGI deployments.
+
+    Same request and response bodies. Validation runs on the event loop; the
+    insert and the audit write go to the engine's shared database pool.
+    """
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'detail': 'Malformed JSON body.'}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = NotificationEventSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    event = await run_db(serializer.save)
+    classification, explanation = await adecide_notification(event)
+    return JsonResponse({
+        'classification': classification,
+        'explanation': explanation,
+        'event_id': event.id
+    }, status=status.HTTP_200_OK)
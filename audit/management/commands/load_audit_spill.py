@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from audit.sink import load_spilled
+
+
+class Command(BaseCommand):
+    help = 'Insert audit records the async sink spilled to disk while the database was unavailable.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spill-dir', default=None, help='Defaults to ENGINE_AUDIT_SPILL_DIR.')
+
+    def handle(self, *args, **options):
+        loaded = load_spilled(options['spill_dir'])
+        self.stdout.write(f'Loaded {loaded} spilled audit records')
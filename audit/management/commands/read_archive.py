@@ -0,0 +1,52 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from audit.retention import TABLES, read_archives
+
+
+def _filter_value(model, field_name, value):
+    """``value`` as stored in archived rows of ``model``: ints for integer
+    primary and foreign keys and other integer columns, strings otherwise.
+    """
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+    if field_name not in fields:
+        raise CommandError(f'Unknown column {field_name!r}; expected one of {", ".join(sorted(fields))}.')
+    field = fields[field_name]
+    target = field.target_field if field.is_relation else field
+    if not isinstance(target, models.IntegerField):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError(f'{field_name} must be an integer, got {value!r}.')
+
+
+def _when(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise CommandError(f'Invalid datetime: {value!r}')
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+
+class Command(BaseCommand):
+    help = 'Stream archived rows back as JSONL, optionally filtered.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=sorted(TABLES))
+        parser.add_argument('--archive-dir', default=None)
+        parser.add_argument('--start', type=_when)
+        parser.add_argument('--end', type=_when)
+        parser.add_argument('--where', action='append', default=[], metavar='FIELD=VALUE',
+                            help='Exact match on a column, e.g. --where user_id=u1 (repeatable).')
+
+    def handle(self, table, **options):
+        filters = {}
+        for item in options['where']:
+            field, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f'--where expects FIELD=VALUE, got {item!r}')
+            filters[field] = _filter_value(TABLES[table][0], field, value)
+        for row in read_archives(table, options['archive_dir'], options['start'], options['end'], **filters):
+            self.stdout.write(json.dumps(row))
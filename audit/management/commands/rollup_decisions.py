@@ -0,0 +1,28 @@
+import time
+from django.core.management.base import BaseCommand
+from audit.rollups import compact
+
+
+class Command(BaseCommand):
+    help = 'Fold new decision records into the hourly dashboard rollups.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--settle-seconds', type=int, default=None,
+                            help='Leave records younger than this for the next run.')
+        parser.add_argument('--loop', action='store_true', help='Keep compacting instead of exiting when caught up.')
+        parser.add_argument('--interval', type=float, default=30.0, help='Seconds between runs with --loop.')
+
+    def handle(self, *args, **options):
+        while True:
+            total = 0
+            while True:
+                folded = compact(options['batch_size'], options['settle_seconds'])
+                if not folded:
+                    break
+                total += folded
+            if total:
+                self.stdout.write(f'Folded {total} decision records into rollups')
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('audit', '0002_decision_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='decisionrecord',
+            name='reason',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.CreateModel(
+            name='DecisionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('event_type', models.CharField(max_length=100)),
+                ('channel', models.CharField(max_length=20)),
+                ('classification', models.CharField(choices=[('NOW', 'Now'), ('LATER', 'Later'), ('NEVER', 'Never')], max_length=6)),
+                ('reason', models.CharField(blank=True, default='', max_length=32)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'event_type', 'channel', 'classification', 'reason'), name='decision_rollup_unique')],
+            },
+        ),
+    ]
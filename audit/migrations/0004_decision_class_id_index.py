@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_event_indexes'),
+        ('audit', '0003_decision_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='decisionrecord',
+            index=models.Index(fields=['classification', '-id'], name='decision_class_id_idx'),
+        ),
+    ]
@@ -13,9 +13,53 @@ class DecisionRecord(models.Model):
     classification = models.CharField(max_length=6, choices=CLASSIFICATION_CHOICES)
     explanation = models.TextField()
     duplicate_result = models.CharField(max_length=10, null=True, blank=True)
+    # Short code for what decided the event (see engine.services.Decision).
+    reason = models.CharField(max_length=32, blank=True, default='')
     rules_triggered = models.JSONField(default=dict, blank=True)
     fatigue_snapshot = models.JSONField(default=dict, blank=True)
     timestamp = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            # Retention, rollups and the audit start/end filters.
+            models.Index(fields=['-timestamp'], name='decision_ts_idx'),
+            # Audit pages filtered by classification, newest (highest id)
+            # first; unfiltered pages walk the primary key.
+            models.Index(fields=['classification', '-id'], name='decision_class_id_idx'),
+        ]
+
     def __str__(self):
         return f"{self.event.id} → {self.classification} @ {self.timestamp}"
+
+
+class DecisionRollup(models.Model):
+    """Decision counts per hour, event_type, channel, classification and reason.
+
+    Maintained incrementally from DecisionRecord by audit.rollups.compact, so
+    dashboards never aggregate the raw audit table.
+    """
+    bucket = models.DateTimeField()
+    event_type = models.CharField(max_length=100)
+    channel = models.CharField(max_length=20)
+    classification = models.CharField(max_length=6, choices=DecisionRecord.CLASSIFICATION_CHOICES)
+    reason = models.CharField(max_length=32, blank=True, default='')
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'event_type', 'channel', 'classification', 'reason'],
+                                    name='decision_rollup_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket:%Y-%m-%d %H:00} {self.event_type}/{self.channel} {self.classification}: {self.count}"
+
+
+class RollupWatermark(models.Model):
+    """Highest DecisionRecord id already folded into the rollups."""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.last_id}"
@@ -0,0 +1,135 @@
+"""Filtering and keyset pagination of DecisionRecords for the audit views."""
+import hashlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import DecisionRecord
+
+RECORD_FIELDS = ('id', 'classification', 'explanation', 'timestamp', 'event__id', 'event__user_id',
+                 'event__event_type')
+
+
+class AuditQueryError(ValueError):
+    """Raised for malformed audit query parameters."""
+
+
+def _int(params, name):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise AuditQueryError(f'{name} must be an integer.')
+
+
+def _datetime(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            parsed = datetime(day.year, day.month, day.day) if day else None
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise AuditQueryError(f'{name} must be an ISO 8601 date or datetime.')
+    return parsed if timezone.is_aware(parsed) else parsed.replace(tzinfo=dt_timezone.utc)
+
+
+class AuditQuery:
+    """Parsed audit query.
+
+    Filters: ``user_id``, ``classification``, ``event_type`` and a
+    ``start``/``end`` timestamp range. Pages walk backwards by id from
+    ``cursor`` (newest first); ``since`` instead returns records with a
+    higher id than the given one, oldest first, for incremental polling.
+
+    Ids are assigned before commit, so a lower id can become visible after a
+    higher one (concurrent writers, the async audit sink). ``since`` polls
+    therefore stop before the first record younger than
+    AUDIT_SETTLE_SECONDS, as audit.rollups.compact does. The newest page
+    (no cursor) is not held back: start polling from an id at least that
+    old, or from 0.
+    """
+
+    def __init__(self, params, default_limit=50):
+        self.user_id = params.get('user_id') or None
+        self.classification = params.get('classification') or None
+        if self.classification and self.classification not in dict(DecisionRecord.CLASSIFICATION_CHOICES):
+            raise AuditQueryError('classification must be NOW, LATER or NEVER.')
+        self.event_type = params.get('event_type') or None
+        self.start = _datetime(params, 'start')
+        self.end = _datetime(params, 'end')
+        self.cursor = _int(params, 'cursor')
+        self.since = _int(params, 'since')
+        if self.cursor is not None and self.since is not None:
+            raise AuditQueryError('cursor and since cannot be combined.')
+        limit = _int(params, 'limit') or default_limit
+        self.limit = max(1, min(limit, getattr(settings, 'AUDIT_PAGE_MAX', 500)))
+
+    def filtered(self):
+        """DecisionRecords matching the filters, ignoring cursor and since."""
+        qs = DecisionRecord.objects.all()
+        if self.user_id:
+            qs = qs.filter(event__user_id=self.user_id)
+        if self.classification:
+            qs = qs.filter(classification=self.classification)
+        if self.event_type:
+            qs = qs.filter(event__event_type=self.event_type)
+        if self.start:
+            qs = qs.filter(timestamp__gte=self.start)
+        if self.end:
+            qs = qs.filter(timestamp__lt=self.end)
+        return qs
+
+    def key(self):
+        """Short digest of the parsed parameters, for the ETag."""
+        params = (self.user_id, self.classification, self.event_type, self.start, self.end, self.cursor,
+                  self.since, self.limit)
+        return hashlib.blake2b(repr(params).encode('utf-8'), digest_size=8).hexdigest()
+
+    def _polled(self, qs):
+        """``qs`` cut to the settled records after ``since``."""
+        qs = qs.filter(id__gt=self.since)
+        cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'AUDIT_SETTLE_SECONDS', 10))
+        unsettled = (DecisionRecord.objects.filter(id__gt=self.since, timestamp__gte=cutoff)
+                     .order_by('id').values_list('id', flat=True).first())
+        return qs if unsettled is None else qs.filter(id__lt=unsettled)
+
+    def latest_id(self):
+        """Id of the newest matching record on this query's pages (or None).
+
+        One index-backed lookup; part of the ETag so an unchanged poll never
+        loads any rows.
+        """
+        qs = self.filtered()
+        if self.since is not None:
+            qs = self._polled(qs)
+        if self.cursor is not None:
+            qs = qs.filter(id__lt=self.cursor)
+        return qs.order_by('-id').values_list('id', flat=True).first()
+
+    def page(self):
+        """Return (records, next_cursor) for this query.
+
+        ``next_cursor`` is the value to pass as ``cursor`` (or ``since``)
+        for the following page, or None when there is nothing more.
+        """
+        qs = self.filtered().select_related('event').only(*RECORD_FIELDS)
+        if self.since is not None:
+            records = list(self._polled(qs).order_by('id')[:self.limit + 1])
+        else:
+            if self.cursor is not None:
+                qs = qs.filter(id__lt=self.cursor)
+            records = list(qs.order_by('-id')[:self.limit + 1])
+        more = len(records) > self.limit
+        records = records[:self.limit]
+        if self.since is not None:
+            next_cursor = records[-1].id if records else self.since
+        else:
+            next_cursor = records[-1].id if more else None
+        return records, next_cursor
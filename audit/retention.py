@@ -0,0 +1,137 @@
+"""Retention for the audit tables: archive expired rows, then delete them.
+
+Rows older than the table's TTL are taken in id-ordered chunks. Each chunk
+is written to a gzip-compressed JSONL file (fsynced and atomically renamed)
+and only then deleted in a short transaction, so the hot tables stay at a
+steady size without long-held locks and nothing is deleted unarchived.
+
+Archives are laid out as ``<RETENTION_ARCHIVE_DIR>/<table>/<YYYY-MM-DD>/
+<table>-<first id>-<last id>.jsonl.gz`` and can be streamed back with
+``read_archives``.
+"""
+import gzip
+import json
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from api.models import NotificationEvent
+from delivery.models import Delivery
+from scheduler.models import DeferredNotification
+from .models import DecisionRecord
+
+# table name -> (model, timestamp field, TTL setting, default days)
+TABLES = {
+    'decisions': (DecisionRecord, 'timestamp', 'RETENTION_DECISION_DAYS', 90),
+    'deferred': (DeferredNotification, 'scheduled_for', 'RETENTION_DEFERRED_DAYS', 30),
+    'deliveries': (Delivery, 'created_at', 'RETENTION_DELIVERY_DAYS', 30),
+    'events': (NotificationEvent, 'timestamp', 'RETENTION_EVENT_DAYS', 90),
+}
+
+
+def retention_days(table):
+    _, _, setting, default = TABLES[table]
+    return getattr(settings, setting, default)
+
+
+def expired(table, now=None):
+    """Queryset of ``table`` rows past their TTL that may be removed.
+
+    Pending deferred notifications and deliveries, and the events they point
+    at, are never expired: the scheduler and the dispatcher still need them.
+    """
+    model, field, _, _ = TABLES[table]
+    cutoff = (now or timezone.now()) - timedelta(days=retention_days(table))
+    qs = model.objects.filter(**{f'{field}__lt': cutoff})
+    if table in ('deferred', 'deliveries'):
+        qs = qs.exclude(status='PENDING')
+    elif table == 'events':
+        qs = qs.exclude(deferred__status='PENDING').exclude(deliveries__status='PENDING')
+    return qs
+
+
+def apply_retention(table, chunk_size=None, archive_dir=None, dry_run=False, now=None, limit=None):
+    """Archive and delete expired rows of ``table``; returns rows removed.
+
+    Deleting an event also archives and deletes its decisions, deferred
+    rows and deliveries, which the foreign keys would otherwise cascade away unarchived.
+    """
+    chunk_size = chunk_size or getattr(settings, 'RETENTION_CHUNK_SIZE', 5000)
+    archive_dir = archive_dir or getattr(settings, 'RETENTION_ARCHIVE_DIR', 'archive')
+    qs = expired(table, now)
+    if dry_run:
+        return qs.count()
+
+    model = TABLES[table][0]
+    removed, last_id = 0, 0
+    while limit is None or removed < limit:
+        ids = list(qs.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        last_id = ids[-1]
+        targets = [(table, model.objects.filter(id__in=ids))]
+        if table == 'events':
+            targets[:0] = [(child, TABLES[child][0].objects.filter(event_id__in=ids))
+                           for child in ('decisions', 'deferred', 'deliveries')]
+        for name, rows in targets:
+            _archive(name, rows.order_by('id').values(), archive_dir)
+        with transaction.atomic():
+            for _, rows in targets:
+                rows.delete()
+        removed += len(ids)
+    return removed
+
+
+def _archive(table, rows, archive_dir):
+    rows = list(rows)
+    if not rows:
+        return None
+    directory = os.path.join(archive_dir, table, timezone.now().strftime('%Y-%m-%d'))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{table}-{rows[0]['id']}-{rows[-1]['id']}.jsonl.gz")
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as fh:
+            for row in rows:
+                fh.write(json.dumps(row, cls=DjangoJSONEncoder).encode('utf-8'))
+                fh.write(b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def archive_files(archive_dir, table):
+    """Archive files of ``table`` in id order."""
+    root = os.path.join(archive_dir, table)
+    files = []
+    for dirpath, _, names in os.walk(root):
+        files.extend(os.path.join(dirpath, name) for name in names if name.endswith('.jsonl.gz'))
+
+    def first_id(path):
+        return int(os.path.basename(path).rsplit('.jsonl.gz', 1)[0].split('-')[-2])
+    return sorted(files, key=first_id)
+
+
+def read_archives(table, archive_dir=None, start=None, end=None, **filters):
+    """Stream archived rows of ``table`` as dicts, one file at a time.
+
+    ``start``/``end`` bound the table's timestamp field; other keyword
+    arguments must match row values exactly (e.g. ``user_id='u1'``).
+    """
+    archive_dir = archive_dir or getattr(settings, 'RETENTION_ARCHIVE_DIR', 'archive')
+    field = TABLES[table][1]
+    for path in archive_files(archive_dir, table):
+        with gzip.open(path, 'rt', encoding='utf-8') as fh:
+            for line in fh:
+                row = json.loads(line)
+                if any(row.get(key) != value for key, value in filters.items()):
+                    continue
+                if start or end:
+                    when = parse_datetime(row[field])
+                    if (start and when < start) or (end and when >= end):
+                        continue
+                yield row
@@ -0,0 +1,105 @@
+"""Incremental hourly rollups of DecisionRecords for the dashboard.
+
+``compact()`` folds records above the watermark into DecisionRollup rows
+with one GROUP BY over a bounded id range; ``summary()`` reads only the
+rollups, so its cost depends on the time span shown, not on audit volume.
+"""
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+from scheduler.models import DeferredNotification
+from .models import DecisionRecord, DecisionRollup, RollupWatermark
+
+WATERMARK = 'decision_rollup'
+DIMENSIONS = ('bucket', 'event_type', 'channel', 'classification', 'reason')
+
+
+def compact(batch_size=None, settle_seconds=None):
+    """Fold the next batch of new DecisionRecords into the rollups.
+
+    Only records older than ``settle_seconds`` are taken, so rows committed
+    slightly out of id order (e.g. by the async audit sink) are not skipped.
+    Returns the number of records folded in; 0 means caught up.
+    """
+    batch_size = batch_size or getattr(settings, 'ROLLUP_BATCH_SIZE', 50000)
+    if settle_seconds is None:
+        settle_seconds = getattr(settings, 'ROLLUP_SETTLE_SECONDS', 60)
+    cutoff = timezone.now() - timedelta(seconds=settle_seconds)
+
+    with transaction.atomic():
+        RollupWatermark.objects.get_or_create(name=WATERMARK)
+        mark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+        pending = DecisionRecord.objects.filter(id__gt=mark.last_id)
+        upper = mark.last_id + batch_size
+        unsettled = (pending.filter(id__lte=upper, timestamp__gte=cutoff)
+                     .order_by('id').values_list('id', flat=True).first())
+        if unsettled is not None:
+            upper = unsettled - 1
+        rows = pending.filter(id__lte=upper)
+        last_id = rows.order_by('-id').values_list('id', flat=True).first()
+        if last_id is None:
+            return 0
+
+        groups = (rows.annotate(bucket=TruncHour('timestamp'), event_type=F('event__event_type'),
+                                channel=F('event__channel'))
+                  .values(*DIMENSIONS).annotate(n=Count('id')).order_by())
+        deltas = {tuple(g[d] for d in DIMENSIONS): g['n'] for g in groups}
+        folded = sum(deltas.values())
+        _apply(deltas)
+        mark.last_id = last_id
+        mark.save(update_fields=['last_id', 'updated_at'])
+    return folded
+
+
+def _apply(deltas):
+    existing = DecisionRollup.objects.select_for_update().filter(bucket__in={key[0] for key in deltas})
+    changed = []
+    for rollup in existing:
+        key = tuple(getattr(rollup, d) for d in DIMENSIONS)
+        if key in deltas:
+            rollup.count += deltas.pop(key)
+            changed.append(rollup)
+    DecisionRollup.objects.bulk_update(changed, ['count'])
+    DecisionRollup.objects.bulk_create([DecisionRollup(**dict(zip(DIMENSIONS, key)), count=n)
+                                        for key, n in deltas.items()])
+
+
+def summary(hours=24, now=None):
+    """Dashboard aggregates for the last ``hours`` hours, from rollups only."""
+    now = now or timezone.now()
+    rollups = DecisionRollup.objects.filter(bucket__gte=now - timedelta(hours=hours))
+
+    def grouped(*fields):
+        return list(rollups.values(*fields).annotate(count=Sum('count')).order_by(*fields))
+
+    totals = {row['classification']: row['count'] for row in grouped('classification')}
+    return {
+        'hours': hours,
+        'total': sum(totals.values()),
+        'classifications': totals,
+        'by_event_type': _rates(grouped('event_type', 'classification'), 'event_type'),
+        'by_channel': _rates(grouped('channel', 'classification'), 'channel'),
+        'by_hour': {hour.isoformat(): row
+                    for hour, row in _rates(grouped('bucket', 'classification'), 'bucket').items()},
+        'suppression_reasons': {row['reason'] or 'unknown': row['count'] for row in sorted(
+            rollups.exclude(classification='NOW').values('reason').annotate(count=Sum('count')),
+            key=lambda row: -row['count'])},
+        'deferred_pending': DeferredNotification.objects.filter(status='PENDING').count(),
+        'watermark': RollupWatermark.objects.filter(name=WATERMARK).values_list('updated_at', flat=True).first(),
+    }
+
+
+def _rates(rows, field):
+    """Pivot (field, classification, count) rows into per-value counts and rates."""
+    pivot = {}
+    for row in rows:
+        entry = pivot.setdefault(row[field], {'total': 0, 'NOW': 0, 'LATER': 0, 'NEVER': 0})
+        entry[row['classification']] += row['count']
+        entry['total'] += row['count']
+    for entry in pivot.values():
+        for classification in ('NOW', 'LATER', 'NEVER'):
+            entry[f'{classification.lower()}_rate'] = entry[classification] / entry['total']
+    return pivot
@@ -0,0 +1,195 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, connection, transaction
+from engine import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncAuditSink:
+    """Buffers unsaved DecisionRecords and writes them from a background thread.
+
+    Records are flushed with bulk_create once ``batch_size`` are pending or
+    ``flush_interval`` seconds have passed. The buffer holds at most
+    ``max_buffer`` records; when it is full, submitters block for up to
+    ``put_timeout`` seconds and then write their records synchronously, so
+    nothing is dropped.
+
+    A failed write is retried ``retries`` times with exponential backoff
+    from ``retry_base`` seconds. If the database is still unavailable the
+    batch is spilled to a JSONL file in ``spill_dir``, to be loaded back
+    with load_spilled() (``manage.py load_audit_spill``).
+    """
+
+    def __init__(self, max_buffer=10000, batch_size=500, flush_interval=1.0, put_timeout=0.5, retries=3,
+                 retry_base=0.5, spill_dir='audit_spill'):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.retry_base = retry_base
+        self.spill_dir = spill_dir
+        self._queue = queue.Queue(maxsize=max_buffer)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='audit-sink', daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        self.submit_many([record])
+
+    def submit_many(self, records):
+        """Queue records once the current transaction (if any) commits."""
+        transaction.on_commit(lambda: self._enqueue(records))
+
+    def _enqueue(self, records):
+        overflow = []
+        for record in records:
+            try:
+                self._queue.put(record, timeout=self.put_timeout)
+            except queue.Full:
+                overflow.append(record)
+        if overflow:
+            logger.warning('Audit buffer full, writing %d records synchronously', len(overflow))
+            self._write(overflow)
+
+    def flush(self):
+        """Block until every record queued so far has been written."""
+        self._queue.join()
+
+    def close(self):
+        """Stop the writer thread after draining the buffer."""
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._thread.join()
+
+    def _run(self):
+        pending = []
+        deadline = time.monotonic() + self.flush_interval
+        while not (self._stopped.is_set() and self._queue.empty()):
+            try:
+                pending.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+            if len(pending) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush_pending(pending)
+                pending = []
+                deadline = time.monotonic() + self.flush_interval
+        self._flush_pending(pending)
+        connection.close()
+
+    def _flush_pending(self, pending):
+        if pending:
+            try:
+                self._write(pending)
+            finally:
+                for _ in pending:
+                    self._queue.task_done()
+
+    def _write(self, records):
+        from .models import DecisionRecord
+        for attempt in range(self.retries + 1):
+            close_old_connections()
+            try:
+                # Atomic, so a retry never duplicates the chunks written before a failure.
+                with transaction.atomic():
+                    DecisionRecord.objects.bulk_create(records, batch_size=self.batch_size)
+                return
+            except Exception as exc:
+                for record in records:
+                    record.pk = None
+                if attempt == self.retries:
+                    logger.exception('Failed to write %d audit records, spilling them to %s',
+                                     len(records), self.spill_dir)
+                    break
+                delay = self.retry_base * 2 ** attempt
+                logger.warning('Failed to write %d audit records (%s), retrying in %.1fs', len(records), exc, delay)
+                if metrics.enabled():
+                    metrics.AUDIT_WRITE_FAILURES.inc('retry')
+                time.sleep(delay)
+        self._spill(records)
+
+    def _spill(self, records):
+        try:
+            path = spill(records, self.spill_dir)
+        except OSError:
+            logger.exception('Failed to spill %d audit records, they are lost', len(records))
+            outcome = 'dropped'
+        else:
+            logger.warning('Spilled %d audit records to %s', len(records), path)
+            outcome = 'spilled'
+        if metrics.enabled():
+            metrics.AUDIT_WRITE_FAILURES.inc(outcome)
+
+
+def _fields():
+    from .models import DecisionRecord
+    return [f.attname for f in DecisionRecord._meta.concrete_fields if not f.primary_key]
+
+
+def spill(records, spill_dir):
+    """Write unsaved DecisionRecords to a new JSONL file (fsynced, then
+    atomically renamed) in ``spill_dir``; returns its path.
+    """
+    os.makedirs(spill_dir, exist_ok=True)
+    path = os.path.join(spill_dir, f'audit-{time.time_ns()}-{os.getpid()}-{threading.get_ident()}.jsonl')
+    fields = _fields()
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        for record in records:
+            fh.write(json.dumps({f: getattr(record, f) for f in fields}, cls=DjangoJSONEncoder))
+            fh.write('\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def load_spilled(spill_dir=None, batch_size=500):
+    """Insert the records of every spill file in ``spill_dir``, oldest
+    first, deleting each file once its records are committed. Returns the
+    number of records loaded.
+    """
+    from .models import DecisionRecord
+    spill_dir = spill_dir or getattr(settings, 'ENGINE_AUDIT_SPILL_DIR', 'audit_spill')
+    if not os.path.isdir(spill_dir):
+        return 0
+    loaded = 0
+    for name in sorted(n for n in os.listdir(spill_dir) if n.endswith('.jsonl')):
+        path = os.path.join(spill_dir, name)
+        with open(path, encoding='utf-8') as fh:
+            records = [DecisionRecord(**json.loads(line)) for line in fh if line.strip()]
+        with transaction.atomic():
+            DecisionRecord.objects.bulk_create(records, batch_size=batch_size)
+        os.remove(path)
+        loaded += len(records)
+    return loaded
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_audit_sink():
+    """Return the process-wide sink, or None when ENGINE_AUDIT_ASYNC is off."""
+    global _sink
+    if not getattr(settings, 'ENGINE_AUDIT_ASYNC', False):
+        return None
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = AsyncAuditSink(
+                    max_buffer=getattr(settings, 'ENGINE_AUDIT_BUFFER_SIZE', 10000),
+                    batch_size=getattr(settings, 'ENGINE_AUDIT_BATCH_SIZE', 500),
+                    flush_interval=getattr(settings, 'ENGINE_AUDIT_FLUSH_INTERVAL', 1.0),
+                    retries=getattr(settings, 'ENGINE_AUDIT_WRITE_RETRIES', 3),
+                    spill_dir=getattr(settings, 'ENGINE_AUDIT_SPILL_DIR', 'audit_spill'),
+                )
+                atexit.register(_sink.close)
+    return _sink
@@ -0,0 +1,278 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from api.models import NotificationEvent
+from engine.services import decide_notification
+from scheduler.models import DeferredNotification
+from . import sink as sink_module
+from .models import DecisionRecord, DecisionRollup, RollupWatermark
+from .retention import apply_retention, archive_files, read_archives
+from .rollups import WATERMARK, compact, summary
+from .sink import AsyncAuditSink, get_audit_sink, load_spilled
+
+
+class AuditSinkTests(TransactionTestCase):
+    def setUp(self):
+        self.event = NotificationEvent.objects.create(user_id='u1', event_type='update', title='Your invoice is ready',
+                                                      channel='push', timestamp=timezone.now())
+
+    def records(self, n):
+        return [DecisionRecord(event=self.event, classification='NOW', explanation='', timestamp=timezone.now())
+                for _ in range(n)]
+
+    def test_records_are_written_in_batches_and_on_close(self):
+        sink = AsyncAuditSink(batch_size=2, flush_interval=60)
+        self.addCleanup(sink.close)
+        sink.submit_many(self.records(4))
+        sink.flush()
+        self.assertEqual(DecisionRecord.objects.count(), 4)
+        # Below batch_size and long before the interval: only close writes it.
+        sink.submit_many(self.records(1))
+        sink.close()
+        self.assertEqual(DecisionRecord.objects.count(), 5)
+
+    def test_full_buffer_writes_inline(self):
+        # A writer thread that never drains the buffer.
+        with mock.patch.object(AsyncAuditSink, '_run'):
+            sink = AsyncAuditSink(max_buffer=2, put_timeout=0.01)
+        with self.assertLogs('audit.sink', 'WARNING'):
+            sink.submit_many(self.records(3))
+        self.assertEqual(DecisionRecord.objects.count(), 1)
+        self.assertEqual(sink._queue.qsize(), 2)
+
+    def test_failed_write_is_retried(self):
+        with mock.patch.object(AsyncAuditSink, '_run'):
+            sink = AsyncAuditSink(retry_base=0)
+        bulk_create = DecisionRecord.objects.bulk_create
+        calls = []
+
+        def flaky(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return bulk_create(*args, **kwargs)
+        with mock.patch.object(DecisionRecord.objects, 'bulk_create', side_effect=flaky), \
+                self.assertLogs('audit.sink', 'WARNING'):
+            sink._write(self.records(3))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(DecisionRecord.objects.count(), 3)
+
+    def test_unwritable_batch_is_spilled_and_loaded_back(self):
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir)
+        with mock.patch.object(AsyncAuditSink, '_run'):
+            sink = AsyncAuditSink(retries=1, retry_base=0, spill_dir=spill_dir)
+        with mock.patch.object(DecisionRecord.objects, 'bulk_create', side_effect=OperationalError('db down')), \
+                self.assertLogs('audit.sink', 'WARNING'):
+            sink._write(self.records(2))
+        self.assertFalse(DecisionRecord.objects.exists())
+        self.assertEqual(len(os.listdir(spill_dir)), 1)
+
+        self.assertEqual(load_spilled(spill_dir), 2)
+        self.assertEqual(DecisionRecord.objects.filter(event=self.event).count(), 2)
+        self.assertEqual(os.listdir(spill_dir), [])
+
+    @override_settings(ENGINE_AUDIT_ASYNC=True)
+    def test_decisions_go_through_the_sink(self):
+        cache.clear()
+        with mock.patch.object(sink_module, '_sink', None):
+            sink = get_audit_sink()
+            self.addCleanup(sink.close)
+            self.assertEqual(decide_notification(self.event)[0], 'NOW')
+            sink.flush()
+        self.assertEqual(DecisionRecord.objects.get(event=self.event).classification, 'NOW')
+
+
+class AuditApiTests(TestCase):
+    URL = '/audit/records/'
+
+    def setUp(self):
+        self.records = []
+        for i, (user_id, classification) in enumerate([('u1', 'NOW'), ('u2', 'NEVER'), ('u1', 'LATER'),
+                                                        ('u1', 'NOW'), ('u2', 'NOW')]):
+            event = NotificationEvent.objects.create(user_id=user_id, event_type='update', title=f'Item {i}',
+                                                     channel='push', timestamp=timezone.now())
+            self.records.append(DecisionRecord.objects.create(event=event, classification=classification,
+                                                              explanation='',
+                                                              timestamp=timezone.now() - timedelta(minutes=1)))
+
+    def ids(self, response):
+        return [r['id'] for r in response.json()]
+
+    def test_pages_walk_back_by_cursor(self):
+        response = self.client.get(self.URL, {'limit': 2})
+        self.assertEqual(self.ids(response), [self.records[4].id, self.records[3].id])
+        self.assertIn(f'cursor={self.records[3].id}', response['Link'])
+        response = self.client.get(self.URL, {'limit': 2, 'cursor': self.records[3].id})
+        self.assertEqual(self.ids(response), [self.records[2].id, self.records[1].id])
+        response = self.client.get(self.URL, {'limit': 2, 'cursor': self.records[1].id})
+        self.assertEqual(self.ids(response), [self.records[0].id])
+        self.assertFalse(response.has_header('Link'))
+
+    def test_since_returns_newer_records_oldest_first(self):
+        response = self.client.get(self.URL, {'since': self.records[2].id})
+        self.assertEqual(self.ids(response), [self.records[3].id, self.records[4].id])
+        self.assertIn(f'since={self.records[4].id}', response['Link'])
+
+    def test_since_stops_before_unsettled_records(self):
+        DecisionRecord.objects.filter(id=self.records[3].id).update(timestamp=timezone.now())
+        response = self.client.get(self.URL, {'since': self.records[1].id})
+        self.assertEqual(self.ids(response), [self.records[2].id])
+        with self.settings(AUDIT_SETTLE_SECONDS=0):
+            response = self.client.get(self.URL, {'since': self.records[1].id})
+        self.assertEqual(self.ids(response), [r.id for r in self.records[2:]])
+
+    def test_filters(self):
+        response = self.client.get(self.URL, {'user_id': 'u1', 'classification': 'NOW'})
+        self.assertEqual(self.ids(response), [self.records[3].id, self.records[0].id])
+        self.assertEqual(self.client.get(self.URL, {'event_type': 'promotional'}).json(), [])
+
+    def test_bad_parameters(self):
+        for params in ({'classification': 'SOON'}, {'cursor': 'x'}, {'start': 'yesterday'},
+                       {'cursor': 1, 'since': 1}):
+            self.assertEqual(self.client.get(self.URL, params).status_code, 400, params)
+
+    def test_unchanged_poll_is_not_modified(self):
+        response = self.client.get(self.URL)
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        DecisionRecord.objects.create(event=self.records[0].event, classification='NOW', explanation='',
+                                      timestamp=timezone.now())
+        response = self.client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_depends_on_the_query(self):
+        self.assertNotEqual(self.client.get(self.URL, {'limit': 2})['ETag'], self.client.get(self.URL)['ETag'])
+        response = self.client.get(self.URL, {'user_id': 'u2'}, HTTP_IF_NONE_MATCH=self.client.get(self.URL)['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.hour = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+
+    def record(self, classification='NOW', reason='', event_type='update', age=None):
+        event = NotificationEvent.objects.create(user_id='u1', event_type=event_type, title='Your invoice is ready',
+                                                 channel='push', timestamp=timezone.now())
+        timestamp = timezone.now() - age if age is not None else self.hour + timedelta(minutes=5)
+        return DecisionRecord.objects.create(event=event, classification=classification, reason=reason,
+                                             explanation='', timestamp=timestamp)
+
+    def watermark(self):
+        return RollupWatermark.objects.get(name=WATERMARK).last_id
+
+    def test_records_are_folded_once(self):
+        self.record()
+        self.record('NEVER', 'duplicate')
+        self.assertEqual(compact(), 2)
+        self.assertEqual(compact(), 0)
+        last = self.record()
+        self.assertEqual(compact(), 1)
+        self.assertEqual(self.watermark(), last.id)
+        rollup = DecisionRollup.objects.get(classification='NOW')
+        self.assertEqual((rollup.bucket, rollup.event_type, rollup.channel, rollup.count),
+                         (self.hour, 'update', 'push', 2))
+
+    def test_batches_are_bounded_by_id(self):
+        records = [self.record() for _ in range(3)]
+        self.assertEqual(compact(batch_size=2), 2)
+        self.assertEqual(self.watermark(), records[1].id)
+        self.assertEqual(compact(batch_size=2), 1)
+        self.assertEqual(DecisionRollup.objects.get().count, 3)
+
+    def test_unsettled_records_wait_for_the_next_run(self):
+        settled = self.record()
+        fresh = self.record(age=timedelta(seconds=5))
+        self.record()
+        self.assertEqual(compact(settle_seconds=60), 1)
+        self.assertEqual(self.watermark(), settled.id)
+        self.assertEqual(compact(settle_seconds=0), 2)
+        self.assertEqual(self.watermark(), fresh.id + 1)
+
+    def test_summary_reads_the_rollups(self):
+        self.record()
+        self.record('NEVER', 'duplicate')
+        self.record('NEVER', 'duplicate', event_type='promotional')
+        self.record('LATER', 'quiet_hours', event_type='promotional')
+        compact()
+        DecisionRecord.objects.all().delete()
+        data = summary(hours=24)
+        self.assertEqual(data['total'], 4)
+        self.assertEqual(data['classifications'], {'NOW': 1, 'NEVER': 2, 'LATER': 1})
+        self.assertEqual(data['by_event_type']['promotional']['never_rate'], 0.5)
+        self.assertEqual(data['suppression_reasons'], {'duplicate': 2, 'quiet_hours': 1})
+        self.assertEqual(summary(hours=1)['total'], 0)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        self.old = timezone.now() - timedelta(days=200)
+        self.events = [NotificationEvent.objects.create(user_id=f'u{i}', event_type='update', title=f'event {i}',
+                                                        channel='push', timestamp=self.old)
+                       for i in range(3)]
+        for i, event in enumerate(self.events):
+            DecisionRecord.objects.create(event=event, classification='NOW' if i else 'NEVER', explanation='',
+                                          timestamp=self.old + timedelta(hours=i))
+        self.recent = DecisionRecord.objects.create(event=self.events[0], classification='NOW', explanation='',
+                                                    timestamp=timezone.now())
+
+    def read(self, *args):
+        out = StringIO()
+        call_command('read_archive', 'decisions', '--archive-dir', self.archive_dir, *args, stdout=out)
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_expired_rows_are_archived_then_deleted(self):
+        self.assertEqual(apply_retention('decisions', archive_dir=self.archive_dir, dry_run=True), 3)
+        self.assertEqual(DecisionRecord.objects.count(), 4)
+        self.assertEqual(apply_retention('decisions', chunk_size=2, archive_dir=self.archive_dir), 3)
+        self.assertEqual(list(DecisionRecord.objects.all()), [self.recent])
+        self.assertEqual(len(archive_files(self.archive_dir, 'decisions')), 2)
+        self.assertEqual([row['event_id'] for row in read_archives('decisions', self.archive_dir)],
+                         [event.id for event in self.events])
+
+    def test_events_take_their_children_along(self):
+        DeferredNotification.objects.create(event=self.events[2], scheduled_for=self.old)
+        self.recent.delete()
+        self.assertEqual(apply_retention('events', archive_dir=self.archive_dir), 2)
+        # The pending deferred row still needs its event.
+        self.assertEqual(list(NotificationEvent.objects.all()), [self.events[2]])
+        self.assertEqual(DecisionRecord.objects.get().event, self.events[2])
+        self.assertEqual(len(list(read_archives('decisions', self.archive_dir))), 2)
+        self.assertEqual(len(list(read_archives('events', self.archive_dir))), 2)
+
+    def test_read_archive_filters(self):
+        apply_retention('decisions', archive_dir=self.archive_dir)
+        self.assertEqual(len(self.read('--where', 'classification=NOW')), 2)
+        start = (self.old + timedelta(minutes=30)).isoformat()
+        self.assertEqual(len(self.read('--start', start)), 2)
+
+    def test_foreign_key_filter_matches_integer_ids(self):
+        apply_retention('decisions', archive_dir=self.archive_dir)
+        rows = self.read('--where', f'event_id={self.events[1].id}')
+        self.assertEqual([row['event_id'] for row in rows], [self.events[1].id])
+        self.assertEqual(len(self.read('--where', 'classification=NOW', '--where', f'event_id={self.events[0].id}')),
+                         0)
+
+    def test_bad_filters_are_rejected(self):
+        apply_retention('decisions', archive_dir=self.archive_dir)
+        with self.assertRaisesMessage(CommandError, 'event_id must be an integer'):
+            self.read('--where', 'event_id=abc')
+        with self.assertRaisesMessage(CommandError, 'Unknown column'):
+            self.read('--where', 'user_id=u1')
+        with self.assertRaisesMessage(CommandError, 'FIELD=VALUE'):
+            self.read('--where', 'classification')
@@ -1,13 +1,43 @@
-from django.http import JsonResponse
-from .models import DecisionRecord
+from django.http import HttpResponseNotModified, JsonResponse
+from django.utils.http import parse_etags, quote_etag
+from .queries import AuditQuery, AuditQueryError
+
 
 def audit_list(request):
-    records = DecisionRecord.objects.select_related('event').order_by('-timestamp')[:50]
+    """Decision records, newest first, with filters and keyset pagination.
+
+    Query parameters: ``user_id``, ``classification``, ``event_type``,
+    ``start``/``end`` (ISO 8601), ``limit``, and either ``cursor`` (older
+    page) or ``since`` (records newer than an id, oldest first). The next
+    page is announced in a ``Link: <...>; rel="next"`` header. Responses carry
+    an ETag, so a poll that matches ``If-None-Match`` gets a bodiless 304.
+    """
+    try:
+        query = AuditQuery(request.GET)
+    except AuditQueryError as exc:
+        return JsonResponse({'detail': str(exc)}, status=400)
+
+    # Records are append-only, so the query and its newest matching id
+    # identify the page.
+    etag = quote_etag(f'audit-{query.key()}-{query.latest_id() or 0}')
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    records, next_cursor = query.page()
     data = [{
+        'id': r.id,
         'event_id': r.event.id,
         'user_id': r.event.user_id,
         'classification': r.classification,
         'explanation': r.explanation,
         'timestamp': r.timestamp.isoformat()
     } for r in records]
-    return JsonResponse(data, safe=False)
+    response = JsonResponse(data, safe=False)
+    response['ETag'] = etag
+    if next_cursor is not None:
+        params = request.GET.copy()
+        params['since' if query.since is not None else 'cursor'] = next_cursor
+        response['Link'] = f'<{request.build_absolute_uri(request.path)}?{params.urlencode()}>; rel="next"'
+    return response
@@ -0,0 +1 @@
+# Benchmarks for the notification engine (run as python -m benchmarks.<name>)
@@ -0,0 +1,126 @@
+"""Synthetic event generator built on the datasets in create_custom_data.py.
+
+Produces any number of unsaved NotificationEvents with a realistic mix:
+event types weighted by dataset, users drawn from a Zipf-like distribution
+(a few very active users, a long tail of quiet ones), and configurable
+rates of exact and near duplicates.
+
+    python -m benchmarks.generator --events 1000000 --out events.jsonl.gz
+"""
+import argparse
+import bisect
+import copy
+import gzip
+import json
+import random
+import sys
+from datetime import timedelta
+from itertools import accumulate
+
+import create_custom_data as datasets  # sets up Django
+from django.utils import timezone
+
+# (factory, share of traffic, user prefix)
+DATASETS = [
+    (datasets.marketing_event, 0.30, 'user'),
+    (datasets.user_activity_event, 0.35, 'user'),
+    (datasets.urgent_reminders_event, 0.10, 'user'),
+    (datasets.daily_digests_event, 0.10, 'user'),
+    (datasets.system_alerts_event, 0.15, 'admin'),
+]
+
+
+class EventGenerator:
+    """Deterministic (seeded) stream of synthetic NotificationEvents.
+
+    ``duplicate_rate`` of events repeat a recent event verbatim and
+    ``near_duplicate_rate`` repeat one with a slightly different title.
+    Timestamps advance by ``interval`` seconds per event from ``start``.
+    """
+
+    def __init__(self, users=10000, duplicate_rate=0.05, near_duplicate_rate=0.05, zipf_s=1.1,
+                 seed=42, start=None, interval=0.01, user_prefix=''):
+        self.random = random.Random(seed)
+        self.users = users
+        self.duplicate_rate = duplicate_rate
+        self.near_duplicate_rate = near_duplicate_rate
+        self.start = start or timezone.now()
+        self.interval = interval
+        self.user_prefix = user_prefix
+        self._user_weights = list(accumulate(1 / (rank ** zipf_s) for rank in range(1, users + 1)))
+        self._dataset_weights = list(accumulate(share for _, share, _ in DATASETS))
+        self._recent = []
+
+    def __iter__(self):
+        return self.events()
+
+    def events(self, n=None):
+        i = 0
+        while n is None or i < n:
+            yield self.event(i)
+            i += 1
+
+    def event(self, i):
+        rnd = self.random
+        roll = rnd.random()
+        if self._recent and roll < self.duplicate_rate:
+            event = copy.copy(rnd.choice(self._recent))
+        elif self._recent and roll < self.duplicate_rate + self.near_duplicate_rate:
+            event = copy.copy(rnd.choice(self._recent))
+            event.title = f'{event.title.rsplit(" ", 1)[0]} {rnd.randrange(1000)}'
+        else:
+            factory, _, prefix = DATASETS[self._pick(self._dataset_weights)]
+            # The dataset factories draw from the module-level RNG.
+            random.seed(rnd.random())
+            event = factory(i, self.start)
+            event.user_id = f'{self.user_prefix}{prefix}{self._pick(self._user_weights) + 1}'
+            self._recent.append(event)
+            if len(self._recent) > 1000:
+                self._recent.pop(0)
+        event.pk = None
+        event.timestamp = self.start + timedelta(seconds=i * self.interval)
+        return event
+
+    def _pick(self, cumulative):
+        return min(len(cumulative) - 1, bisect.bisect_right(cumulative, self.random.random() * cumulative[-1]))
+
+
+def to_payload(event):
+    """JSON-serialisable dict in the shape the events API accepts."""
+    return {
+        'user_id': event.user_id,
+        'event_type': event.event_type,
+        'title': event.title,
+        'source': event.source,
+        'priority_hint': event.priority_hint,
+        'timestamp': event.timestamp.isoformat(),
+        'channel': event.channel,
+        'metadata': event.metadata,
+        'dedupe_key': event.dedupe_key,
+        'expires_at': event.expires_at.isoformat() if event.expires_at else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--duplicate-rate', type=float, default=0.05)
+    parser.add_argument('--near-duplicate-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='NDJSON output file (.gz to compress); stdout if omitted.')
+    args = parser.parse_args()
+
+    generator = EventGenerator(args.users, args.duplicate_rate, args.near_duplicate_rate, seed=args.seed)
+    if args.out:
+        opener = gzip.open if args.out.endswith('.gz') else open
+        out = opener(args.out, 'wt', encoding='utf-8')
+    else:
+        out = sys.stdout
+    with out:
+        for event in generator.events(args.events):
+            out.write(json.dumps(to_payload(event)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
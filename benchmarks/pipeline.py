@@ -0,0 +1,192 @@
+"""Latency, throughput and query-count benchmarks for the decision pipeline.
+
+Runs against whatever database and cache the settings select: SQLite and
+LocMemCache by default, Postgres and Redis when POSTGRES_DB / REDIS_URL
+point at local instances. A throwaway test database is created, so the
+development data is never touched. Results are written as JSON so runs can
+be compared:
+
+    python -m benchmarks.pipeline --events 20000 --out results.json
+    python -m benchmarks.pipeline --events 20000 --compare results.json
+"""
+import argparse
+import json
+import platform
+import time
+import uuid
+from datetime import timedelta
+
+from benchmarks.generator import EventGenerator, to_payload
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+from django.utils import timezone
+
+from api.models import NotificationEvent
+from engine.services import decide_notification, decide_notifications
+from engine.utils import evaluate_rules, fingerprint_event, legacy_fingerprint
+from scheduler.models import DeferredNotification
+from scheduler.tasks import process_due_deferred
+
+
+class QueryCounter:
+    """Counts SQL statements without DEBUG's per-query bookkeeping."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def timed(fn, items):
+    """Call ``fn`` on each item; return per-call latencies, wall time and query count."""
+    counter = QueryCounter()
+    latencies = []
+    with connection.execute_wrapper(counter):
+        started = time.perf_counter()
+        for item in items:
+            t0 = time.perf_counter()
+            fn(item)
+            latencies.append(time.perf_counter() - t0)
+        wall = time.perf_counter() - started
+    return latencies, wall, counter.count
+
+
+def summarize(latencies, wall, queries, operations):
+    latencies = sorted(latencies)
+    return {
+        'operations': operations,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 4),
+        'throughput_per_s': round(operations / wall, 1) if wall else None,
+        'queries_per_op': round(queries / operations, 3) if operations else None,
+    }
+
+
+def events(n, users, seed):
+    # A fresh user prefix per run keeps cache state from earlier runs (e.g.
+    # on a shared Redis) from turning everything into duplicates.
+    prefix = f'bench-{uuid.uuid4().hex[:6]}-'
+    return list(EventGenerator(users=users, seed=seed, user_prefix=prefix).events(n))
+
+
+def bench_fingerprint(n, users):
+    batch = events(n, users, seed=1)
+    return summarize(*timed(fingerprint_event, batch), n)
+
+
+def bench_fingerprint_legacy(n, users):
+    batch = events(n, users, seed=1)
+    return summarize(*timed(legacy_fingerprint, batch), n)
+
+
+def bench_evaluate_rules(n, users):
+    batch = events(n, users, seed=2)
+    return summarize(*timed(evaluate_rules, batch), n)
+
+
+def bench_decide(n, users):
+    batch = NotificationEvent.objects.bulk_create(events(n, users, seed=3))
+    return summarize(*timed(decide_notification, batch), n)
+
+
+def bench_decide_batch(n, users, batch_size=500):
+    saved = NotificationEvent.objects.bulk_create(events(n, users, seed=4))
+    chunks = [saved[i:i + batch_size] for i in range(0, n, batch_size)]
+    latencies, wall, queries = timed(decide_notifications, chunks)
+    result = summarize(latencies, wall, queries, n)
+    result['batch_size'] = batch_size
+    return result
+
+
+def bench_api(n, users):
+    client = Client()
+    payloads = [json.dumps(to_payload(e)) for e in events(n, users, seed=5)]
+    return summarize(*timed(
+        lambda body: client.post('/api/events/evaluate/', body, content_type='application/json'),
+        payloads), n)
+
+
+def bench_scheduler(n, users):
+    saved = NotificationEvent.objects.bulk_create(events(n, users, seed=6))
+    due = timezone.now() - timedelta(seconds=1)
+    DeferredNotification.objects.bulk_create([DeferredNotification(event=e, scheduled_for=due) for e in saved])
+    latencies, wall, queries = timed(lambda _: process_due_deferred(), [None])
+    result = summarize(latencies, wall, queries, n)
+    result['p50_ms'] = result['p99_ms'] = None  # one run over the whole queue
+    return result
+
+
+BENCHMARKS = {
+    'fingerprint_event': bench_fingerprint,
+    'fingerprint_legacy': bench_fingerprint_legacy,
+    'evaluate_rules': bench_evaluate_rules,
+    'decide_notification': bench_decide,
+    'decide_notifications': bench_decide_batch,
+    'api_evaluate': bench_api,
+    'process_due_deferred': bench_scheduler,
+}
+
+
+def compare(results, baseline):
+    print('\n📊 Change vs baseline (negative latency / positive throughput is better)')
+    for name, current in results['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p99_ms', 'throughput_per_s', 'queries_per_op'):
+            if current.get(metric) is not None and previous.get(metric):
+                changes.append(f'{metric} {(current[metric] - previous[metric]) / previous[metric]:+.1%}')
+        print(f'  {name:<22} ' + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--only', nargs='*', choices=sorted(BENCHMARKS), help='Run a subset of the benchmarks.')
+    parser.add_argument('--out', help='Write results JSON to this file.')
+    parser.add_argument('--compare', help='Baseline results JSON to compare against.')
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        results = {
+            'meta': {
+                'database': connection.vendor,
+                'cache': settings.CACHES['default']['BACKEND'],
+                'python': platform.python_version(),
+                'events': args.events,
+                'started_at': timezone.now().isoformat(),
+            },
+            'results': {},
+        }
+        for name in args.only or BENCHMARKS:
+            result = BENCHMARKS[name](args.events, args.users)
+            results['results'][name] = result
+            print(f'⏱️  {name:<22} {result}')
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f'✅ Results written to {args.out}')
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Query plans and timings for the engine's hot queries.
+
+Fills a throwaway test database (SQLite by default, Postgres when
+POSTGRES_DB is set) with synthetic rows, then prints the plan and the
+median latency of every query the scheduler, dashboard and audit views run.
+--database runs against the configured database itself instead, adding the
+synthetic rows to it unless --skip-populate is given.
+
+    python -m benchmarks.query_plans --rows 100000 --json plans.json
+    python -m benchmarks.query_plans --database --skip-populate
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from datetime import timedelta
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notification_engine.settings')
+django.setup()
+
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+from django.utils import timezone
+
+from api.models import NotificationEvent
+from audit.models import DecisionRecord
+from scheduler.models import DeferredNotification
+
+CHUNK = 10000
+USERS = 100000
+EVENT_TYPES = ['promotional', 'system_alert', 'social_interaction', 'digest', 'reminder']
+CLASSIFICATIONS = ['NOW', 'LATER', 'NEVER']
+# Only a small fraction of the deferred table is ever PENDING at once.
+DEFERRED_STATUSES = ['DELIVERED'] * 90 + ['DROPPED'] * 5 + ['EXPIRED'] * 3 + ['PENDING'] * 2
+
+
+def populate(rows):
+    """Insert ``rows`` events and decisions and ``rows // 10`` deferred rows."""
+    now = timezone.now()
+    start_id = (NotificationEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    print(f'📥 Inserting {rows:,} events/decisions into {connection.vendor}...')
+    for offset in range(0, rows, CHUNK):
+        n = min(CHUNK, rows - offset)
+        events = NotificationEvent.objects.bulk_create([
+            NotificationEvent(
+                user_id=f'user{random.randrange(USERS)}',
+                event_type=random.choice(EVENT_TYPES),
+                title=f'Synthetic event {offset + i}',
+                source='benchmark',
+                priority_hint='low',
+                timestamp=now - timedelta(seconds=random.randrange(30 * 86400)),
+                channel='push',
+            ) for i in range(n)
+        ])
+        if not events[0].pk:
+            # Backends that cannot return ids from bulk inserts.
+            for i, event in enumerate(events):
+                event.pk = start_id + offset + i
+        DecisionRecord.objects.bulk_create([
+            DecisionRecord(event=e, classification=random.choice(CLASSIFICATIONS), explanation='benchmark',
+                           timestamp=e.timestamp) for e in events
+        ])
+        DeferredNotification.objects.bulk_create([
+            DeferredNotification(event=e, status=random.choice(DEFERRED_STATUSES),
+                                 scheduled_for=e.timestamp + timedelta(hours=random.randrange(1, 48)))
+            for e in events[::10]
+        ])
+        if (offset // CHUNK) % 50 == 0:
+            print(f'   {offset + n:,} / {rows:,}')
+
+
+def hot_queries():
+    now = timezone.now()
+    user_id = NotificationEvent.objects.values_list('user_id', flat=True).first()
+    return {
+        'scheduler_due': DeferredNotification.objects.filter(
+            status='PENDING', scheduled_for__lte=now).order_by('scheduled_for')[:500],
+        'dashboard_deferred': DeferredNotification.objects.select_related('event').filter(
+            status='PENDING').order_by('scheduled_for')[:100],
+        'audit_latest': DecisionRecord.objects.select_related('event').order_by('-id')[:50],
+        'audit_classification': DecisionRecord.objects.select_related('event').filter(
+            classification='LATER').order_by('-id')[:50],
+        'dashboard_audit': DecisionRecord.objects.select_related('event').order_by('-id')[:100],
+        'user_history': NotificationEvent.objects.filter(user_id=user_id).order_by('-timestamp')[:50],
+    }
+
+
+def measure(queryset, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        list(queryset.all())
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--database', action='store_true',
+                        help='Use the configured database instead of a throwaway test database.')
+    parser.add_argument('--skip-populate', action='store_true', help='Measure existing rows (needs --database).')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', help='Write results to this file.')
+    args = parser.parse_args()
+    if args.skip_populate and not args.database:
+        parser.error('--skip-populate needs --database: the test database starts empty')
+
+    if not args.database:
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        if not args.skip_populate:
+            populate(args.rows)
+        results = {'vendor': connection.vendor, 'events': NotificationEvent.objects.count(), 'queries': {}}
+        for name, queryset in hot_queries().items():
+            plan = queryset.explain()
+            median_ms = measure(queryset, args.repeat)
+            results['queries'][name] = {'plan': plan, 'median_ms': round(median_ms, 3)}
+            print(f'\n🔎 {name}: {median_ms:.3f} ms (median of {args.repeat})\n{plan}')
+    finally:
+        if not args.database:
+            teardown_databases(old_config, verbosity=0)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f'\n✅ Results written to {args.json}')
+
+
+if __name__ == '__main__':
+    main()
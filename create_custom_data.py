@@ -19,88 +19,103 @@ def clear_existing_data():
     NotificationEvent.objects.all().delete()
     print('🧹 Cleared existing notifications and audits')
 
+def marketing_event(i, base_date):
+    """Unsaved event #i of the marketing dataset."""
+    ts = base_date - timedelta(days=random.randint(0, 5), hours=random.randint(10, 18))
+    return NotificationEvent(
+        user_id=f'user{random.randint(1, 10)}',
+        event_type='promotional',
+        title=f'Spring Sale Offer {i}',
+        source='marketing_platform',
+        priority_hint='low',
+        timestamp=ts,
+        channel='email',
+        metadata={'campaign': 'spring_2026', 'discount': '20%'},
+    )
+
 def create_dataset_marketing(base_date):
     """Creates a dataset for marketing notifications, typically lower priority."""
     print("📈 Generating Marketing Dataset...")
-    for i in range(20):
-        ts = base_date - timedelta(days=random.randint(0, 5), hours=random.randint(10, 18))
-        NotificationEvent.objects.create(
-            user_id=f'user{random.randint(1, 10)}',
-            event_type='promotional',
-            title=f'Spring Sale Offer {i}',
-            source='marketing_platform',
-            priority_hint='low',
-            timestamp=ts,
-            channel='email',
-            metadata={'campaign': 'spring_2026', 'discount': '20%'},
-        )
+    NotificationEvent.objects.bulk_create([marketing_event(i, base_date) for i in range(20)])
+
+def system_alerts_event(i, base_date):
+    """Unsaved event #i of the system alerts dataset."""
+    ts = base_date - timedelta(hours=random.randint(0, 48), minutes=random.randint(0, 59))
+    return NotificationEvent(
+        user_id=f'admin{random.randint(1, 3)}',
+        event_type='system_alert',
+        title=f'High CPU Usage on Node {i}',
+        source='monitoring_system',
+        priority_hint='high',
+        timestamp=ts,
+        channel='sms',
+        metadata={'node': f'app-node-{i}', 'cpu_percent': random.randint(85, 99)},
+    )
 
 def create_dataset_system_alerts(base_date):
     """Creates a dataset for system alerts, typically higher priority and near real-time."""
     print("⚙️ Generating System Alerts Dataset...")
-    for i in range(15):
-        ts = base_date - timedelta(hours=random.randint(0, 48), minutes=random.randint(0, 59))
-        NotificationEvent.objects.create(
-            user_id=f'admin{random.randint(1, 3)}',
-            event_type='system_alert',
-            title=f'High CPU Usage on Node {i}',
-            source='monitoring_system',
-            priority_hint='high',
-            timestamp=ts,
-            channel='sms',
-            metadata={'node': f'app-node-{i}', 'cpu_percent': random.randint(85, 99)},
-        )
+    NotificationEvent.objects.bulk_create([system_alerts_event(i, base_date) for i in range(15)])
+
+def user_activity_event(i, base_date):
+    """Unsaved event #i of the user activity dataset."""
+    ts = base_date - timedelta(days=random.randint(0, 7), hours=random.randint(0, 23))
+    return NotificationEvent(
+        user_id=f'user{random.randint(1, 15)}',
+        event_type='social_interaction',
+        title=f'Someone liked your post {i}',
+        source='app_frontend',
+        priority_hint='medium',
+        timestamp=ts,
+        channel='push',
+        metadata={'post_id': i, 'interaction_type': 'like'},
+    )
 
 def create_dataset_user_activity(base_date):
     """Creates a dataset of user activity notifications (e.g., likes, comments)."""
     print("👤 Generating User Activity Dataset...")
-    for i in range(25):
-        ts = base_date - timedelta(days=random.randint(0, 7), hours=random.randint(0, 23))
-        NotificationEvent.objects.create(
-            user_id=f'user{random.randint(1, 15)}',
-            event_type='social_interaction',
-            title=f'Someone liked your post {i}',
-            source='app_frontend',
-            priority_hint='medium',
-            timestamp=ts,
-            channel='push',
-            metadata={'post_id': i, 'interaction_type': 'like'},
-        )
+    NotificationEvent.objects.bulk_create([user_activity_event(i, base_date) for i in range(25)])
+
+def daily_digests_event(i, base_date):
+    """Unsaved event #i of the daily digests dataset."""
+    # Scheduled roughly around 8 AM
+    ts = base_date - timedelta(days=random.randint(0, 5))
+    ts = ts.replace(hour=8, minute=random.randint(0, 30))
+    return NotificationEvent(
+        user_id=f'user{random.randint(1, 10)}',
+        event_type='digest',
+        title=f'Your Daily Activity Summary {i}',
+        source='summary_job',
+        priority_hint='low',
+        timestamp=ts,
+        channel='email',
+        metadata={'items_included': random.randint(5, 20)},
+    )
 
 def create_dataset_daily_digests(base_date):
     """Creates a dataset for daily email digests."""
     print("📰 Generating Daily Digests Dataset...")
-    for i in range(15):
-        # Scheduled roughly around 8 AM
-        ts = base_date - timedelta(days=random.randint(0, 5))
-        ts = ts.replace(hour=8, minute=random.randint(0, 30))
-        NotificationEvent.objects.create(
-            user_id=f'user{random.randint(1, 10)}',
-            event_type='digest',
-            title=f'Your Daily Activity Summary {i}',
-            source='summary_job',
-            priority_hint='low',
-            timestamp=ts,
-            channel='email',
-            metadata={'items_included': random.randint(5, 20)},
-        )
+    NotificationEvent.objects.bulk_create([daily_digests_event(i, base_date) for i in range(15)])
+
+def urgent_reminders_event(i, base_date):
+    """Unsaved event #i of the urgent reminders dataset."""
+    # Scheduled randomly in the last 2 days
+    ts = base_date - timedelta(hours=random.randint(1, 48))
+    return NotificationEvent(
+        user_id=f'user{random.randint(1, 10)}',
+        event_type='reminder',
+        title=f'Action Required: Subscription Renewal {i}',
+        source='billing_system',
+        priority_hint='high',
+        timestamp=ts,
+        channel='push',
+        metadata={'amount_due': 19.99, 'deadline': (ts + timedelta(days=2)).isoformat()},
+    )
 
 def create_dataset_urgent_reminders(base_date):
     """Creates a dataset for high-priority upcoming events (e.g., payment due)."""
     print("⏰ Generating Urgent Reminders Dataset...")
-    for i in range(10):
-        # Scheduled randomly in the last 2 days
-        ts = base_date - timedelta(hours=random.randint(1, 48))
-        NotificationEvent.objects.create(
-            user_id=f'user{random.randint(1, 10)}',
-            event_type='reminder',
-            title=f'Action Required: Subscription Renewal {i}',
-            source='billing_system',
-            priority_hint='high',
-            timestamp=ts,
-            channel='push',
-            metadata={'amount_due': 19.99, 'deadline': (ts + timedelta(days=2)).isoformat()},
-        )
+    NotificationEvent.objects.bulk_create([urgent_reminders_event(i, base_date) for i in range(10)])
 
 def create_rules():
     """Create example RuleConfig entries with distinct requirements."""
@@ -8,4 +8,5 @@ urlpatterns = [
     path('rules/', views.rule_list, name='rules'),
     path('audit/', views.audit_log, name='audit'),
     path('deferred/', views.deferred_queue, name='deferred'),
+    path('summary/', views.dashboard_summary, name='summary'),
 ]
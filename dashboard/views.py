@@ -1,6 +1,8 @@
+from django.http import JsonResponse
 from django.shortcuts import render
 from rules.models import RuleConfig
-from audit.models import DecisionRecord
+from audit.queries import AuditQuery, AuditQueryError
+from audit.rollups import summary
 from scheduler.models import DeferredNotification
 
 def dashboard_home(request):
@@ -11,9 +13,31 @@ def rule_list(request):
     return render(request, 'dashboard/rule_list.html', {'rules': rules})
 
 def audit_log(request):
-    decisions = DecisionRecord.objects.select_related('event').order_by('-timestamp')[:100]
-    return render(request, 'dashboard/audit_log.html', {'decisions': decisions})
+    try:
+        query = AuditQuery(request.GET, default_limit=100)
+    except AuditQueryError as exc:
+        return render(request, 'dashboard/audit_log.html', {'decisions': [], 'error': str(exc)}, status=400)
+    decisions, next_cursor = query.page()
+    params = request.GET.copy()
+    params.pop('since', None)
+    params['cursor'] = next_cursor
+    return render(request, 'dashboard/audit_log.html', {
+        'decisions': decisions,
+        'filters': request.GET,
+        'next_query': params.urlencode() if next_cursor is not None else None,
+    })
 
 def deferred_queue(request):
     pending = DeferredNotification.objects.filter(status='PENDING').order_by('scheduled_for')
     return render(request, 'dashboard/defer_queue.html', {'pending': pending})
+
+def dashboard_summary(request):
+    """Decision rates, suppression reasons and queue depth, read from rollups."""
+    try:
+        hours = max(1, min(int(request.GET.get('hours', 24)), 24 * 90))
+    except ValueError:
+        hours = 24
+    data = summary(hours)
+    if request.GET.get('format') == 'json':
+        return JsonResponse(data)
+    return render(request, 'dashboard/summary.html', {'summary': data})
@@ -0,0 +1,228 @@
+"""Per-channel delivery backends.
+
+A backend sends a list of Deliveries in as few provider calls as the
+provider allows and returns one SendResult per delivery, in order. The
+dispatcher keeps a pool of instances per channel, one per concurrent
+sender; an instance is only used by one thread at a time and keeps its
+connection open between batches.
+
+When the whole call fails (connection refused, provider 5xx, ...) a
+backend raises DeliveryError; ``retryable`` says whether sending the same
+batch again may succeed. Backends are configured per channel in
+DELIVERY_BACKENDS, like CACHES:
+
+    'sms': {'BACKEND': 'delivery.backends.HTTPBackend', 'CONCURRENCY': 8,
+            'OPTIONS': {'URL': 'https://sms.example.com/v1/bulk', 'TOKEN': '...'}}
+"""
+import http.client
+import json
+import random
+import smtplib
+import threading
+import time
+from urllib.parse import urlsplit
+from django.core import mail
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+# Payloads "sent" by LocmemBackend in this process, like django.core.mail.outbox.
+outbox = []
+_outbox_lock = threading.Lock()
+
+
+class DeliveryError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class SendResult:
+    __slots__ = ('ok', 'provider_id', 'error', 'retryable')
+
+    def __init__(self, ok, provider_id=None, error='', retryable=True):
+        self.ok = ok
+        self.provider_id = provider_id
+        self.error = error
+        self.retryable = retryable
+
+
+def make_backend(channel, config):
+    return import_string(config['BACKEND'])(channel, config.get('OPTIONS', {}))
+
+
+class BaseBackend:
+    # Most deliveries a single provider call may carry.
+    max_batch = 100
+
+    def __init__(self, channel, options):
+        self.channel = channel
+        self.options = options
+        self.max_batch = options.get('MAX_BATCH', self.max_batch)
+
+    def open(self):
+        """Connect if not connected; called before every batch."""
+
+    def close(self):
+        """Drop the connection; the next open() reconnects."""
+
+    def send_batch(self, deliveries):
+        raise NotImplementedError
+
+    def payload(self, delivery):
+        # The delivery id doubles as an idempotency key: a batch is sent
+        # again if the worker dies before recording the result.
+        event = delivery.event
+        return {
+            'id': delivery.id,
+            'event_id': event.id,
+            'user_id': event.user_id,
+            'channel': delivery.channel,
+            'event_type': event.event_type,
+            'title': event.title,
+            'metadata': event.metadata,
+        }
+
+
+class LocmemBackend(BaseBackend):
+    """Fake provider for tests and local runs: appends payloads to ``outbox``.
+
+    OPTIONS: LATENCY (seconds per call), FAILURE_RATE (share of messages
+    rejected with a retryable error) and DOWN (every call raises).
+    """
+
+    def send_batch(self, deliveries):
+        if self.options.get('LATENCY'):
+            time.sleep(self.options['LATENCY'])
+        if self.options.get('DOWN'):
+            raise DeliveryError(f'{self.channel} provider unavailable')
+        failure_rate = self.options.get('FAILURE_RATE', 0)
+        results, sent = [], []
+        for delivery in deliveries:
+            if failure_rate and random.random() < failure_rate:
+                results.append(SendResult(False, error='rejected by fake provider'))
+            else:
+                sent.append(self.payload(delivery))
+                results.append(SendResult(True, provider_id=f'locmem-{delivery.id}'))
+        with _outbox_lock:
+            outbox.extend(sent)
+        return results
+
+
+class SMTPBackend(BaseBackend):
+    """Email through Django's mail backend (EMAIL_* settings), on one SMTP
+    session kept open across batches. The address is ``metadata['email']``.
+
+    OPTIONS: EMAIL_BACKEND (defaults to settings.EMAIL_BACKEND) and
+    FROM_EMAIL (defaults to DEFAULT_FROM_EMAIL).
+    """
+    max_batch = 50
+
+    def __init__(self, channel, options):
+        super().__init__(channel, options)
+        self.connection = None
+
+    def open(self):
+        if self.connection is None:
+            self.connection = mail.get_connection(self.options.get('EMAIL_BACKEND'), fail_silently=False)
+            self.connection.open()
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def send_batch(self, deliveries):
+        results, messages = [], []
+        for delivery in deliveries:
+            event = delivery.event
+            address = event.metadata.get('email') if isinstance(event.metadata, dict) else None
+            if not address:
+                results.append(SendResult(False, error='no email address in metadata', retryable=False))
+                continue
+            body = event.metadata.get('body') or event.title
+            messages.append(mail.EmailMessage(event.title, body, self.options.get('FROM_EMAIL'), [address],
+                                              connection=self.connection,
+                                              headers={'X-Delivery-Id': str(delivery.id)}))
+            results.append(SendResult(True))
+        if messages:
+            try:
+                self.connection.send_messages(messages)
+            except (smtplib.SMTPException, OSError) as exc:
+                self.close()
+                raise DeliveryError(f'SMTP: {exc}')
+        return results
+
+
+class HTTPBackend(BaseBackend):
+    """JSON-over-HTTP(S) provider with a bulk endpoint (SMS and push gateways).
+
+    POSTs ``{"messages": [payload, ...]}`` to OPTIONS['URL'] on a keep-alive
+    connection, with OPTIONS['TOKEN'] as a bearer token if set. A 2xx reply
+    may carry ``{"results": [{"id": ..., "error": ...}, ...]}`` in request
+    order; without it every message counts as accepted. 429 and 5xx replies
+    are retried, other replies fail the batch for good.
+    """
+
+    def __init__(self, channel, options):
+        super().__init__(channel, options)
+        url = urlsplit(options['URL'])
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host, self.port = url.hostname, url.port
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.timeout = options.get('TIMEOUT', 10)
+        self.headers = {'Content-Type': 'application/json'}
+        if options.get('TOKEN'):
+            self.headers['Authorization'] = f"Bearer {options['TOKEN']}"
+        self.connection = None
+        self._reused = False
+
+    def open(self):
+        if self.connection is None:
+            self.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+            self._reused = False
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def send_batch(self, deliveries):
+        body = json.dumps({'messages': [self.payload(d) for d in deliveries]}, cls=DjangoJSONEncoder)
+        status, data = self._post(body)
+        if status == 429 or status >= 500:
+            raise DeliveryError(f'{self.channel}: HTTP {status}')
+        if status >= 300:
+            raise DeliveryError(f'{self.channel}: HTTP {status}: {data[:200]!r}', retryable=False)
+        try:
+            replies = json.loads(data)['results'] if data else None
+        except (ValueError, KeyError, TypeError):
+            replies = None
+        if not isinstance(replies, list) or len(replies) != len(deliveries):
+            return [SendResult(True) for _ in deliveries]
+        return [SendResult(False, error=str(reply['error'])) if reply.get('error')
+                else SendResult(True, provider_id=reply.get('id')) for reply in replies]
+
+    def _post(self, body):
+        try:
+            self.connection.request('POST', self.path, body, self.headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as exc:
+            # The provider closed an idle keep-alive connection: reconnect once.
+            self.close()
+            if not self._reused:
+                raise DeliveryError(f'{self.channel}: {exc}')
+            self.open()
+            return self._post(body)
+        except (OSError, http.client.HTTPException) as exc:
+            self.close()
+            raise DeliveryError(f'{self.channel}: {exc}')
+        self._reused = True
+        if response.will_close:
+            self.close()
+        return response.status, data
@@ -0,0 +1,277 @@
+"""Sending Deliveries through the per-channel backends.
+
+Workers claim due PENDING rows in leased batches, as the deferred scheduler
+does. The dispatcher splits a batch by channel into chunks of the backend's
+bulk size and sends the chunks concurrently. Each channel has its own pool
+of CONCURRENCY threads, and each thread has its own long-lived backend
+connection. Throughput is therefore bounded by the providers, not by one
+send at a time, and all channels are sent in parallel.
+
+A failed send is retried later with exponentially growing, jittered delays
+keyed on ``retry_count``, until DELIVERY_MAX_RETRIES. Whole calls that keep
+failing open the channel's circuit breaker. While it is open, that
+channel's rows are pushed back without being tried, until a single probe
+call succeeds.
+"""
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from engine import leasing, metrics
+from engine.leasing import make_worker_id, release as _release
+from .backends import DeliveryError, SendResult, make_backend
+from .models import Delivery
+
+logger = logging.getLogger(__name__)
+
+UPDATE_FIELDS = ['status', 'retry_count', 'next_attempt_at', 'claimed_by', 'lease_expires_at', 'sent_at',
+                 'provider_id', 'last_error']
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failed calls. After
+    ``reset_seconds`` one probe call is let through (half-open): success
+    closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, name, threshold=5, reset_seconds=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.probing else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.reset_seconds:
+                return False
+            self.probing = True
+            return True
+
+    def retry_after(self):
+        """Seconds to hold back calls refused by the breaker: until the next
+        probe, or a full period while a probe is in flight.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.reset_seconds - time.monotonic()) or self.reset_seconds
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f'Delivery circuit for {self.name} closed')
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing:
+                logger.info(f'Delivery circuit for {self.name} stays open: probe failed')
+            elif self.opened_at is None and self.failures >= self.threshold:
+                logger.warning(f'Delivery circuit for {self.name} open after {self.failures} failed calls')
+            else:
+                return
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class ChannelSender:
+    """Bounded-concurrency sender for one channel.
+
+    ``concurrency`` backend instances are kept in a pool, so at most that
+    many calls are in flight and every call reuses a warm connection.
+    """
+
+    def __init__(self, channel, config):
+        self.channel = channel
+        self.concurrency = config.get('CONCURRENCY', 4)
+        backends = [make_backend(channel, config) for _ in range(self.concurrency)]
+        self._backends = queue.LifoQueue()
+        for backend in backends:
+            self._backends.put(backend)
+        max_batch = backends[0].max_batch
+        self.batch_size = min(config.get('BATCH_SIZE') or max_batch, max_batch)
+        self.breaker = CircuitBreaker(channel, getattr(settings, 'DELIVERY_BREAKER_THRESHOLD', 5),
+                                      getattr(settings, 'DELIVERY_BREAKER_RESET_SECONDS', 30))
+        self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix=f'deliver-{channel}')
+
+    def submit(self, chunk):
+        return self._executor.submit(self._send, chunk)
+
+    def _send(self, chunk):
+        """SendResults for ``chunk``, or None if the breaker refused the call."""
+        # Checked when the call is about to go out, so chunks still queued
+        # behind the call that opened the breaker are not sent.
+        if not self.breaker.allow():
+            return None
+        backend = self._backends.get()
+        started = time.perf_counter()
+        try:
+            backend.open()
+            results = backend.send_batch(chunk)
+        except DeliveryError as exc:
+            # A rejected request says nothing about the provider's health.
+            if exc.retryable:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            return [SendResult(False, error=str(exc), retryable=exc.retryable)] * len(chunk)
+        except Exception as exc:
+            logger.exception(f'{self.channel} backend failed on a batch of {len(chunk)}: {exc}')
+            backend.close()
+            self.breaker.failure()
+            return [SendResult(False, error=f'{type(exc).__name__}: {exc}')] * len(chunk)
+        finally:
+            self._backends.put(backend)
+            if metrics.enabled():
+                metrics.DELIVERY_CALL_SECONDS.observe(time.perf_counter() - started, self.channel)
+        self.breaker.success()
+        return results
+
+    def close(self):
+        self._executor.shutdown()
+        while not self._backends.empty():
+            self._backends.get().close()
+
+
+class Dispatcher:
+    """Sends Deliveries through the DELIVERY_BACKENDS of their channels.
+
+    Channel senders (threads and connections) are created on first use and
+    live until close(), so keep one Dispatcher per worker process.
+    """
+
+    def __init__(self, backends=None):
+        self.config = backends if backends is not None else getattr(settings, 'DELIVERY_BACKENDS', {})
+        self.max_retries = getattr(settings, 'DELIVERY_MAX_RETRIES', 5)
+        self.retry_base = getattr(settings, 'DELIVERY_RETRY_BASE_SECONDS', 5)
+        self.retry_max = getattr(settings, 'DELIVERY_RETRY_MAX_SECONDS', 900)
+        self._senders = {}
+
+    def sender(self, channel):
+        if channel not in self._senders:
+            config = self.config.get(channel)
+            self._senders[channel] = ChannelSender(channel, config) if config else None
+        return self._senders[channel]
+
+    def send(self, deliveries, now=None):
+        """Send ``deliveries`` and update them in memory; the caller saves."""
+        now = now or timezone.now()
+        by_channel = {}
+        for delivery in deliveries:
+            expires_at = delivery.event.expires_at
+            if expires_at and expires_at <= now:
+                self._finish(delivery, SendResult(False, error='expired before delivery', retryable=False), now)
+            else:
+                by_channel.setdefault(delivery.channel, []).append(delivery)
+
+        calls = []
+        for channel, rows in by_channel.items():
+            sender = self.sender(channel)
+            if sender is None:
+                result = SendResult(False, error=f'no delivery backend for channel {channel!r}', retryable=False)
+                for delivery in rows:
+                    self._finish(delivery, result, now)
+                continue
+            for start in range(0, len(rows), sender.batch_size):
+                chunk = rows[start:start + sender.batch_size]
+                calls.append((sender, chunk, sender.submit(chunk)))
+
+        for sender, chunk, future in calls:
+            results = future.result()
+            if results is None:
+                # Circuit open: not attempted, so no retry is used up.
+                retry_at = now + timedelta(seconds=sender.breaker.retry_after() + random.uniform(0, 1))
+                for delivery in chunk:
+                    delivery.next_attempt_at = retry_at
+                    _release(delivery)
+                if metrics.enabled():
+                    metrics.DELIVERY_MESSAGES.inc(sender.channel, 'postponed', amount=len(chunk))
+                continue
+            if len(results) != len(chunk):
+                # Without a result per row there is no telling which rows went out.
+                logger.error(f'{sender.channel} backend returned {len(results)} results for {len(chunk)} deliveries')
+                results = [SendResult(False, error=f'backend returned {len(results)} results for '
+                                                   f'{len(chunk)} deliveries')] * len(chunk)
+            for delivery, result in zip(chunk, results):
+                self._finish(delivery, result, now)
+
+    def backoff(self, retry_count):
+        """Delay before retry number ``retry_count``: exponential, capped,
+        and jittered over its upper half so failed batches spread out.
+        """
+        delay = min(self.retry_max, self.retry_base * 2 ** (retry_count - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _finish(self, delivery, result, now):
+        if result.ok:
+            delivery.status = 'SENT'
+            delivery.sent_at = timezone.now()
+            delivery.provider_id = result.provider_id
+            delivery.last_error = ''
+            outcome = 'sent'
+        elif result.retryable and delivery.retry_count < self.max_retries:
+            delivery.retry_count += 1
+            delivery.next_attempt_at = now + timedelta(seconds=self.backoff(delivery.retry_count))
+            delivery.last_error = result.error
+            outcome = 'retry'
+        else:
+            delivery.status = 'FAILED'
+            delivery.last_error = result.error
+            outcome = 'failed'
+            logger.warning(f'Delivery {delivery.id} of event {delivery.event_id} failed: {result.error}')
+        _release(delivery)
+        if metrics.enabled():
+            metrics.DELIVERY_MESSAGES.inc(delivery.channel, outcome)
+
+    def close(self):
+        for sender in self._senders.values():
+            if sender is not None:
+                sender.close()
+        self._senders.clear()
+
+
+def claim_due(worker_id, batch_size=1000, lease_seconds=120, now=None):
+    """Lease up to ``batch_size`` due deliveries to ``worker_id`` and return
+    them, with their events (see engine.leasing).
+    """
+    return leasing.claim_due(Delivery, 'next_attempt_at', worker_id, batch_size, lease_seconds, now,
+                             related=('event',))
+
+
+def deliver_due(dispatcher, batch_size=None, worker_id=None, lease_seconds=None):
+    """Send every due delivery in leased batches; returns the rows handled.
+
+    Safe to run from several processes at once. The lease must outlast a
+    batch's slowest provider call, or another worker may send it again.
+    """
+    batch_size = batch_size or getattr(settings, 'DELIVERY_BATCH_SIZE', 1000)
+    lease_seconds = lease_seconds or getattr(settings, 'DELIVERY_LEASE_SECONDS', 120)
+    worker_id = worker_id or make_worker_id()
+    handled = 0
+    while True:
+        batch = claim_due(worker_id, batch_size, lease_seconds)
+        if not batch:
+            return handled
+        dispatcher.send(batch)
+        Delivery.objects.bulk_update(batch, UPDATE_FIELDS)
+        handled += len(batch)
+
@@ -0,0 +1,20 @@
+from contextlib import closing
+from django.conf import settings
+from delivery.dispatcher import Dispatcher, deliver_due
+from engine.management.workers import WorkerCommand
+
+
+class Command(WorkerCommand):
+    help = 'Send due deliveries through their channel backends in leased batches.'
+    report = '{worker_id}: handled {count} deliveries'
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'DELIVERY_BACKENDS', {}):
+            self.stderr.write('No DELIVERY_BACKENDS configured: every due delivery will fail.')
+        super().handle(*args, **options)
+
+    def worker(self):
+        return closing(Dispatcher())
+
+    def drain(self, dispatcher, worker_id, options):
+        return deliver_due(dispatcher, options['batch_size'], worker_id, options['lease_seconds'])
@@ -0,0 +1,40 @@
+from django.db import models
+from django.utils import timezone
+from api.models import NotificationEvent
+
+class Delivery(models.Model):
+    """Outbox row for one event to be sent on its channel.
+
+    Created with the NOW decision (see engine.services) and sent by the
+    dispatcher (see delivery.dispatcher), which retries it with backoff
+    until it is SENT or gives up.
+    """
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('SENT', 'Sent'),
+        ('FAILED', 'Failed'),
+    ]
+
+    event = models.ForeignKey(NotificationEvent, on_delete=models.CASCADE, related_name='deliveries')
+    channel = models.CharField(max_length=20)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    retry_count = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # Lease held by the dispatcher worker currently sending the row.
+    claimed_by = models.CharField(max_length=64, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    provider_id = models.CharField(max_length=255, blank=True, null=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], name='delivery_pending_due_idx',
+                         condition=models.Q(status='PENDING')),
+            models.Index(fields=['claimed_by'], name='delivery_claimed_idx',
+                         condition=models.Q(claimed_by__isnull=False)),
+        ]
+
+    def __str__(self):
+        return f'Delivery {self.event_id} via {self.channel} [{self.status}]'
@@ -0,0 +1,151 @@
+from datetime import timedelta
+from unittest import mock
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from api.models import NotificationEvent
+from engine.services import decide_notification, record_decisions
+from rules.snapshot import invalidate_rule_snapshot
+from . import backends
+from .dispatcher import CircuitBreaker, Dispatcher, deliver_due
+from .models import Delivery
+
+
+def locmem(**options):
+    return {'BACKEND': 'delivery.backends.LocmemBackend', 'CONCURRENCY': 1, 'OPTIONS': options}
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_opens_after_threshold_and_probes_once(self):
+        breaker = CircuitBreaker('sms', threshold=2, reset_seconds=30)
+        with mock.patch('delivery.dispatcher.time.monotonic', return_value=100.0) as clock:
+            breaker.failure()
+            self.assertEqual(breaker.state, 'closed')
+            with self.assertLogs('delivery.dispatcher', 'WARNING'):
+                breaker.failure()
+            self.assertEqual(breaker.state, 'open')
+            self.assertFalse(breaker.allow())
+            self.assertEqual(breaker.retry_after(), 30)
+
+            clock.return_value = 131.0
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, 'half-open')
+            # Only one probe at a time.
+            self.assertFalse(breaker.allow())
+            breaker.failure()
+            self.assertEqual(breaker.state, 'open')
+            self.assertFalse(breaker.allow())
+
+            clock.return_value = 162.0
+            self.assertTrue(breaker.allow())
+            breaker.success()
+            self.assertEqual(breaker.state, 'closed')
+            self.assertTrue(breaker.allow())
+
+
+class DeliveryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+        backends.outbox.clear()
+
+    def delivery(self, title='Your invoice is ready', channel='push', expires_at=None):
+        event = NotificationEvent.objects.create(user_id='u1', event_type='update', title=title, channel=channel,
+                                                 timestamp=timezone.now(), expires_at=expires_at)
+        return Delivery.objects.create(event=event, channel=channel)
+
+    def deliver(self, config, **kwargs):
+        dispatcher = Dispatcher(config)
+        self.addCleanup(dispatcher.close)
+        return deliver_due(dispatcher, worker_id='test-worker', **kwargs)
+
+    def refresh(self, delivery):
+        delivery.refresh_from_db()
+        return delivery
+
+
+class OutboxTests(DeliveryTestCase):
+    @override_settings(ENGINE_DELIVERY=True)
+    def test_now_decisions_get_a_delivery(self):
+        event = NotificationEvent.objects.create(user_id='u1', event_type='update', title='Your invoice is ready',
+                                                 channel='sms', timestamp=timezone.now())
+        self.assertEqual(decide_notification(event)[0], 'NOW')
+        self.assertEqual(decide_notification(event)[0], 'NEVER')
+        delivery = Delivery.objects.get()
+        self.assertEqual((delivery.event, delivery.channel, delivery.status), (event, 'sms', 'PENDING'))
+
+    @override_settings(ENGINE_DELIVERY=True)
+    def test_replays_are_not_delivered(self):
+        event = NotificationEvent.objects.create(user_id='u1', event_type='update', title='Your invoice is ready',
+                                                 channel='sms', timestamp=timezone.now())
+        self.assertEqual(record_decisions([event])[0].classification, 'NOW')
+        self.assertFalse(Delivery.objects.exists())
+
+    def test_no_deliveries_by_default(self):
+        event = NotificationEvent.objects.create(user_id='u1', event_type='update', title='Your invoice is ready',
+                                                 channel='sms', timestamp=timezone.now())
+        decide_notification(event)
+        self.assertFalse(Delivery.objects.exists())
+
+
+class DispatchTests(DeliveryTestCase):
+    def test_batches_are_sent_in_chunks(self):
+        rows = [self.delivery(f'Item {i}') for i in range(5)]
+        with mock.patch.object(backends.LocmemBackend, 'send_batch', autospec=True,
+                               side_effect=backends.LocmemBackend.send_batch) as send_batch:
+            self.assertEqual(self.deliver({'push': locmem(MAX_BATCH=2)}), 5)
+        self.assertEqual([len(call.args[1]) for call in send_batch.call_args_list], [2, 2, 1])
+        for delivery in rows:
+            delivery = self.refresh(delivery)
+            self.assertEqual((delivery.status, delivery.provider_id), ('SENT', f'locmem-{delivery.id}'))
+            self.assertIsNone(delivery.claimed_by)
+        self.assertEqual(sorted(p['id'] for p in backends.outbox), [d.id for d in rows])
+
+    @override_settings(DELIVERY_MAX_RETRIES=1)
+    def test_failed_sends_back_off_then_fail(self):
+        delivery = self.delivery()
+        with self.assertLogs('delivery.dispatcher', 'WARNING'):
+            before = timezone.now()
+            self.deliver({'push': locmem(DOWN=True)})
+            delivery = self.refresh(delivery)
+            self.assertEqual((delivery.status, delivery.retry_count), ('PENDING', 1))
+            self.assertGreater(delivery.next_attempt_at, before)
+
+            Delivery.objects.update(next_attempt_at=timezone.now())
+            self.deliver({'push': locmem(DOWN=True)})
+        delivery = self.refresh(delivery)
+        self.assertEqual(delivery.status, 'FAILED')
+        self.assertIn('unavailable', delivery.last_error)
+
+    def test_short_result_list_is_retried(self):
+        rows = [self.delivery(f'Item {i}') for i in range(3)]
+        send_batch = backends.LocmemBackend.send_batch
+        with mock.patch.object(backends.LocmemBackend, 'send_batch', autospec=True,
+                               side_effect=lambda backend, chunk: send_batch(backend, chunk)[:1]), \
+                self.assertLogs('delivery.dispatcher', 'ERROR'):
+            self.deliver({'push': locmem()})
+        for delivery in rows:
+            delivery = self.refresh(delivery)
+            self.assertEqual((delivery.status, delivery.retry_count), ('PENDING', 1))
+            self.assertIn('returned 1 results for 3 deliveries', delivery.last_error)
+            self.assertIsNone(delivery.claimed_by)
+
+    def test_undeliverable_rows_fail_without_a_call(self):
+        missing = self.delivery(channel='email')
+        expired = self.delivery(expires_at=timezone.now() - timedelta(seconds=1))
+        with self.assertLogs('delivery.dispatcher', 'WARNING'):
+            self.deliver({'push': locmem()})
+        self.assertEqual(self.refresh(missing).status, 'FAILED')
+        self.assertIn("no delivery backend for channel 'email'", missing.last_error)
+        self.assertEqual(self.refresh(expired).status, 'FAILED')
+        self.assertEqual(backends.outbox, [])
+
+    @override_settings(DELIVERY_BREAKER_THRESHOLD=2)
+    def test_open_circuit_postpones_without_using_a_retry(self):
+        rows = [self.delivery(f'Item {i}') for i in range(3)]
+        with self.assertLogs('delivery.dispatcher', 'WARNING'):
+            self.deliver({'push': locmem(DOWN=True, MAX_BATCH=1)})
+        self.assertEqual([self.refresh(d).retry_count for d in rows], [1, 1, 0])
+        postponed = rows[2]
+        self.assertEqual(postponed.status, 'PENDING')
+        self.assertGreater(postponed.next_attempt_at, timezone.now() + timedelta(seconds=25))
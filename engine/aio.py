@@ -0,0 +1,42 @@
+"""Blocking work on the async (ASGI) decision path.
+
+Django's async ORM methods are thread-sensitive sync_to_async wrappers, and
+under ASGI every request gets its own thread-sensitive context, i.e. a
+thread per in-flight request. ``run_db`` instead sends database (and other
+blocking) calls to one shared pool of ENGINE_ASYNC_DB_THREADS threads, each
+keeping its own connection, so thousands of concurrent evaluations wait on
+the event loop rather than on threads.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connection
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_db_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(getattr(settings, 'ENGINE_ASYNC_DB_THREADS', 8),
+                                               thread_name_prefix='engine-db')
+    return _executor
+
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    except DatabaseError:
+        # The pool thread outlives the request; drop a broken connection so
+        # the next call reconnects.
+        connection.close()
+        raise
+
+
+async def run_db(func, *args, **kwargs):
+    """Await ``func(*args, **kwargs)`` on the shared database pool."""
+    return await sync_to_async(_call, thread_sensitive=False, executor=get_db_executor())(func, args, kwargs)
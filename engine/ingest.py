@@ -0,0 +1,507 @@
+"""Durable on-disk ingestion queue for the accept-fast API mode.
+
+With ENGINE_QUEUE on, ``POST /api/events/`` only validates an event, appends
+it to one of ENGINE_QUEUE_PARTITIONS append-only logs (picked by a stable
+hash of ``user_id``) and answers 202. ``drain_queue`` workers read the
+partitions in batches, insert and decide the events, and only then commit
+their read offset.
+
+A batch's end offset is also stored in a QueueCheckpoint row in the same
+transaction as its events, so a batch that reached the database is never
+inserted again, even if its worker died before committing the offset here.
+Before a batch's counters are touched its end offset is noted in
+``attempted``. A batch that fails after that (database error, crash) is
+redelivered with the dedupe checks off: the first attempt already recorded
+its fingerprints, and would otherwise turn every event into an exact
+duplicate of itself. Exact duplicates within a redelivered batch are not
+caught, and its events may count twice against rate windows. Workers that
+own their partitions' counters (engine.shard) undo a failed batch's
+counter writes instead, so their retries keep the dedupe checks.
+
+Each partition is a directory of segment files named after the byte offset
+their first record starts at, so offsets are global byte positions. Records
+are JSON lines numbered by ``seq`` within their partition; ``consumer``
+holds the offset of the next unread record and ``id`` the partition's
+random id.
+Changing ENGINE_QUEUE_PARTITIONS while events are queued breaks per-user
+ordering, so drain the queue first.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.utils.dateparse import parse_datetime
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.log'
+DATETIME_FIELDS = ('timestamp', 'expires_at')
+
+
+def partition_for(user_id, partitions):
+    """Partition of ``user_id``; stable across processes and restarts."""
+    return zlib.crc32(str(user_id).encode('utf-8')) % partitions
+
+
+def _rfind_newline(fd, end):
+    """Position of the last newline before ``end`` in ``fd``, or -1."""
+    while end > 0:
+        start = max(0, end - (1 << 16))
+        newline = os.pread(fd, end - start, start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline
+        end = start
+    return -1
+
+
+def _last_line(fd, size):
+    """Last complete record line of a segment of ``size`` bytes, or b''."""
+    end = _rfind_newline(fd, size)
+    if end < 0:
+        return b''
+    start = _rfind_newline(fd, end) + 1
+    return os.pread(fd, end + 1 - start, start)
+
+
+def _partition_path(root, index):
+    return os.path.join(root, f'p{index:03d}')
+
+
+def _empty_stats(index):
+    return {'partition': index, 'depth': 0, 'bytes': 0, 'lag_seconds': 0.0}
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Partition:
+    """One partition's segment log and committed consumer offset.
+
+    Appends from any number of processes are serialized with an flock on
+    ``append.lock``, and within a process by a thread lock. A process that
+    consumes the partition holds ``consumer.lock`` (see ``claim``) for as
+    long as it drains it.
+    """
+
+    def __init__(self, root, index, segment_bytes, fsync):
+        self.index = index
+        self.path = _partition_path(root, index)
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        os.makedirs(self.path, exist_ok=True)
+        self.uid = self._identity()
+        self._append_lock = os.open(os.path.join(self.path, 'append.lock'), os.O_CREAT | os.O_RDWR, 0o644)
+        self._thread_lock = threading.Lock()
+        self._claim = None
+        self._fh = None
+        self._base = 0
+        # (segment base, size, seq) after this process's last append, so
+        # the last seq is only read back when another process appended.
+        self._tail = None
+
+    def _identity(self):
+        path = os.path.join(self.path, 'id')
+        if not os.path.exists(path):
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as fh:
+                fh.write(uuid.uuid4().hex)
+                fh.flush()
+                os.fsync(fh.fileno())
+            try:
+                # Atomic and exclusive: concurrent openers agree on one id.
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        with open(path) as fh:
+            return fh.read().strip()
+
+    def segments(self):
+        """(base offset, path) of every segment, oldest first."""
+        names = [name for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX)]
+        return sorted((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.path, name)) for name in names)
+
+    def _segment_path(self, base):
+        return os.path.join(self.path, f'{base:020d}{SEGMENT_SUFFIX}')
+
+    # Producer side ---------------------------------------------------
+
+    def append(self, lines):
+        """Append records, each a JSON object line; returns their offsets.
+
+        Every record gets the next ``seq`` of the partition, prepended as
+        its first key.
+        """
+        with self._thread_lock:
+            fcntl.flock(self._append_lock, fcntl.LOCK_EX)
+            try:
+                fh = self._writable()
+                size = os.fstat(fh.fileno()).st_size
+                if size and os.pread(fh.fileno(), 1, size - 1) != b'\n':
+                    # A writer died mid-record; drop the torn tail.
+                    size = _rfind_newline(fh.fileno(), size) + 1
+                    os.ftruncate(fh.fileno(), size)
+                seq = self._last_seq(fh, size)
+                offsets, numbered, position = [], [], self._base + size
+                for line in lines:
+                    seq += 1
+                    line = b'{"seq":%d,%s' % (seq, line[1:])
+                    offsets.append(position)
+                    numbered.append(line)
+                    position += len(line)
+                fh.write(b''.join(numbered))
+                fh.flush()
+                if self.fsync:
+                    os.fdatasync(fh.fileno())
+                self._tail = (self._base, position - self._base, seq)
+            finally:
+                fcntl.flock(self._append_lock, fcntl.LOCK_UN)
+            return offsets
+
+    def _last_seq(self, fh, size):
+        if self._tail is not None and self._tail[:2] == (self._base, size):
+            return self._tail[2]
+        line = _last_line(fh.fileno(), size)
+        record = json.loads(line) if line else self.last_record()
+        return record.get('seq', 0) if record else 0
+
+    def _writable(self):
+        # Segments roll only by size, so a cached handle is current as long
+        # as its file is below the limit.
+        fh = self._fh
+        if fh is not None and os.fstat(fh.fileno()).st_size < self.segment_bytes:
+            return fh
+        if fh is not None:
+            fh.close()
+        segments = self.segments()
+        base, path = segments[-1] if segments else (0, self._segment_path(0))
+        created = not segments
+        if segments and os.path.getsize(path) >= self.segment_bytes:
+            base += os.path.getsize(path)
+            path, created = self._segment_path(base), True
+        self._fh, self._base = open(path, 'a+b'), base
+        if created and self.fsync:
+            _fsync_dir(self.path)
+        return self._fh
+
+    # Consumer side ---------------------------------------------------
+
+    def claim(self):
+        """Try to become this partition's only consumer; True on success."""
+        if self._claim is None:
+            fd = os.open(os.path.join(self.path, 'consumer.lock'), os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            self._claim = fd
+        return True
+
+    def _read_offset(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as fh:
+                return int(fh.read().strip() or 0)
+        except FileNotFoundError:
+            return None
+
+    def _write_offset(self, name, offset):
+        path = os.path.join(self.path, name)
+        with open(path + '.tmp', 'w') as fh:
+            fh.write(str(offset))
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+        os.replace(path + '.tmp', path)
+
+    def committed(self):
+        offset = self._read_offset('consumer')
+        if offset is None:
+            segments = self.segments()
+            return segments[0][0] if segments else 0
+        return offset
+
+    def attempted(self):
+        """End offset of the last batch whose decision was started."""
+        return self._read_offset('attempted') or 0
+
+    def attempt(self, offset):
+        self._write_offset('attempted', offset)
+
+    def commit(self, offset, keep_from=None):
+        """Durably record ``offset`` as read and drop fully read segments,
+        keeping any at or after ``keep_from``.
+        """
+        self._write_offset('consumer', offset)
+        limit = offset if keep_from is None else min(offset, keep_from)
+        segments = self.segments()
+        for (_, old), (next_base, _) in zip(segments, segments[1:]):
+            if next_base <= limit:
+                os.remove(old)
+
+    def read(self, offset, limit, end=None):
+        """Up to ``limit`` complete records from ``offset`` on, stopping at
+        offset ``end`` if given.
+
+        Returns (records, next_offset).
+        """
+        records = []
+        segments = self.segments()
+        for i, (base, path) in enumerate(segments):
+            segment_end = segments[i + 1][0] if i + 1 < len(segments) else None
+            if segment_end is not None and segment_end <= offset:
+                continue
+            with open(path, 'rb') as fh:
+                fh.seek(max(0, offset - base))
+                while len(records) < limit and (end is None or offset < end):
+                    line = fh.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    records.append(json.loads(line))
+                    offset += len(line)
+            if len(records) >= limit or segment_end is None or offset < segment_end:
+                break
+        return records, offset
+
+    def last_record(self):
+        """The newest complete record, or None if the partition is empty."""
+        for _, path in reversed(self.segments()):
+            with open(path, 'rb') as fh:
+                line = _last_line(fh.fileno(), os.fstat(fh.fileno()).st_size)
+            if line:
+                return json.loads(line)
+        return None
+
+    def stats(self, now=None):
+        """Pending record count, byte backlog and age of the oldest pending record.
+
+        Reads only the first pending and the last record: the count is the
+        difference of their ``seq``.
+        """
+        offset = self.committed()
+        first, _ = self.read(offset, 1)
+        if not first:
+            return _empty_stats(self.index)
+        last = self.last_record()
+        base, path = self.segments()[-1]
+        backlog = max(0, base + os.path.getsize(path) - offset)
+        depth = last.get('seq', 0) - first[0].get('seq', 0) + 1
+        lag = max(0.0, (now or time.time()) - first[0]['accepted_at'])
+        return {'partition': self.index, 'depth': depth, 'bytes': backlog, 'lag_seconds': round(lag, 3)}
+
+
+class IngestQueue:
+    """The set of partitions under ``root``."""
+
+    def __init__(self, root=None, partitions=None, segment_bytes=None, fsync=None):
+        self.root = root or getattr(settings, 'ENGINE_QUEUE_DIR', 'queue')
+        self.partitions = partitions or getattr(settings, 'ENGINE_QUEUE_PARTITIONS', 16)
+        self.segment_bytes = segment_bytes or getattr(settings, 'ENGINE_QUEUE_SEGMENT_BYTES', 64 << 20)
+        self.fsync = getattr(settings, 'ENGINE_QUEUE_FSYNC', True) if fsync is None else fsync
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def partition(self, index):
+        part = self._partitions.get(index)
+        if part is None:
+            with self._lock:
+                part = self._partitions.get(index)
+                if part is None:
+                    part = self._partitions[index] = Partition(self.root, index, self.segment_bytes, self.fsync)
+        return part
+
+    def append(self, events):
+        """Durably queue validated event dicts; returns (partition, offset) per event."""
+        now = time.time()
+        groups = {}
+        for position, event in enumerate(events):
+            line = json.dumps({'accepted_at': now, 'event': event}, cls=DjangoJSONEncoder,
+                              separators=(',', ':')).encode('utf-8') + b'\n'
+            groups.setdefault(partition_for(event['user_id'], self.partitions), []).append((position, line))
+        receipts = [None] * len(events)
+        for index, items in groups.items():
+            offsets = self.partition(index).append([line for _, line in items])
+            for (position, _), offset in zip(items, offsets):
+                receipts[position] = (index, offset)
+        if metrics.enabled():
+            metrics.QUEUE_EVENTS.inc('accepted', amount=len(events))
+        return receipts
+
+    def stats(self):
+        """Totals and per-partition stats. Read-only: a partition nothing was
+        ever queued to is reported empty rather than created.
+        """
+        now = time.time()
+        parts = [self.partition(index).stats(now)
+                 if index in self._partitions or os.path.isdir(_partition_path(self.root, index))
+                 else _empty_stats(index)
+                 for index in range(self.partitions)]
+        return {
+            'depth': sum(p['depth'] for p in parts),
+            'lag_seconds': max((p['lag_seconds'] for p in parts), default=0.0),
+            'partitions': parts,
+        }
+
+
+def to_event_fields(record):
+    """NotificationEvent keyword arguments for a queued record."""
+    fields = dict(record['event'])
+    for name in DATETIME_FIELDS:
+        if fields.get(name):
+            fields[name] = parse_datetime(fields[name])
+    return fields
+
+
+def catch_up(part, keep_from=None):
+    """Committed offset of ``part``, first moved up to its database checkpoint.
+
+    The checkpoint is ahead when a worker stopped between committing a
+    batch's transaction and recording its offset in the partition; that
+    batch is already in the database and is skipped.
+    """
+    from .models import QueueCheckpoint
+    offset = part.committed()
+    saved = QueueCheckpoint.objects.filter(partition=part.uid).values_list('offset', flat=True).first()
+    if saved is not None and saved > offset:
+        logger.warning('Partition %d: events up to offset %d are already in the database, skipping them',
+                       part.index, saved)
+        part.commit(saved, keep_from=offset if keep_from is None else min(keep_from, offset))
+        offset = saved
+    return offset
+
+
+def drain_partition(part, batch_size=None, state=None):
+    """Insert and decide the next batch of ``part``; returns events handled.
+
+    The offset is committed only after the events, their decisions and the
+    partition's QueueCheckpoint are in the database. A redelivered batch is
+    decided without the dedupe checks (see the module docstring). With a
+    ShardState (engine.shard) the counters are the worker's own instead of
+    the shared cache.
+    """
+    from api.models import NotificationEvent
+    from .models import QueueCheckpoint
+    from .services import record_decisions
+    batch_size = batch_size or getattr(settings, 'ENGINE_QUEUE_BATCH_SIZE', 500)
+    offset = catch_up(part, state.saved_offset if state is not None else None)
+    if state is not None and state.offset != offset:
+        state.advanced(offset)
+    attempted = part.attempted() if state is None else 0
+    redelivered = offset < attempted
+    records, next_offset = part.read(offset, batch_size, end=attempted if redelivered else None)
+    if not records:
+        return 0
+    if redelivered:
+        logger.warning('Partition %d: redelivering %d events without dedupe', part.index, len(records))
+    elif state is None:
+        part.attempt(next_offset)
+    else:
+        state.begin_batch()
+    try:
+        with transaction.atomic():
+            events = NotificationEvent.objects.bulk_create(
+                [NotificationEvent(**to_event_fields(record)) for record in records],
+                batch_size=getattr(settings, 'ENGINE_BULK_BATCH_SIZE', 1000),
+            )
+            if state is not None:
+                state.tick()
+            record_decisions(events, dedupe=not redelivered, deliver=True,
+                             counters=state.counters if state is not None else None)
+            QueueCheckpoint.objects.bulk_create([QueueCheckpoint(partition=part.uid, offset=next_offset)],
+                                                update_conflicts=True, unique_fields=['partition'],
+                                                update_fields=['offset'])
+    except BaseException:
+        if state is not None:
+            state.discard_batch()
+        raise
+    if state is not None:
+        state.keep_batch()
+        part.commit(next_offset, keep_from=state.saved_offset)
+        state.advanced(next_offset)
+    else:
+        part.commit(next_offset)
+    if metrics.enabled():
+        now = time.time()
+        metrics.QUEUE_EVENTS.inc('decided', amount=len(records))
+        for record in records:
+            metrics.QUEUE_LAG_SECONDS.observe(now - record['accepted_at'])
+    return len(records)
+
+
+def run_worker(queue, indexes, batch_size=None, poll_interval=0.5, once=False, stop=None, local_state=None):
+    """Drain the partitions in ``indexes`` that this process can claim.
+
+    Loops until ``stop`` (a threading/multiprocessing Event) is set, or with
+    ``once`` until the claimed partitions are empty. Database or cache
+    failures leave the batch uncommitted; it is retried after a backoff.
+    ``local_state`` (default ENGINE_QUEUE_LOCAL_STATE) keeps each claimed
+    partition's counters in this process; see engine.shard.
+    Returns the number of events handled.
+    """
+    parts = [part for part in map(queue.partition, indexes) if part.claim()]
+    if len(parts) < len(indexes):
+        logger.warning('%d of %d partitions are drained by another process', len(indexes) - len(parts),
+                       len(indexes))
+    if local_state is None:
+        local_state = getattr(settings, 'ENGINE_QUEUE_LOCAL_STATE', False)
+    for part in parts:
+        # Before restoring local state, which replays up to the committed
+        # offset; keep every segment that replay may need.
+        catch_up(part, keep_from=0 if local_state else None)
+    states = {}
+    if local_state:
+        from .shard import ShardState
+        for part in parts:
+            states[part.index] = ShardState(part)
+            states[part.index].restore()
+    wait = stop.wait if stop is not None else time.sleep
+    handled, backoff = 0, poll_interval
+    while parts and not (stop is not None and stop.is_set()):
+        try:
+            drained = sum(drain_partition(part, batch_size, states.get(part.index)) for part in parts)
+        except Exception:
+            logger.exception('Draining partitions %s failed, retrying in %.1fs',
+                             [part.index for part in parts], backoff)
+            connections.close_all()
+            wait(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = poll_interval
+        handled += drained
+        if not drained:
+            if once:
+                break
+            wait(poll_interval)
+    for state in states.values():
+        state.save()
+    return handled
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_ingest_queue():
+    """Process-wide queue, or None when ENGINE_QUEUE is off."""
+    global _queue
+    if not getattr(settings, 'ENGINE_QUEUE', False):
+        return None
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = IngestQueue()
+    return _queue
@@ -0,0 +1,58 @@
+"""Leased batch claims for the worker-drained tables.
+
+The deferred scheduler (DeferredNotification) and the delivery dispatcher
+(Delivery) both hand out due PENDING rows to worker processes. A row is
+leased through its ``claimed_by`` and ``lease_expires_at`` columns; a lease
+that runs out (worker crashed) makes the row claimable again, and a worker
+only writes rows whose lease it still holds.
+"""
+import os
+import socket
+import uuid
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+
+def make_worker_id():
+    return f'{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def claim_due(model, due_field, worker_id, batch_size, lease_seconds, now=None, related=()):
+    """Lease up to ``batch_size`` PENDING rows of ``model`` whose
+    ``due_field`` has passed to ``worker_id`` and return them, oldest due
+    first, with ``related`` selected.
+
+    On Postgres the candidate rows are locked with SKIP LOCKED so concurrent
+    workers pick disjoint batches. Elsewhere (SQLite) the claim is a single
+    conditional UPDATE on the lease columns, which the database serialises.
+    """
+    now = now or timezone.now()
+    lease_until = now + timedelta(seconds=lease_seconds)
+    unleased = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=now)
+    due = (model.objects
+           .filter(unleased, status='PENDING', **{f'{due_field}__lte': now})
+           .order_by(due_field))
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(due.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+            claimed = model.objects.filter(id__in=ids).update(claimed_by=worker_id, lease_expires_at=lease_until)
+    else:
+        claimed = model.objects.filter(unleased, id__in=due.values('id')[:batch_size]).update(
+            claimed_by=worker_id, lease_expires_at=lease_until)
+    if not claimed:
+        return []
+    return list(model.objects
+                .filter(claimed_by=worker_id, lease_expires_at=lease_until, status='PENDING')
+                .select_related(*related))
+
+
+def leased(model, worker_id):
+    """``model``'s rows on which ``worker_id`` still holds an unexpired lease."""
+    return model.objects.filter(claimed_by=worker_id, lease_expires_at__gt=timezone.now())
+
+
+def release(row):
+    row.claimed_by = None
+    row.lease_expires_at = None
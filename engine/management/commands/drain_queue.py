@@ -0,0 +1,81 @@
+import argparse
+import json
+import multiprocessing
+import signal
+import time
+from django.core.management.base import BaseCommand
+from django.db import connections
+from engine.ingest import IngestQueue, run_worker
+
+
+class _StopFlag:
+    """Stop signal for the single-process mode; set from a signal handler,
+    so unlike an Event it takes no lock.
+    """
+    is_stopped = False
+
+    def set(self):
+        self.is_stopped = True
+
+    def is_set(self):
+        return self.is_stopped
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return self.is_stopped
+
+
+def _worker(indexes, options, stop, results):
+    # The parent turns SIGINT/SIGTERM into ``stop``; finish the batch in hand.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        results.put(run_worker(IngestQueue(), indexes, options['batch_size'], options['poll_interval'],
+                               options['once'], stop, options['local_state']))
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Decide events queued by the accept-fast API, one process per group of user partitions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes; partition p goes to worker p %% workers.')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--poll-interval', type=float, default=0.5,
+                            help='Seconds to wait when every partition is empty.')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty.')
+        parser.add_argument('--local-state', action=argparse.BooleanOptionalAction, default=None,
+                            help='Keep counters in the workers instead of the shared cache '
+                                 '(default ENGINE_QUEUE_LOCAL_STATE).')
+        parser.add_argument('--stats', action='store_true', help='Print queue depth and lag, then exit.')
+
+    def handle(self, **options):
+        queue = IngestQueue()
+        if options['stats']:
+            self.stdout.write(json.dumps(queue.stats(), indent=2))
+            return
+        workers = max(1, min(options['workers'], queue.partitions))
+        groups = [list(range(i, queue.partitions, workers)) for i in range(workers)]
+        stop = _StopFlag() if workers == 1 else multiprocessing.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+
+        if workers == 1:
+            handled = run_worker(queue, groups[0], options['batch_size'], options['poll_interval'],
+                                 options['once'], stop, options['local_state'])
+        else:
+            # Children must not share the parent's database connections.
+            connections.close_all()
+            results = multiprocessing.SimpleQueue()
+            procs = [multiprocessing.Process(target=_worker, args=(group, options, stop, results))
+                     for group in groups]
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+            handled = 0
+            while not results.empty():
+                handled += results.get()
+        self.stdout.write(self.style.SUCCESS(f'Decided {handled} queued events'))
@@ -0,0 +1,140 @@
+import gzip
+import json
+import time
+from datetime import timezone as dt_timezone
+from itertools import islice
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from api.models import NotificationEvent
+from engine.clock import get_clock
+from engine.services import evaluate_events, record_decisions
+from engine.simulate import EventTimeCache, EventTimeClock
+from engine.utils import LocalCounterBackend
+
+REQUIRED = ('user_id', 'event_type', 'title', 'timestamp', 'channel')
+OPTIONAL = ('source', 'priority_hint', 'dedupe_key')
+MAX_LENGTHS = {f.name: f.max_length for f in NotificationEvent._meta.fields if getattr(f, 'max_length', None)}
+
+
+def open_events(path):
+    """Open a JSONL file, transparently decompressing gzip."""
+    with open(path, 'rb') as fh:
+        gzipped = fh.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rt', encoding='utf-8') if gzipped else open(path, encoding='utf-8')
+
+
+def _datetime(value, field):
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is None:
+        raise ValueError(f'{field}: invalid datetime {value!r}')
+    return parsed if timezone.is_aware(parsed) else parsed.replace(tzinfo=dt_timezone.utc)
+
+
+def to_event(record):
+    """Validate one decoded record and build an unsaved NotificationEvent.
+
+    A plain-Python check of the same constraints the serializer enforces,
+    without DRF's per-field overhead.
+    """
+    if not isinstance(record, dict):
+        raise ValueError('record is not an object')
+    for field in REQUIRED:
+        if record.get(field) in (None, ''):
+            raise ValueError(f'{field}: this field is required')
+    for field in REQUIRED + OPTIONAL:
+        value = record.get(field)
+        if value is not None and field != 'timestamp':
+            if not isinstance(value, str):
+                raise ValueError(f'{field}: expected a string')
+            if field in MAX_LENGTHS and len(value) > MAX_LENGTHS[field]:
+                raise ValueError(f'{field}: longer than {MAX_LENGTHS[field]} characters')
+    metadata = record.get('metadata') or {}
+    if not isinstance(metadata, dict):
+        raise ValueError('metadata: expected an object')
+    return NotificationEvent(
+        user_id=record['user_id'],
+        event_type=record['event_type'],
+        title=record['title'],
+        source=record.get('source'),
+        priority_hint=record.get('priority_hint'),
+        timestamp=_datetime(record['timestamp'], 'timestamp'),
+        channel=record['channel'],
+        metadata=metadata,
+        dedupe_key=record.get('dedupe_key'),
+        expires_at=_datetime(record['expires_at'], 'expires_at') if record.get('expires_at') else None,
+    )
+
+
+class Command(BaseCommand):
+    help = 'Stream a (optionally gzipped) JSONL file of events through the decision engine.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Decide without persisting anything; uses private in-memory counters.')
+        parser.add_argument('--no-defer', action='store_true',
+                            help='Do not queue LATER decisions in the deferred queue.')
+        parser.add_argument('--event-time', action='store_true',
+                            help='Decide each event as of its own timestamp instead of the wall clock, '
+                                 'counting on private event-time counters.')
+        parser.add_argument('--report-every', type=int, default=50000)
+
+    def handle(self, path, **options):
+        self.errors = 0
+        counters, clock = None, get_clock()
+        if options['event_time']:
+            # The shared counters expire on the wall clock, so event-time
+            # windows need private counters, whether or not this is a dry run.
+            state = EventTimeCache()
+            counters, clock = LocalCounterBackend(state), EventTimeClock(state)
+        elif options['dry_run']:
+            counters = LocalCounterBackend(LocMemCache('replay-dry-run', {'OPTIONS': {'MAX_ENTRIES': 1000000}}))
+        totals = {'NOW': 0, 'LATER': 0, 'NEVER': 0}
+        started = time.monotonic()
+        processed = next_report = 0
+        try:
+            with open_events(path) as lines:
+                events = self._events(lines)
+                while True:
+                    chunk = list(islice(events, options['chunk_size']))
+                    if not chunk:
+                        break
+                    if options['dry_run']:
+                        decisions = evaluate_events(chunk, counters=counters, clock=clock)
+                    else:
+                        with transaction.atomic():
+                            NotificationEvent.objects.bulk_create(chunk)
+                            decisions = record_decisions(chunk, schedule_later=not options['no_defer'],
+                                                         clock=clock, counters=counters)
+                    for decision in decisions:
+                        totals[decision.classification] += 1
+                    processed += len(chunk)
+                    if processed >= next_report:
+                        self._report(processed, started, totals)
+                        next_report = processed + options['report_every']
+        except OSError as exc:
+            raise CommandError(exc)
+        self._report(processed, started, totals)
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Dry run: decided" if options["dry_run"] else "Replayed"} {processed} events '
+            f'({self.errors} invalid records skipped).'))
+
+    def _events(self, lines):
+        for lineno, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield to_event(json.loads(line))
+            except ValueError as exc:
+                self.errors += 1
+                if self.errors <= 10:
+                    self.stderr.write(f'line {lineno}: {exc}')
+
+    def _report(self, processed, started, totals):
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.stdout.write(f'{processed} events in {elapsed:.1f}s ({processed / elapsed:.0f}/s) {totals}')
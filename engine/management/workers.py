@@ -0,0 +1,55 @@
+import multiprocessing
+import time
+from contextlib import nullcontext
+from django.core.management.base import BaseCommand
+from django.db import connections
+from engine.leasing import make_worker_id
+
+
+class WorkerCommand(BaseCommand):
+    """Base for commands that drain a leased table from one or more processes.
+
+    Subclasses implement ``drain(resource, worker_id, options)``, one pass
+    returning the number of rows handled, and may override ``worker()``, a
+    context manager for per-process resources that is entered in every
+    worker process. ``report`` is formatted with ``worker_id`` and ``count``.
+    """
+    default_interval = 1.0
+    report = '{worker_id}: handled {count} rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--lease-seconds', type=int, default=None)
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when drained.')
+        parser.add_argument('--interval', type=float, default=self.default_interval,
+                            help='Seconds between polls with --loop.')
+        parser.add_argument('--workers', type=int, default=1, help='Number of worker processes to run.')
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 1:
+            self._work(options)
+            return
+        # Children must not share the parent's database connections.
+        connections.close_all()
+        procs = [multiprocessing.Process(target=self._work, args=(options,)) for _ in range(options['workers'])]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+
+    def worker(self):
+        return nullcontext()
+
+    def drain(self, resource, worker_id, options):
+        raise NotImplementedError
+
+    def _work(self, options):
+        worker_id = make_worker_id()
+        with self.worker() as resource:
+            while True:
+                count = self.drain(resource, worker_id, options)
+                if count:
+                    self.stdout.write(self.report.format(worker_id=worker_id, count=count))
+                if not options['loop']:
+                    return
+                time.sleep(options['interval'])
@@ -0,0 +1,136 @@
+"""Process-local metrics in the Prometheus text exposition format.
+
+A deliberately small registry (counters and fixed-bucket histograms) so the
+hot path pays a dict lookup and a lock per observation and nothing else.
+Every process keeps its own values; scrape each worker separately.
+"""
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from django.conf import settings
+
+_registry = []
+
+# Seconds; spans cache round trips (sub-ms) up to slow batch writes.
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def enabled():
+    return getattr(settings, 'ENGINE_METRICS', True)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [(n, v) for n, v in zip(names, values)] + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield (f'{self.name}_bucket'
+                       f'{_format_labels(self.labelnames, labels, [("le", bound)])} {cumulative}')
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}'
+
+
+class StageTimer:
+    """Laps through the pipeline stages of one decision.
+
+    ``lap(stage)`` charges the time since the previous lap to ``stage``.
+    """
+    __slots__ = ('last',)
+
+    def __init__(self):
+        self.last = perf_counter()
+
+    def lap(self, stage):
+        now = perf_counter()
+        STAGE_SECONDS.observe(now - self.last, stage)
+        self.last = now
+
+
+def render():
+    """All registered metrics in Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('engine_stage_seconds', 'Time spent in each decision pipeline stage.', ['stage'])
+DECISIONS = Counter('engine_decisions_total', 'Decisions made, by classification and reason.',
+                    ['classification', 'reason'])
+CACHE_ROUND_TRIPS = Counter('engine_cache_round_trips_total', 'Counter-backend calls (one cache round trip each).')
+DB_QUERIES = Counter('engine_db_queries_total', 'SQL statements issued while recording decisions.')
+SCHEDULER_BATCH_SECONDS = Histogram('engine_scheduler_batch_seconds', 'Time to process one claimed deferred batch.')
+SCHEDULER_ROWS = Counter('engine_scheduler_rows_total', 'Deferred rows processed, by resulting status.', ['status'])
+QUEUE_EVENTS = Counter('engine_queue_events_total', 'Ingestion queue events, by state (accepted or decided).',
+                       ['state'])
+QUEUE_LAG_SECONDS = Histogram('engine_queue_lag_seconds', 'Time from queue accept to decision.',
+                              buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0))
+DELIVERY_MESSAGES = Counter('engine_delivery_messages_total',
+                            'Delivery attempts, by channel and outcome (sent, retry, failed or postponed).',
+                            ['channel', 'outcome'])
+AUDIT_WRITE_FAILURES = Counter('engine_audit_write_failures_total',
+                               'Failed async audit batch writes, by outcome (retry, spilled or dropped).',
+                               ['outcome'])
+DELIVERY_CALL_SECONDS = Histogram('engine_delivery_call_seconds', 'Time per provider call (one bulk send).',
+                                  ['channel'])
+
+
+class QueryCounter:
+    """connection.execute_wrapper that feeds DB_QUERIES."""
+
+    def __call__(self, execute, sql, params, many, context):
+        DB_QUERIES.inc()
+        return execute(sql, params, many, context)
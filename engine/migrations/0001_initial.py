@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueCheckpoint',
+            fields=[
+                ('partition', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('offset', models.BigIntegerField()),
+            ],
+        ),
+    ]
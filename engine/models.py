@@ -0,0 +1,15 @@
+from django.db import models
+
+
+class QueueCheckpoint(models.Model):
+    """Offset up to which an ingest queue partition's events are in the
+    database, written in the same transaction as them (see engine.ingest).
+
+    Keyed by the partition directory's random id, so a recreated queue
+    never picks up an old checkpoint.
+    """
+    partition = models.CharField(max_length=32, primary_key=True)
+    offset = models.BigIntegerField()
+
+    def __str__(self):
+        return f'{self.partition} @ {self.offset}'
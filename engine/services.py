@@ -1,64 +1,301 @@
+import asyncio
 import hashlib
 import json
-from datetime import datetime, timedelta
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
 from django.core.cache import cache
 from django.conf import settings
-from .utils import fingerprint_event, is_exact_duplicate, is_near_duplicate, exceeds_rate_limits, evaluate_rules
+from django.db import connection, transaction
+from . import metrics
+from .aio import run_db
+from .clock import get_clock, user_timezone
+from .utils import (get_counter_backend, get_async_counter_backend, dedupe_steps, near_duplicate_step,
+                    rate_limit_steps, match_rules, cap_exceeded, DEDUPE, NEAR, LIMIT, WINDOW)
 from api.models import NotificationEvent
 from audit.models import DecisionRecord
+from audit.sink import get_audit_sink
+from delivery.models import Delivery
+from rules.snapshot import aget_rule_snapshot, get_rule_snapshot
+from scheduler.models import DeferredNotification
+
+
+class Decision:
+    """Outcome of running one event through the pipeline (not yet persisted).
+
+    ``reason`` is a short machine-readable code for what decided the event;
+    ``rules_triggered`` and ``fatigue_snapshot`` carry the evaluation trace
+    when ENGINE_DECISION_TRACE is on and are None otherwise. ``release_at``
+    is when a LATER decision should be retried.
+    """
+    __slots__ = ('classification', 'explanation', 'duplicate', 'reason', 'rules_triggered', 'fatigue_snapshot',
+                 'release_at')
+
+    def __init__(self, classification, explanation, duplicate=None, reason=None, release_at=None):
+        self.classification = classification
+        self.explanation = explanation
+        self.duplicate = duplicate
+        self.reason = reason
+        self.rules_triggered = None
+        self.fatigue_snapshot = None
+        self.release_at = release_at
+
+    def to_record(self, event, timestamp):
+        return DecisionRecord(
+            event=event,
+            classification=self.classification,
+            explanation=self.explanation,
+            duplicate_result=self.duplicate,
+            reason=self.reason or '',
+            rules_triggered=self.rules_triggered or {},
+            fatigue_snapshot=self.fatigue_snapshot or {},
+            timestamp=timestamp,
+        )
 
 
 def decide_notification(event: NotificationEvent):
     """Core decision function returning (classification, explanation)."""
-    # 1️⃣ Fingerprint / dedupe
-    fp = fingerprint_event(event)
-    if is_exact_duplicate(fp):
-        explanation = "Exact duplicate within configured window."
-        classification = "NEVER"
-        _log_decision(event, classification, explanation, duplicate='exact')
-        return classification, explanation
-
-    if is_near_duplicate(event):
-        explanation = "Near‑duplicate detected (similar title/content)."
-        classification = "NEVER"
-        _log_decision(event, classification, explanation, duplicate='near')
-        return classification, explanation
-
-    # 2️⃣ Fatigue / rate‑limit counters (cached per user)
-    if exceeds_rate_limits(event.user_id, event):
-        explanation = "Rate‑limit exceeded (max notifications per interval)."
-        classification = "NEVER"
-        _log_decision(event, classification, explanation, duplicate=None)
-        return classification, explanation
+    decision = record_decisions([event], deliver=True)[0]
+    return decision.classification, decision.explanation
+
+
+def decide_notifications(events):
+    """Batch variant of decide_notification.
+
+    Decides every event in a single pass and writes all DecisionRecords with
+    one bulk_create. Returns a list of (classification, explanation) in the
+    same order as ``events``.
+    """
+    return [(d.classification, d.explanation) for d in record_decisions(events, deliver=True)]
+
+
+def record_decisions(events, schedule_later=True, dedupe=True, clock=None, counters=None, deliver=False):
+    """Decide ``events`` and persist the results; returns the Decisions.
+
+    With ``schedule_later`` every LATER decision also gets a PENDING
+    DeferredNotification due at ``release_at``, created in the same
+    transaction as the audit records. The scheduler passes False for both
+    flags: it reschedules the existing row instead, and an event released
+    from the queue must not be dropped as a duplicate of its own first pass.
+    ``clock`` defaults to the one selected by ENGINE_CLOCK and ``counters``
+    to the shared counter backend. Only live paths pass ``deliver``: replays
+    of historical events must not send anything.
+    """
+    snapshot = get_rule_snapshot()
+    clock = clock or get_clock()
+    decisions = [_evaluate(event, snapshot, dedupe, counters, now=clock.now(event)) for event in events]
+    _persist(events, decisions, schedule_later, deliver)
+    return decisions
+
+
+async def adecide_notification(event: NotificationEvent):
+    """decide_notification for async (ASGI) views.
+
+    The counter call is awaited on the async cache client and the audit
+    write runs on the shared database pool (see engine.aio), so no thread is
+    held per in-flight evaluation.
+    """
+    decision = (await arecord_decisions([event], deliver=True))[0]
+    return decision.classification, decision.explanation
+
+
+async def arecord_decisions(events, schedule_later=True, dedupe=True, clock=None, deliver=False):
+    """record_decisions for coroutines.
+
+    The events' counter calls are issued concurrently; each one is still a
+    single atomic script call, so dedupe and rate-limit checks stay
+    consistent with each other.
+    """
+    snapshot = await aget_rule_snapshot()
+    clock = clock or get_clock()
+    decisions = await asyncio.gather(*(_aevaluate(event, snapshot, dedupe, now=clock.now(event))
+                                       for event in events))
+    await run_db(_persist, events, decisions, schedule_later, deliver)
+    return decisions
+
+
+def _persist(events, decisions, schedule_later, deliver=False):
+    """Write the DecisionRecords (and DeferredNotifications) for ``decisions``.
+
+    With ``deliver`` and ENGINE_DELIVERY on, NOW decisions also get their
+    Delivery outbox rows in the same transaction.
+    """
+    now = datetime.now(timezone.utc)
+    timer = metrics.StageTimer() if metrics.enabled() else None
+    with connection.execute_wrapper(metrics.QueryCounter()) if timer else nullcontext():
+        with transaction.atomic():
+            _save_records([d.to_record(event, now) for event, d in zip(events, decisions)])
+            if schedule_later:
+                deferred = [DeferredNotification(event=event, scheduled_for=d.release_at)
+                            for event, d in zip(events, decisions) if d.classification == 'LATER']
+                if deferred:
+                    DeferredNotification.objects.bulk_create(deferred)
+            if deliver and getattr(settings, 'ENGINE_DELIVERY', False):
+                deliveries = [Delivery(event=event, channel=event.channel)
+                              for event, d in zip(events, decisions) if d.classification == 'NOW']
+                if deliveries:
+                    Delivery.objects.bulk_create(deliveries)
+    if timer:
+        timer.lap('audit')
+
+
+def evaluate_events(events, counters=None, snapshot=None, clock=None):
+    """Decide ``events`` without writing anything to the database.
+
+    ``counters`` replaces the shared counter backend, e.g. a
+    LocalCounterBackend over a private LocMemCache so dry runs leave the live
+    dedupe and fatigue state untouched. Pass an EventClock as ``clock`` to
+    decide each event as of its own timestamp.
+    """
+    snapshot = snapshot or get_rule_snapshot()
+    clock = clock or get_clock()
+    return [_evaluate(event, snapshot, counters=counters, now=clock.now(event)) for event in events]
+
+
+def _evaluate(event, snapshot=None, dedupe=True, counters=None, now=None):
+    """Run the decision pipeline for one event without persisting anything.
+
+    Every rule that needs no cache access is resolved first, so the dedupe,
+    rate-limit and marketing-cap counters all go out in a single atomic
+    counter call. The trace is assembled from values already at hand, so it
+    costs no extra round trips.
+    """
+    timer = metrics.StageTimer() if metrics.enabled() else None
+    now = now or get_clock().now(event)
+    if snapshot is None:
+        snapshot = get_rule_snapshot()
+    plan = _plan(event, snapshot, dedupe, now, timer)
+    result = (counters or get_counter_backend()).run(plan[0])
+    return _finish(event, snapshot, now, plan, result, timer)
+
+
+async def _aevaluate(event, snapshot, dedupe=True, counters=None, now=None):
+    """_evaluate for coroutines: the counter call is awaited, not blocked on."""
+    timer = metrics.StageTimer() if metrics.enabled() else None
+    now = now or get_clock().now(event)
+    plan = _plan(event, snapshot, dedupe, now, timer)
+    result = await (counters or get_async_counter_backend()).run(plan[0])
+    return _finish(event, snapshot, now, plan, result, timer)
+
+
+def _plan(event, snapshot, dedupe, now, timer):
+    """Resolve the cache-free rules and build the counter steps for ``event``."""
+    evaluated = [] if getattr(settings, 'ENGINE_DECISION_TRACE', True) else None
+    critical = bool(event.priority_hint) and event.priority_hint.lower() == 'critical'
+    rule_action, rule_desc, cap_step = (None, None, None) if critical else match_rules(event, snapshot, now, evaluated)
+    if timer:
+        timer.lap('rules')
+
+    # 1️⃣ Fingerprint / dedupe + 2️⃣ fatigue counters, one round trip
+    steps = []
+    if dedupe:
+        steps.extend(dedupe_steps(event, snapshot))
+        if timer:
+            timer.lap('fingerprint')
+        near = snapshot.near_duplicate_for(event.event_type)
+        if near is not None:
+            steps.append(near_duplicate_step(event, now, near.threshold, near.recent_seconds))
+            if timer:
+                timer.lap('near_duplicate')
+    steps.extend(rate_limit_steps(event, now, snapshot))
+    if cap_step is not None:
+        steps.append(cap_step)
+    if timer:
+        timer.lap('rate_limit')
+    return steps, critical, rule_action, rule_desc, cap_step, evaluated
+
+
+def _finish(event, snapshot, now, plan, result, timer):
+    """Turn the counter ``result`` for ``plan`` into a Decision."""
+    steps, critical, rule_action, rule_desc, cap_step, evaluated = plan
+    failed_kind = steps[result.failed].kind if result.failed is not None else None
+    if timer:
+        timer.lap('counters')
+
+    decision = _classify(failed_kind, critical, rule_action, rule_desc, cap_step)
+    if decision.reason == 'rate_limit' and getattr(settings, 'ENGINE_DIGEST', False):
+        # Held for the scheduler's digest instead of dropped (see scheduler.digest).
+        decision = _hold_for_digest(event, now)
+    elif decision.classification == 'LATER':
+        quiet = snapshot.quiet_hours
+        decision = _schedule(event, decision, quiet.release_after(now, user_timezone(event, quiet.timezone)))
+    if evaluated is not None:
+        decision.rules_triggered = {
+            'evaluated': evaluated,
+            'matched': decision.reason if decision.reason in evaluated else None,
+            'reason': decision.reason,
+        }
+        decision.fatigue_snapshot = {
+            'dedupe': decision.duplicate,
+            'counters': {step.key: value for step, value in zip(steps, result.values)
+                         if step.kind in (WINDOW, LIMIT)},
+            'failed': steps[result.failed].key if result.failed is not None else None,
+        }
+    if timer:
+        timer.lap('classify')
+        metrics.DECISIONS.inc(decision.classification, decision.reason)
+    return decision
+
+
+def _classify(failed_kind, critical, rule_action, rule_desc, cap_step):
+    if failed_kind == DEDUPE:
+        return Decision("NEVER", "Exact duplicate within configured window.", duplicate='exact',
+                        reason='exact_duplicate')
+
+    if failed_kind == NEAR:
+        return Decision("NEVER", "Near‑duplicate detected (similar title/content).", duplicate='near',
+                        reason='near_duplicate')
+
+    if failed_kind == WINDOW:
+        return Decision("NEVER", "Rate‑limit exceeded (max notifications per interval).", reason='rate_limit')
 
     # 3️⃣ Priority hint / business rules
-    if event.priority_hint and event.priority_hint.lower() == 'critical':
-        explanation = "Critical hint – forced immediate delivery."
-        classification = "NOW"
-        _log_decision(event, classification, explanation)
-        return classification, explanation
+    if critical:
+        return Decision("NOW", "Critical hint – forced immediate delivery.", reason='critical')
 
     # 4️⃣ Evaluate dynamic rules (stored in RuleConfig model)
-    rule_action, rule_desc = evaluate_rules(event)
+    if failed_kind == LIMIT:
+        rule_action, rule_desc = cap_exceeded(cap_step)
     if rule_action:
-        explanation = f"Rule triggered: {rule_desc}"
-        classification = rule_action
-        _log_decision(event, classification, explanation)
-        return classification, explanation
+        return Decision(rule_action, f"Rule triggered: {rule_desc}", reason=_matched_rule(rule_action, failed_kind))
 
     # 5️⃣ Default fallback – send now
-    explanation = "No rule matched – default to immediate delivery."
-    classification = "NOW"
-    _log_decision(event, classification, explanation)
-    return classification, explanation
-
-
-def _log_decision(event, classification, explanation, duplicate=None):
-    """Persist a DecisionRecord for audit and explainability."""
-    DecisionRecord.objects.create(
-        event=event,
-        classification=classification,
-        explanation=explanation,
-        duplicate_result=duplicate,
-        timestamp=datetime.utcnow()
-    )
+    return Decision("NOW", "No rule matched – default to immediate delivery.", reason='default')
+
+
+def _schedule(event, decision, release_at):
+    """Attach the release time to a LATER decision, or drop the event if it
+    expires before it could be delivered.
+    """
+    release_at = release_at.replace(tzinfo=timezone.utc)
+    if event.expires_at and event.expires_at <= release_at:
+        return Decision("NEVER", f"Event expires before quiet hours end ({release_at:%Y-%m-%d %H:%M} UTC).",
+                        reason='expired')
+    decision.release_at = release_at
+    return decision
+
+
+def _hold_for_digest(event, now):
+    # At least a second, or a digest held again would be re-claimed at once.
+    hold = max(getattr(settings, 'ENGINE_DIGEST_HOLD_SECONDS', 600), 1)
+    release_at = (now + timedelta(seconds=hold)
+                  ).replace(tzinfo=timezone.utc)
+    if event.expires_at and event.expires_at <= release_at:
+        return Decision("NEVER", "Rate‑limit exceeded (max notifications per interval).", reason='rate_limit')
+    return Decision("LATER", "Rate‑limit exceeded – held for the next digest.", reason='rate_limit',
+                    release_at=release_at)
+
+
+def _matched_rule(rule_action, failed_kind):
+    if failed_kind == LIMIT:
+        return 'max_daily_marketing'
+    return 'quiet_hours' if rule_action == 'LATER' else 'system_alert_routing'
+
+
+def _save_records(records):
+    """Write DecisionRecords inline, or hand them to the async audit sink."""
+    sink = get_audit_sink()
+    if sink is not None:
+        sink.submit_many(records)
+    else:
+        DecisionRecord.objects.bulk_create(records, batch_size=getattr(settings, 'ENGINE_BULK_BATCH_SIZE', 1000))
+
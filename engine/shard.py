@@ -0,0 +1,153 @@
+"""Worker-owned counter state for user-sharded queue draining.
+
+Every queue partition is drained by exactly one process (see
+engine.ingest), and a user's events always land in the same partition, so
+that process can keep the partition's dedupe, near-duplicate and fatigue
+counters in its own memory instead of the shared cache. Decisions still go
+through the unchanged pipeline; only the counter backend differs, a
+LocalCounterBackend over a private in-process store.
+
+The state is pickled to ``<partition>/state.pickle`` together with the
+queue offset it reflects. After a crash the snapshot is loaded and the
+records committed since are replayed through the counters only, so the
+restored state matches what was decided. Queue segments are kept until a
+snapshot covers them. Within a process, the counter writes of a batch whose
+transaction fails are undone, so the retry sees the counters as they were.
+
+Only queued events see this state: the synchronous evaluate endpoints and
+the deferred scheduler keep using the shared cache.
+"""
+import logging
+import os
+import pickle
+import time
+from datetime import datetime
+from django.conf import settings
+from api.models import NotificationEvent
+from .clock import EventClock, FixedClock, get_clock
+from .ingest import to_event_fields
+from .services import evaluate_events
+from .simulate import EventTimeCache
+from .utils import LocalCounterBackend
+
+logger = logging.getLogger(__name__)
+
+
+class JournaledCache(EventTimeCache):
+    """EventTimeCache whose writes since ``begin()`` can be undone."""
+    __slots__ = ('_journal',)
+
+    def __init__(self):
+        super().__init__()
+        self._journal = None
+
+    def begin(self):
+        self._journal = {}
+
+    def keep(self):
+        self._journal = None
+
+    def rollback(self):
+        for key, entry in self._journal.items():
+            if entry is None:
+                self._data.pop(key, None)
+            else:
+                self._data[key] = entry
+        self._journal = None
+
+    def _note(self, key):
+        # The entry as it was before the batch's first write to ``key``.
+        if self._journal is not None and key not in self._journal:
+            self._journal[key] = self._data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self._note(key)
+        super().set(key, value, timeout)
+
+    def incr(self, key, delta=1):
+        self._note(key)
+        return super().incr(key, delta)
+
+
+class ShardState:
+    """Authoritative in-memory counters for one queue partition.
+
+    ``offset`` is the queue offset whose events the counters reflect;
+    ``saved_offset`` is the one covered by the last snapshot.
+    """
+    __slots__ = ('part', 'path', 'snapshot_seconds', 'cache', 'counters', 'offset', 'saved_offset', '_saved_at')
+
+    def __init__(self, part, snapshot_seconds=None):
+        self.part = part
+        self.path = os.path.join(part.path, 'state.pickle')
+        self.snapshot_seconds = snapshot_seconds or getattr(settings, 'ENGINE_QUEUE_SNAPSHOT_SECONDS', 30)
+        # Entries expire on the wall clock, advanced before every batch.
+        self.cache = JournaledCache()
+        self.counters = LocalCounterBackend(self.cache)
+        self.offset = self.saved_offset = None
+        self._saved_at = time.monotonic()
+
+    def tick(self):
+        self.cache.advance(time.time())
+
+    def restore(self):
+        """Load the last snapshot and replay the records committed after it."""
+        committed = self.part.committed()
+        try:
+            with open(self.path, 'rb') as fh:
+                saved = pickle.load(fh)
+            self.cache.now, self.cache._data = saved['now'], saved['data']
+            offset = saved['offset']
+        except FileNotFoundError:
+            offset = committed
+        segments = self.part.segments()
+        if offset < committed and (not segments or offset < segments[0][0]):
+            # Drained without local state since the snapshot was taken.
+            logger.warning('Partition %d: events since the state snapshot are gone; counters may be stale',
+                           self.part.index)
+            offset = committed
+
+        replayed = 0
+        event_clock = EventClock() if isinstance(get_clock(), EventClock) else None
+        while offset < committed:
+            records, offset = self.part.read(offset, 1000, end=committed)
+            if not records:
+                break
+            for record in records:
+                self.cache.advance(record['accepted_at'])
+                clock = event_clock or FixedClock(datetime.utcfromtimestamp(record['accepted_at']))
+                evaluate_events([NotificationEvent(**to_event_fields(record))], counters=self.counters, clock=clock)
+            replayed += len(records)
+        if replayed:
+            logger.info('Partition %d: replayed %d events into restored counters', self.part.index, replayed)
+        self.offset = committed
+        self.tick()
+        self.save()
+
+    def begin_batch(self):
+        self.cache.begin()
+
+    def discard_batch(self):
+        """Undo the counter writes since begin_batch(); the batch failed."""
+        self.cache.rollback()
+
+    def keep_batch(self):
+        self.cache.keep()
+
+    def advanced(self, offset):
+        """Record that events up to ``offset`` are decided; snapshot if due."""
+        self.offset = offset
+        if time.monotonic() - self._saved_at >= self.snapshot_seconds:
+            self.save()
+
+    def save(self):
+        """Atomically write the counters and the offset they reflect."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            pickle.dump({'offset': self.offset, 'now': self.cache.now, 'data': self.cache._data}, fh,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+        self.saved_offset = self.offset
+        self._saved_at = time.monotonic()
@@ -0,0 +1,228 @@
+"""Rule what-if simulation over stored events.
+
+Replays NotificationEvents in timestamp order against a candidate rule set,
+using private event-time counters so the shared cache is never touched, and
+diffs the outcome against the DecisionRecords written at the time.
+"""
+import multiprocessing
+from collections import Counter
+from django.db import connections
+from django.db.models import Count
+from api.models import NotificationEvent
+from audit.models import DecisionRecord
+from rules.models import RuleConfig
+from rules.snapshot import RuleSnapshot
+from .clock import EventClock, epoch
+from .services import evaluate_events
+from .utils import LocalCounterBackend
+
+EVENT_FIELDS = ('id', 'user_id', 'event_type', 'title', 'source', 'priority_hint', 'timestamp', 'channel',
+                'metadata', 'dedupe_key', 'expires_at')
+
+
+class EventTimeCache:
+    """Minimal cache whose entries expire on a simulated clock.
+
+    Implements the subset of the Django cache API LocalCounterBackend uses.
+    ``advance()`` moves the clock forward; expired entries are swept once per
+    ``sweep_seconds`` of simulated time so memory stays bounded.
+    """
+    __slots__ = ('now', 'sweep_seconds', '_swept', '_data')
+
+    def __init__(self, sweep_seconds=3600):
+        self.now = 0
+        self.sweep_seconds = sweep_seconds
+        self._swept = 0
+        self._data = {}
+
+    def advance(self, now):
+        self.now = max(self.now, now)
+        if self.now - self._swept >= self.sweep_seconds:
+            self._data = {k: entry for k, entry in self._data.items() if entry[1] > self.now}
+            self._swept = self.now
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= self.now:
+            return default
+        return entry[0]
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > self.now:
+                found[key] = entry[0]
+        return found
+
+    def set(self, key, value, timeout=None):
+        self._data[key] = (value, self.now + timeout if timeout else float('inf'))
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+        return []
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, timeout)
+        return True
+
+    def incr(self, key, delta=1):
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= self.now:
+            raise ValueError(f"Key '{key}' not found")
+        self._data[key] = (entry[0] + delta, entry[1])
+        return entry[0] + delta
+
+
+class EventTimeClock(EventClock):
+    """EventClock that also advances ``state`` (an EventTimeCache) to each
+    event's time, so counter windows expire on event time as well.
+
+    Relies on the engine asking for an event's time just before deciding it,
+    as record_decisions and evaluate_events do.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def now(self, event=None):
+        now = super().now(event)
+        self.state.advance(epoch(now))
+        return now
+
+
+def candidate_rules(overrides=None, drop=()):
+    """Current RuleConfig rows with ``overrides`` applied and ``drop`` removed."""
+    rows = dict(RuleConfig.objects.values_list('key', 'value'))
+    rows.update(overrides or {})
+    for key in drop:
+        rows.pop(key, None)
+    return list(rows.items())
+
+
+def plan_shards(queryset, shards):
+    """Split ``queryset``'s users into at most ``shards`` contiguous user_id
+    ranges holding roughly equal numbers of events.
+
+    Every event of a user lands in the same shard, so per-user counters stay
+    exact. Returns a list of inclusive (low, high) user_id pairs.
+    """
+    counts = list(queryset.values_list('user_id').annotate(n=Count('id')).order_by('user_id'))
+    total = sum(n for _, n in counts)
+    if not total:
+        return []
+    target = total / max(1, shards)
+    ranges, low, filled = [], None, 0
+    for user_id, n in counts:
+        low = user_id if low is None else low
+        filled += n
+        if filled >= target * (len(ranges) + 1) and len(ranges) < shards - 1:
+            ranges.append((low, user_id))
+            low = None
+    if low is not None:
+        ranges.append((low, counts[-1][0]))
+    return ranges
+
+
+def _original_decisions(event_ids):
+    # First decision written for each event, i.e. before any scheduler retry.
+    original = {}
+    for event_id, classification in (DecisionRecord.objects.filter(event_id__in=event_ids)
+                                     .order_by('-id').values_list('event_id', 'classification')):
+        original[event_id] = classification
+    return original
+
+
+def simulate_shard(rows, low=None, high=None, start=None, end=None, chunk_size=2000, samples=20):
+    """Replay one user_id range against ``rows`` and return a partial report."""
+    snapshot = RuleSnapshot('what-if', rows)
+    state = EventTimeCache()
+    counters = LocalCounterBackend(state)
+    clock = EventClock()
+    events = NotificationEvent.objects.only(*EVENT_FIELDS).order_by('timestamp', 'id')
+    if low is not None:
+        events = events.filter(user_id__gte=low, user_id__lte=high)
+    if start is not None:
+        events = events.filter(timestamp__gte=start)
+    if end is not None:
+        events = events.filter(timestamp__lt=end)
+
+    transitions, reasons, flips = Counter(), Counter(), []
+    chunk = []
+
+    def run(chunk):
+        original = _original_decisions([e.id for e in chunk])
+        for event in chunk:
+            state.advance(event.timestamp.timestamp())
+            decision = evaluate_events([event], counters=counters, snapshot=snapshot, clock=clock)[0]
+            before = original.get(event.id)
+            transitions[(before, decision.classification)] += 1
+            if before is not None and before != decision.classification:
+                reasons[decision.reason] += 1
+                if len(flips) < samples:
+                    flips.append({'event_id': event.id, 'user_id': event.user_id, 'before': before,
+                                  'after': decision.classification, 'reason': decision.reason})
+
+    for event in events.iterator(chunk_size=chunk_size):
+        chunk.append(event)
+        if len(chunk) >= chunk_size:
+            run(chunk)
+            chunk = []
+    if chunk:
+        run(chunk)
+    return {'transitions': transitions, 'reasons': reasons, 'samples': flips}
+
+
+def _simulate_shard(args):
+    rows, (low, high), options = args
+    try:
+        return simulate_shard(rows, low, high, **options)
+    finally:
+        connections.close_all()
+
+
+def simulate(rows, workers=1, start=None, end=None, chunk_size=2000, samples=20):
+    """Replay stored events against ``rows`` and diff with the recorded decisions.
+
+    With ``workers`` > 1 the users are split into shards (see plan_shards)
+    that are replayed in parallel by a process pool.
+    """
+    options = {'start': start, 'end': end, 'chunk_size': chunk_size, 'samples': samples}
+    if workers <= 1:
+        parts = [simulate_shard(rows, **options)]
+    else:
+        queryset = NotificationEvent.objects.all()
+        if start is not None:
+            queryset = queryset.filter(timestamp__gte=start)
+        if end is not None:
+            queryset = queryset.filter(timestamp__lt=end)
+        shards = plan_shards(queryset, workers)
+        # Children must not share the parent's database connections.
+        connections.close_all()
+        with multiprocessing.Pool(min(workers, len(shards) or 1)) as pool:
+            parts = pool.map(_simulate_shard, [(rows, shard, options) for shard in shards])
+    return merge_reports(parts, samples)
+
+
+def merge_reports(parts, samples=20):
+    transitions, reasons, flips = Counter(), Counter(), []
+    for part in parts:
+        transitions.update(part['transitions'])
+        reasons.update(part['reasons'])
+        flips.extend(part['samples'])
+    total = sum(transitions.values())
+    compared = sum(n for (before, _), n in transitions.items() if before is not None)
+    flipped = sum(n for (before, after), n in transitions.items() if before is not None and before != after)
+    return {
+        'events': total,
+        'compared': compared,
+        'flipped': flipped,
+        'flip_rate': flipped / compared if compared else 0.0,
+        'transitions': {f'{before or "NONE"}->{after}': n for (before, after), n in sorted(
+            transitions.items(), key=lambda item: (item[0][0] or '', item[0][1]))},
+        'flip_reasons': dict(reasons.most_common()),
+        'samples': flips[:samples],
+    }
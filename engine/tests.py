@@ -0,0 +1,624 @@
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import warnings
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from api.models import NotificationEvent
+from audit.models import DecisionRecord
+from rules.models import RuleConfig
+from rules.snapshot import DEFAULT_NEAR_DUPLICATE, NearDuplicate, QuietHours, RuleSnapshot, invalidate_rule_snapshot
+from . import metrics, utils
+from .clock import EventClock, FixedClock, local_date, user_timezone
+from .ingest import IngestQueue, drain_partition
+from .services import arecord_decisions, decide_notification, evaluate_events
+from .shard import ShardState
+from .simulate import candidate_rules, plan_shards, simulate
+from .utils import (DEDUPE, LIMIT, WINDOW, AsyncCounterBackend, CounterStep, LocalCounterBackend,
+                    RedisCounterBackend, dedupe_steps, fingerprint_event, legacy_fingerprint,
+                    make_async_counter_backend, near_duplicate_step, rate_limit_steps)
+
+try:
+    import fakeredis
+    import fakeredis.aioredis
+    from django_redis.cache import RedisCache
+except ImportError:
+    fakeredis = None
+
+
+_fake_hosts = itertools.count()
+
+
+def fake_redis_cache(server=None):
+    # django_redis caches connection pools by URL, so each server gets its own.
+    options = {'CONNECTION_POOL_KWARGS': {'connection_class': fakeredis.FakeConnection,
+                                          'server': server or fakeredis.FakeServer()}}
+    return RedisCache(f'redis://fake-{next(_fake_hosts)}:6379/0', {'OPTIONS': options})
+
+
+class CounterBackendTests(SimpleTestCase):
+    """The Lua script and the in-process backend give the same answers."""
+
+    def check_steps(self, backend):
+        cap = CounterStep(LIMIT, 'cap:u1', 600, 2)
+        self.assertEqual(backend.run([CounterStep(DEDUPE, 'dup:a', 600, 0), cap]), (None, [0, 1]))
+        # A duplicate stops at its dedupe step and leaves the cap alone.
+        self.assertEqual(backend.run([CounterStep(DEDUPE, 'dup:a', 600, 0), cap]), (0, [1]))
+        self.assertEqual(backend.run([CounterStep(DEDUPE, 'dup:b', 600, 0), cap]), (None, [0, 2]))
+        self.assertEqual(backend.run([CounterStep(DEDUPE, 'dup:c', 600, 0), cap]), (1, [0, 3]))
+
+    def check_windows(self, backend):
+        def window(second, limit=2, key='rl:u1:*:600'):
+            # 10 buckets of 60 seconds.
+            return CounterStep(WINDOW, key, 600, limit, second // 60, 10)
+
+        self.assertEqual(backend.run([window(0)]), (None, [1]))
+        self.assertEqual(backend.run([window(300)]), (None, [2]))
+        self.assertEqual(backend.run([window(590)]), (0, [3]))
+        # The window slides: the event at 0s has left it, the one at 300s has not.
+        self.assertEqual(backend.run([window(600)]), (None, [2]))
+        self.assertEqual(backend.run([window(610)]), (0, [3]))
+        # An event rejected by one window is not counted by the others.
+        self.assertEqual(backend.run([window(0, 5, 'rl:u2:*:600'), window(0, 1, 'rl:u2:ch=sms:600')]),
+                         (None, [1, 1]))
+        self.assertEqual(backend.run([window(0, 5, 'rl:u2:*:600'), window(0, 1, 'rl:u2:ch=sms:600')]),
+                         (1, [2, 2]))
+        self.assertEqual(backend.run([window(0, 5, 'rl:u2:*:600')]), (None, [2]))
+
+    def test_local_backend(self):
+        backend = LocalCounterBackend(LocMemCache('counter-tests', {}))
+        self.check_steps(backend)
+        self.check_windows(backend)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_backend(self):
+        backend = RedisCounterBackend(fake_redis_cache())
+        self.check_steps(backend)
+        self.check_windows(backend)
+
+    def test_concurrent_dedupe_admits_one(self):
+        backend = LocalCounterBackend(LocMemCache('race-tests', {}))
+        results = []
+        barrier = threading.Barrier(8)
+
+        def check():
+            barrier.wait()
+            results.append(backend.run([CounterStep(DEDUPE, 'dup:a', 600, 0)]).failed)
+
+        threads = [threading.Thread(target=check) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(None), 1)
+
+
+class RateWindowTests(SimpleTestCase):
+    def steps(self, snapshot, channel='sms', event_type='promotional'):
+        event = NotificationEvent(user_id='u1', event_type=event_type, title='Spring sale', channel=channel)
+        noon = datetime(2026, 1, 5, 12, 0, tzinfo=dt_timezone.utc)
+        return [(step.key, step.limit, step.buckets) for step in rate_limit_steps(event, noon, snapshot)]
+
+    def test_matching_windows_apply_together(self):
+        snapshot = RuleSnapshot(1, [('rate_limits', {
+            'buckets': 6,
+            'default': [{'window': 600, 'limit': 3}],
+            'channels': {'sms': [{'window': 3600, 'limit': 5, 'buckets': 12}]},
+            'event_types': {'promotional': [{'window': 86400, 'limit': 2}]},
+        })])
+        self.assertEqual(self.steps(snapshot), [('rl:u1:*:600', 3, 6), ('rl:u1:ch=sms:3600', 5, 12),
+                                                ('rl:u1:et=promotional:86400', 2, 6)])
+        self.assertEqual(self.steps(snapshot, 'push', 'update'), [('rl:u1:*:600', 3, 6)])
+
+    def test_default_windows(self):
+        self.assertEqual(self.steps(RuleSnapshot(1, [])), [('rl:u1:*:600', 3, 10), ('rl:u1:*:86400', 30, 10)])
+
+
+class NearDuplicateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def check_lookups(self, backend):
+        noon = datetime(2026, 1, 5, 12, 0, tzinfo=dt_timezone.utc)
+
+        def near(title, user_id='u1', seconds=0):
+            event = NotificationEvent(user_id=user_id, event_type='promotional', title=title, channel='push')
+            step = near_duplicate_step(event, noon + timedelta(seconds=seconds), 0.85, 300)
+            return backend.run([step]).failed is not None
+
+        self.assertFalse(near('Spring Sale Offer 1'))
+        self.assertTrue(near('Spring Sale Offer 2', seconds=10))
+        self.assertFalse(near('Your invoice is ready', seconds=20))
+        self.assertFalse(near('Spring Sale Offer 2', user_id='u2', seconds=30))
+        # Signatures older than recent_seconds no longer match.
+        self.assertFalse(near('Spring Sale Offer 3', seconds=400))
+
+    def test_local_backend(self):
+        self.check_lookups(LocalCounterBackend(LocMemCache('near-tests', {})))
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_backend(self):
+        self.check_lookups(RedisCounterBackend(fake_redis_cache()))
+
+    def test_rule_scoping(self):
+        self.assertEqual(RuleSnapshot(1, []).near_duplicate_for('update'), DEFAULT_NEAR_DUPLICATE)
+        self.assertIsNone(RuleSnapshot(1, [('near_duplicate', {'enabled': False})]).near_duplicate_for('update'))
+        scoped = RuleSnapshot(1, [('near_duplicate', {'threshold': 0.9, 'event_types': ['promotional']})])
+        self.assertEqual(scoped.near_duplicate_for('promotional'), NearDuplicate(0.9, 300))
+        self.assertIsNone(scoped.near_duplicate_for('update'))
+
+    def test_similar_titles_are_sent_once(self):
+        events = [NotificationEvent.objects.create(user_id='u1', event_type='promotional', title=title,
+                                                   channel='push', timestamp=timezone.now())
+                  for title in ['Spring Sale Offer 1', 'Spring Sale Offer 2']]
+        self.assertEqual(decide_notification(events[0])[0], 'NOW')
+        self.assertEqual(decide_notification(events[1])[0], 'NEVER')
+        self.assertEqual(DecisionRecord.objects.get(event=events[1]).duplicate_result, 'near')
+
+
+class DecisionTraceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        RuleConfig.objects.create(key='max_daily_marketing', value={'limit': 1})
+        invalidate_rule_snapshot()
+
+    def decide(self, title, event_type='promotional'):
+        event = NotificationEvent.objects.create(user_id='u1', event_type=event_type, title=title, channel='push',
+                                                 timestamp=timezone.now())
+        decide_notification(event)
+        return DecisionRecord.objects.get(event=event)
+
+    def test_marketing_cap_trace(self):
+        self.assertEqual(self.decide('Spring sale starts today').rules_triggered['reason'], 'default')
+        record = self.decide('Your invoice is ready')
+        self.assertEqual(record.classification, 'NEVER')
+        self.assertEqual(record.rules_triggered, {'evaluated': ['max_daily_marketing'],
+                                                  'matched': 'max_daily_marketing', 'reason': 'max_daily_marketing'})
+        snapshot = record.fatigue_snapshot
+        self.assertIsNone(snapshot['dedupe'])
+        self.assertTrue(snapshot['failed'].startswith('market_cap:u1:'))
+        self.assertEqual(snapshot['counters'][snapshot['failed']], 2)
+        self.assertEqual(snapshot['counters']['rl:u1:*:600'], 2)
+
+    def test_duplicate_trace(self):
+        self.decide('Build 4821 failed on main', 'update')
+        record = self.decide('Build 4821 failed on main', 'update')
+        self.assertEqual(record.rules_triggered, {'evaluated': [], 'matched': None, 'reason': 'exact_duplicate'})
+        self.assertEqual(record.fatigue_snapshot['dedupe'], 'exact')
+        self.assertTrue(record.fatigue_snapshot['failed'].startswith('dup:'))
+        self.assertEqual(record.fatigue_snapshot['counters'], {})
+
+    def test_one_counter_call_per_decision(self):
+        with mock.patch.object(LocalCounterBackend, 'run', autospec=True,
+                               side_effect=LocalCounterBackend.run) as run:
+            self.decide('Spring sale starts today')
+            self.decide('Your invoice is ready')
+        self.assertEqual(run.call_count, 2)
+
+    def test_records_are_stamped_with_an_aware_time(self):
+        with warnings.catch_warnings():
+            # Django warns when a naive datetime reaches a DateTimeField.
+            warnings.simplefilter('error', RuntimeWarning)
+            record = self.decide('Spring sale starts today')
+        self.assertLess(timezone.now() - record.timestamp, timedelta(seconds=5))
+
+    @override_settings(ENGINE_DECISION_TRACE=False)
+    def test_trace_can_be_turned_off(self):
+        record = self.decide('Spring sale starts today')
+        self.assertEqual((record.rules_triggered, record.fatigue_snapshot), ({}, {}))
+
+
+class SimulateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+        day = datetime(2026, 1, 5, tzinfo=dt_timezone.utc)
+        self.events = []
+        for user_id, hours in [('u1', (10, 11, 23)), ('u2', (12,)), ('u3', (13, 14))]:
+            for hour in hours:
+                event = NotificationEvent.objects.create(user_id=user_id, event_type='promotional',
+                                                         title=f'Spring sale, day {hour}', channel='push',
+                                                         timestamp=day + timedelta(hours=hour))
+                DecisionRecord.objects.create(event=event, classification='NOW', explanation='',
+                                              timestamp=event.timestamp)
+                self.events.append(event)
+
+    def test_marketing_cap_flips(self):
+        report = simulate(candidate_rules({'max_daily_marketing': {'limit': 1}}))
+        self.assertEqual((report['events'], report['compared'], report['flipped']), (6, 6, 3))
+        self.assertEqual(report['transitions'], {'NOW->NEVER': 3, 'NOW->NOW': 3})
+        self.assertEqual(report['flip_reasons'], {'max_daily_marketing': 3})
+        self.assertEqual({s['event_id'] for s in report['samples']}, {e.id for e in self.events[1:3] + self.events[5:]})
+
+    def test_quiet_hours_use_event_time(self):
+        report = simulate(candidate_rules({'quiet_hours': {'start': '22:00', 'end': '08:00'}}))
+        self.assertEqual(report['transitions'], {'NOW->LATER': 1, 'NOW->NOW': 5})
+        self.assertEqual(report['samples'][0]['event_id'], self.events[2].id)
+
+    def test_live_counters_are_untouched(self):
+        simulate(candidate_rules())
+        event = self.events[0]
+        event.pk = None
+        event.timestamp = timezone.now()
+        event.save()
+        self.assertEqual(decide_notification(event)[0], 'NOW')
+
+    def test_shards_keep_users_whole(self):
+        self.assertEqual(plan_shards(NotificationEvent.objects.all(), 2), [('u1', 'u1'), ('u2', 'u3')])
+        self.assertEqual(plan_shards(NotificationEvent.objects.all(), 5), [('u1', 'u1'), ('u2', 'u2'), ('u3', 'u3')])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('simulate_rules', '--set', 'max_daily_marketing={"limit": 1}', '--start', '2026-01-05T11:00:00',
+                     stdout=out)
+        output = out.getvalue()
+        self.assertIn('2 of 5 recorded decisions would flip', output)
+        self.assertEqual(json.loads(output[:output.rindex('}') + 1])['flip_reasons'], {'max_daily_marketing': 2})
+
+
+class ReplayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+        # The same event a day apart: a duplicate only if the dedupe window
+        # expires on the wall clock rather than on event time.
+        record = {'user_id': 'u1', 'event_type': 'update', 'title': 'Your invoice is ready', 'channel': 'push'}
+        handle = tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False)
+        self.addCleanup(os.unlink, handle.name)
+        with handle:
+            for day in (5, 6):
+                handle.write(json.dumps({**record, 'timestamp': f'2026-01-{day:02d}T12:00:00Z'}) + '\n')
+        self.path = handle.name
+
+    def replay(self, *args):
+        out = StringIO()
+        call_command('replay_events', self.path, *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_windows_follow_event_time(self):
+        self.assertIn("{'NOW': 2, 'LATER': 0, 'NEVER': 0}", self.replay('--dry-run', '--event-time'))
+        self.assertIn("{'NOW': 1, 'LATER': 0, 'NEVER': 1}", self.replay('--dry-run'))
+        self.assertFalse(NotificationEvent.objects.exists())
+
+    def test_event_time_replay_uses_private_counters(self):
+        self.replay('--event-time')
+        self.assertEqual(list(DecisionRecord.objects.order_by('id').values_list('classification', flat=True)),
+                         ['NOW', 'NOW'])
+        # The live dedupe state never saw the replayed events.
+        event = NotificationEvent.objects.first()
+        event.pk = None
+        event.timestamp = timezone.now()
+        event.save()
+        self.assertEqual(decide_notification(event)[0], 'NOW')
+
+
+class ClockTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+
+    def event(self, hour, tz=None):
+        return NotificationEvent(user_id='u1', event_type='promotional', title='Spring sale', channel='push',
+                                 timestamp=datetime(2026, 1, 5, hour, tzinfo=dt_timezone.utc),
+                                 metadata={'timezone': tz} if tz else {})
+
+    def test_user_timezone(self):
+        self.assertEqual(user_timezone(self.event(12, 'Asia/Tokyo')), 'Asia/Tokyo')
+        self.assertEqual(user_timezone(self.event(12, 'Mars/Olympus')), 'UTC')
+        self.assertEqual(user_timezone(self.event(12), default='Europe/Paris'), 'Europe/Paris')
+
+    def test_local_date(self):
+        seconds = int(datetime(2026, 1, 6, 3, tzinfo=dt_timezone.utc).timestamp())
+        self.assertEqual(local_date('UTC', seconds), '2026-01-06')
+        self.assertEqual(local_date('America/New_York', seconds), '2026-01-05')
+        # 2026-03-08 is 23 hours long in New York.
+        spring = int(datetime(2026, 3, 9, 3, 30, tzinfo=dt_timezone.utc).timestamp())
+        self.assertEqual(local_date('America/New_York', spring), '2026-03-08')
+        self.assertEqual(local_date('America/New_York', spring + 3600), '2026-03-09')
+
+    def test_release_after_in_user_timezone(self):
+        quiet = QuietHours('22:00', '08:00')
+        # 23:00 in New York; the window ends at 08:00 local, 13:00 UTC.
+        self.assertEqual(quiet.release_after(datetime(2026, 1, 6, 4), 'America/New_York'),
+                         datetime(2026, 1, 6, 13, 0, 1))
+        self.assertEqual(quiet.release_after(datetime(2026, 1, 6, 4)), datetime(2026, 1, 6, 8, 0, 1))
+
+    def test_quiet_hours_follow_the_user(self):
+        RuleConfig.objects.create(key='quiet_hours', value={'start': '22:00', 'end': '08:00'})
+        invalidate_rule_snapshot()
+        # 14:00 UTC is 23:00 in Tokyo.
+        events = [self.event(14), self.event(14, 'Asia/Tokyo')]
+        decisions = evaluate_events(events, clock=EventClock())
+        self.assertEqual([d.classification for d in decisions], ['NOW', 'LATER'])
+
+    def test_event_clock_judges_late_events_as_of_their_timestamp(self):
+        RuleConfig.objects.create(key='quiet_hours', value={'start': '22:00', 'end': '08:00'})
+        invalidate_rule_snapshot()
+        event = self.event(23)
+        self.assertEqual(evaluate_events([event], clock=FixedClock(datetime(2026, 1, 5, 12)))[0].classification,
+                         'NOW')
+        cache.clear()
+        self.assertEqual(evaluate_events([event], clock=EventClock())[0].classification, 'LATER')
+
+
+class FingerprintTests(SimpleTestCase):
+    def event(self, **kwargs):
+        fields = {'user_id': 'u1', 'event_type': 'system_alert', 'title': 'Disk full', 'source': 'monitor',
+                  'channel': 'push', 'metadata': {'host': 'db1', 'cpu_percent': 97}}
+        fields.update(kwargs)
+        return NotificationEvent(**fields)
+
+    def snapshot(self, rule=None):
+        return RuleSnapshot(1, [('fingerprint', rule)] if rule else [])
+
+    def test_canonical_encoding_is_stable(self):
+        # Keys written by earlier releases must keep matching.
+        canonical = '["u1","system_alert","Disk full","monitor",{"cpu_percent":97,"host":"db1"}]'
+        digest = hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+        expected = 'b' + base64.urlsafe_b64encode(digest).decode('ascii')[:22]
+        with mock.patch.object(utils, 'xxhash', None):
+            self.assertEqual(fingerprint_event(self.event(), self.snapshot()), expected)
+            reordered = self.event(metadata={'cpu_percent': 97, 'host': 'db1'})
+            self.assertEqual(fingerprint_event(reordered, self.snapshot()), expected)
+        self.assertEqual(len(fingerprint_event(self.event(), self.snapshot())), 23)
+
+    def test_rule_selects_the_fields(self):
+        snapshot = self.snapshot({'exclude_metadata': ['cpu_percent'],
+                                  'per_event_type': {'update': {'fields': ['user_id', 'metadata.host']}}})
+        alert = fingerprint_event(self.event(), snapshot)
+        self.assertEqual(fingerprint_event(self.event(metadata={'host': 'db1', 'cpu_percent': 12}), snapshot), alert)
+        self.assertNotEqual(fingerprint_event(self.event(metadata={'host': 'db2'}), snapshot), alert)
+        update = self.event(event_type='update')
+        self.assertEqual(fingerprint_event(self.event(event_type='update', title='Other', source=None), snapshot),
+                         fingerprint_event(update, snapshot))
+
+    def test_dedupe_key_wins(self):
+        self.assertEqual(fingerprint_event(self.event(dedupe_key='job-42'), self.snapshot()), 'job-42')
+
+    def test_modes(self):
+        event = self.event()
+        legacy = legacy_fingerprint(event)
+        self.assertEqual(len(legacy), 64)
+        with override_settings(ENGINE_FINGERPRINT_MODE='legacy'):
+            self.assertEqual(fingerprint_event(event, self.snapshot()), legacy)
+            self.assertEqual([s.key for s in dedupe_steps(event, self.snapshot())], [f'dup:{legacy}'])
+        with override_settings(ENGINE_FINGERPRINT_MODE='dual'):
+            keys = [s.key for s in dedupe_steps(event, self.snapshot())]
+        self.assertEqual(keys, [f'dup:{fingerprint_event(event, self.snapshot())}', f'dup:{legacy}'])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+
+    def scrape(self):
+        response = self.client.get('/engine/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        values = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+        return values
+
+    def decide(self, title):
+        event = NotificationEvent.objects.create(user_id='u1', event_type='update', title=title, channel='push',
+                                                 timestamp=timezone.now())
+        return decide_notification(event)
+
+    def test_decisions_are_counted(self):
+        self.decide('Your invoice is ready')
+        before = self.scrape()
+        self.decide('Your invoice is ready')
+        after = self.scrape()
+
+        def delta(name):
+            return after.get(name, 0) - before.get(name, 0)
+        self.assertEqual(delta('engine_decisions_total{classification="NEVER",reason="exact_duplicate"}'), 1)
+        self.assertEqual(delta('engine_cache_round_trips_total'), 1)
+        self.assertEqual(delta('engine_stage_seconds_count{stage="counters"}'), 1)
+        self.assertEqual(delta('engine_stage_seconds_count{stage="audit"}'), 1)
+        self.assertGreater(delta('engine_db_queries_total'), 0)
+
+    @override_settings(ENGINE_METRICS=False)
+    def test_collection_can_be_switched_off(self):
+        before = self.scrape()
+        self.decide('Your invoice is ready')
+        self.assertEqual(self.scrape(), before)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ['stage'], buckets=(0.1, 1.0))
+        self.addCleanup(metrics._registry.remove, histogram)
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(list(histogram.render())[2:], [
+            'test_seconds_bucket{stage="a\\"b",le="0.1"} 1',
+            'test_seconds_bucket{stage="a\\"b",le="1.0"} 2',
+            'test_seconds_bucket{stage="a\\"b",le="+Inf"} 3',
+            'test_seconds_count{stage="a\\"b"} 3',
+            'test_seconds_sum{stage="a\\"b"} 5.55',
+        ])
+
+
+class AsyncPathTests(TransactionTestCase):
+    """The async path shares counters and audit writes with the sync one."""
+
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+
+    def payload(self, title='Your invoice is ready'):
+        return {'user_id': 'u1', 'event_type': 'update', 'title': title, 'channel': 'push',
+                'timestamp': timezone.now().isoformat()}
+
+    async def test_evaluate_async_endpoint(self):
+        url = '/api/events/evaluate-async/'
+        first = await self.async_client.post(url, self.payload(), content_type='application/json')
+        second = await self.async_client.post(url, self.payload(), content_type='application/json')
+        self.assertEqual((first.status_code, first.json()['classification']), (200, 'NOW'))
+        self.assertEqual(second.json()['classification'], 'NEVER')
+        self.assertEqual(await DecisionRecord.objects.filter(classification='NEVER').acount(), 1)
+        response = await self.async_client.post(url, '{oops', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    async def test_batch_is_decided_concurrently_and_atomically(self):
+        events = [await NotificationEvent.objects.acreate(user_id='u1', event_type='update', title=title,
+                                                          channel='push', timestamp=timezone.now())
+                  for title in ['Your invoice is ready'] * 4 + ['Weekly team digest']]
+        decisions = await arecord_decisions(events)
+        self.assertEqual([d.classification for d in decisions].count('NOW'), 2)
+        self.assertEqual(await DecisionRecord.objects.acount(), 5)
+
+    def test_sync_and_async_share_the_local_backend(self):
+        backend = LocalCounterBackend(LocMemCache('async-tests', {}))
+        async_backend = make_async_counter_backend(backend)
+        self.assertIsInstance(async_backend, AsyncCounterBackend)
+        step = CounterStep(DEDUPE, 'dup:a', 600, 0)
+        self.assertIsNone(asyncio.run(async_backend.run([step])).failed)
+        self.assertEqual(backend.run([step]).failed, 0)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_async_redis_backend_matches_the_script(self):
+        server = fakeredis.FakeServer()
+        backend = RedisCounterBackend(fake_redis_cache(server))
+        cap = CounterStep(LIMIT, 'cap:u1', 600, 2)
+
+        async def run(*steps):
+            client = fakeredis.aioredis.FakeRedis(server=server)
+            try:
+                return await make_async_counter_backend(backend, client).run(list(steps))
+            finally:
+                await client.aclose()
+
+        self.assertEqual(asyncio.run(run(CounterStep(DEDUPE, 'dup:a', 600, 0), cap)), (None, [0, 1]))
+        self.assertEqual(backend.run([CounterStep(DEDUPE, 'dup:a', 600, 0), cap]), (0, [1]))
+        self.assertEqual(asyncio.run(run(CounterStep(DEDUPE, 'dup:b', 600, 0), cap)), (None, [0, 2]))
+        self.assertEqual(backend.run([CounterStep(DEDUPE, 'dup:c', 600, 0), cap]), (1, [0, 3]))
+
+
+class QueueRedeliveryTests(TestCase):
+    TITLES = ['Your invoice is ready', 'Password changed on a new device', 'Weekly team digest']
+
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.queue = IngestQueue(root=root, partitions=1, fsync=False)
+        self.part = self.queue.partition(0)
+
+    def append(self, titles, user_id='u1'):
+        self.queue.append([{'user_id': user_id, 'event_type': 'update', 'title': title, 'channel': 'push',
+                            'timestamp': timezone.now()} for title in titles])
+
+    def reasons(self):
+        return list(DecisionRecord.objects.order_by('id').values_list('reason', flat=True))
+
+    def test_failed_batch_is_redelivered_without_turning_into_duplicates(self):
+        for i, title in enumerate(self.TITLES):
+            self.append([title], user_id=f'u{i}')
+        with mock.patch('engine.services._persist', side_effect=DatabaseError('db down')):
+            with self.assertRaises(DatabaseError):
+                drain_partition(self.part)
+        self.assertEqual(self.part.committed(), 0)
+        self.assertFalse(NotificationEvent.objects.exists())
+
+        self.assertEqual(drain_partition(self.part), 3)
+        self.assertNotIn('exact_duplicate', self.reasons())
+        self.assertEqual(DecisionRecord.objects.filter(classification='NOW').count(), 3)
+        self.assertEqual(drain_partition(self.part), 0)
+
+    def test_batch_already_in_database_is_not_inserted_again(self):
+        self.append(self.TITLES[:2])
+        with mock.patch.object(self.part, 'commit', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                drain_partition(self.part)
+        self.assertEqual(NotificationEvent.objects.count(), 2)
+
+        self.assertEqual(drain_partition(self.part), 0)
+        self.assertEqual(NotificationEvent.objects.count(), 2)
+        self.assertEqual(self.part.read(self.part.committed(), 10)[0], [])
+
+    def test_shard_state_retry_keeps_dedupe(self):
+        state = ShardState(self.part)
+        state.restore()
+        self.append(self.TITLES[:1])
+        self.assertEqual(drain_partition(self.part, state=state), 1)
+
+        # One exact duplicate of the first batch and one new event.
+        self.append(self.TITLES[:2])
+        with mock.patch('engine.services._persist', side_effect=DatabaseError('db down')):
+            with self.assertRaises(DatabaseError):
+                drain_partition(self.part, state=state)
+        self.assertEqual(drain_partition(self.part, state=state), 2)
+        self.assertEqual(self.reasons()[1:], ['exact_duplicate', 'default'])
+
+
+class QueueStatsTests(SimpleTestCase):
+    def test_stats_do_not_create_partitions(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        queue = IngestQueue(root=root, partitions=4, fsync=False)
+        self.assertEqual(queue.stats()['depth'], 0)
+        self.assertEqual(os.listdir(root), [])
+
+        queue.append([{'user_id': 'u1', 'event_type': 'update', 'title': 'Your invoice is ready',
+                       'channel': 'push', 'timestamp': timezone.now()}])
+        stats = queue.stats()
+        self.assertEqual((stats['depth'], len(stats['partitions'])), (1, 4))
+        self.assertEqual(len(os.listdir(root)), 1)
+
+
+class WindowBoundTests(SimpleTestCase):
+    """Under an event clock, a window only counts buckets up to the event's own."""
+
+    def step(self, bucket):
+        return CounterStep(WINDOW, 'rl:u1:user:600', 600, 3, bucket, 10)
+
+    def check_bounds(self, backend):
+        for _ in range(3):
+            self.assertIsNone(backend.run([self.step(100)]).failed)
+        self.assertEqual(backend.run([self.step(100)]).failed, 0)
+        # A late event is not limited by the events after it...
+        self.assertIsNone(backend.run([self.step(95)]).failed)
+        # ...but counts for the events after it.
+        self.assertEqual(backend.run([self.step(104)]).failed, 0)
+        self.assertIsNone(backend.run([self.step(110)]).failed)
+
+    def test_local_backend(self):
+        self.check_bounds(LocalCounterBackend(LocMemCache('window-tests', {})))
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_backend(self):
+        self.check_bounds(RedisCounterBackend(fake_redis_cache()))
+
+    def test_late_event_through_the_pipeline(self):
+        snapshot = RuleSnapshot(1, [('rate_limits', {'default': [{'window': 600, 'limit': 3}]})])
+        noon = datetime(2026, 1, 5, 12, 0, tzinfo=dt_timezone.utc)
+        titles = ['Your invoice is ready', 'Password changed on a new device', 'Weekly team digest',
+                  'Build 4821 failed on main', 'Flight LH 1234 boards at gate B12']
+        events = [NotificationEvent(user_id='u1', event_type='update', title=title, channel='push',
+                                    timestamp=noon + timedelta(seconds=i)) for i, title in enumerate(titles)]
+        # Replayed out of order: the last event happened before the others.
+        events[-1].timestamp = noon - timedelta(minutes=2)
+        decisions = evaluate_events(events, counters=LocalCounterBackend(LocMemCache('pipeline-tests', {})),
+                                    snapshot=snapshot, clock=EventClock())
+        self.assertEqual([d.classification for d in decisions[:3]], ['NOW'] * 3)
+        self.assertEqual(decisions[3].reason, 'rate_limit')
+        self.assertEqual(decisions[4].classification, 'NOW')
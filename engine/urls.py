@@ -1,3 +1,7 @@
 from django.urls import path
+from . import views
 
-urlpatterns = []
+urlpatterns = [
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('queue/', views.queue_stats, name='queue-stats'),
+]
@@ -1,17 +1,33 @@
+import asyncio
+import base64
 import hashlib
 import json
-from datetime import datetime, timedelta
+import threading
+import weakref
+from collections import namedtuple
+from functools import lru_cache
 from django.core.cache import cache
 from django.conf import settings
+from rules.snapshot import get_rule_snapshot
+from . import metrics
+from .aio import run_db
+from .clock import epoch, get_clock, local_date, user_timezone
+
+try:
+    import xxhash
+except ImportError:  # optional: xxh3 is faster, blake2b is the fallback
+    xxhash = None
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # optional: without it Redis calls go to the thread pool
+    redis_asyncio = None
 
 # -------------------------------------------------------------------
-# Fingerprint generation (deterministic SHA‑256)
+# Fingerprint generation (canonical binary encoding + 128-bit hash)
 # -------------------------------------------------------------------
-def fingerprint_event(event):
-    """Create a deterministic fingerprint for a NotificationEvent.
-    Uses dedupe_key if present, otherwise hashes a JSON representation of
-    the most important fields.
-    """
+def legacy_fingerprint(event):
+    """Original SHA-256-over-JSON fingerprint (ENGINE_FINGERPRINT_MODE='legacy')."""
     if event.dedupe_key:
         return event.dedupe_key
     payload = {
@@ -24,115 +40,487 @@ def fingerprint_event(event):
     json_str = json.dumps(payload, sort_keys=True)
     return hashlib.sha256(json_str.encode('utf-8')).hexdigest()
 
+# Canonical encoding: a compact JSON array with sorted metadata keys, built
+# by the C encoder (faster than any pure-Python binary packing).
+_canonical = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, sort_keys=True, default=str).encode
+
+def _hash128(data):
+    if xxhash is not None:
+        return 'x' + base64.urlsafe_b64encode(xxhash.xxh3_128_digest(data)).decode('ascii')[:22]
+    return 'b' + base64.urlsafe_b64encode(hashlib.blake2b(data, digest_size=16).digest()).decode('ascii')[:22]
+
+def fast_fingerprint(event, spec):
+    """23-character fingerprint over the fields selected by ``spec``
+    (see rules.snapshot.FingerprintSpec).
+    """
+    if event.dedupe_key:
+        return event.dedupe_key
+    values = [getattr(event, name) for name in spec.fields]
+    if spec.metadata:
+        metadata = event.metadata or {}
+        if spec.metadata is not True:
+            metadata = {k: metadata.get(k) for k in spec.metadata}
+        if spec.exclude_metadata:
+            metadata = {k: v for k, v in metadata.items() if k not in spec.exclude_metadata}
+        values.append(metadata)
+    return _hash128(_canonical(values).encode('utf-8'))
+
+def fingerprint_event(event, snapshot=None):
+    """Create a deterministic fingerprint for a NotificationEvent.
+    Uses dedupe_key if present. Otherwise ENGINE_FINGERPRINT_MODE picks the
+    compact 128-bit fingerprint ('fast', the default) or the original
+    SHA-256 hex digest ('legacy').
+    """
+    if getattr(settings, 'ENGINE_FINGERPRINT_MODE', 'fast') == 'legacy':
+        return legacy_fingerprint(event)
+    if snapshot is None:
+        snapshot = get_rule_snapshot()
+    return fast_fingerprint(event, snapshot.fingerprint_for(event.event_type))
+
+# -------------------------------------------------------------------
+# Pipelined fatigue counters (one cache round trip per decision)
+# -------------------------------------------------------------------
+DEDUPE, NEAR, LIMIT, WINDOW = 'dedupe', 'near', 'limit', 'window'
+
+# One gated operation. ``dedupe`` adds the key and fails if it already
+# existed; ``near`` looks up the SimHash LSH bands listed in ``payload`` in
+# the per-user hash ``key`` and fails if a signature within ``limit`` bits
+# was stored less than ``ttl`` seconds before ``bucket`` (the current epoch
+# second), recording the new signature otherwise; ``limit`` increments the
+# key (TTL set on creation) and fails once the count exceeds ``limit``;
+# ``window`` is a sliding window of ``ttl`` seconds stored as ``buckets``
+# bucketed counters in one hash, ``bucket`` being the index of the event's
+# bucket; only buckets from the window's start up to ``bucket`` count, so a
+# late event (event clock) is not limited by events after it. Window steps
+# are only checked while the list is walked and are incremented once every
+# step has passed, so a rejected event never consumes window budget.
+CounterStep = namedtuple('CounterStep', 'kind key ttl limit bucket buckets payload', defaults=(0, 0, ''))
+
+CounterResult = namedtuple('CounterResult', 'failed values')
+
+_COUNTER_SCRIPT = """
+local function distance(a, b)
+  local n = 0
+  for i = 1, 16 do
+    local x, y = tonumber(string.sub(a, i, i), 16), tonumber(string.sub(b, i, i), 16)
+    for _ = 1, 4 do
+      if x % 2 ~= y % 2 then n = n + 1 end
+      x, y = math.floor(x / 2), math.floor(y / 2)
+    end
+  end
+  return n
+end
+local values, admitted = {}, {}
+for i = 1, #KEYS do
+  local base = 6 * (i - 1)
+  local kind, ttl, limit = ARGV[base+1], tonumber(ARGV[base+2]), tonumber(ARGV[base+3])
+  if kind == 'dedupe' then
+    if redis.call('SET', KEYS[i], 1, 'EX', ttl, 'NX') then
+      values[i] = 0
+    else
+      values[i] = 1
+      return {i, values}
+    end
+  elseif kind == 'near' then
+    local now, fields = tonumber(ARGV[base+4]), {}
+    for field in string.gmatch(ARGV[base+6], '%S+') do fields[#fields+1] = field end
+    local sig = table.remove(fields, 1)
+    values[i] = 0
+    for _, entry in ipairs(redis.call('HMGET', KEYS[i], unpack(fields))) do
+      if entry then
+        local other, seen = string.match(entry, '(%x+):(%d+)')
+        if tonumber(seen) > now - ttl and distance(sig, other) <= limit then
+          values[i] = 1
+          return {i, values}
+        end
+      end
+    end
+    local pairs_ = {}
+    for _, field in ipairs(fields) do
+      pairs_[#pairs_+1] = field
+      pairs_[#pairs_+1] = sig .. ':' .. now
+    end
+    redis.call('HSET', KEYS[i], unpack(pairs_))
+    redis.call('EXPIRE', KEYS[i], ttl)
+    if redis.call('HLEN', KEYS[i]) > 64 * #fields then
+      local flat, stale = redis.call('HGETALL', KEYS[i]), {}
+      for j = 1, #flat, 2 do
+        if tonumber(string.match(flat[j+1], ':(%d+)')) <= now - ttl then stale[#stale+1] = flat[j] end
+      end
+      if #stale > 0 then redis.call('HDEL', KEYS[i], unpack(stale)) end
+    end
+  elseif kind == 'window' then
+    local bucket = tonumber(ARGV[base+4])
+    local oldest = bucket - tonumber(ARGV[base+5]) + 1
+    local flat = redis.call('HGETALL', KEYS[i])
+    local count, stale = 1, {}
+    for j = 1, #flat, 2 do
+      local b = tonumber(flat[j])
+      if b < oldest then
+        stale[#stale+1] = flat[j]
+      elseif b <= bucket then
+        count = count + tonumber(flat[j+1])
+      end
+    end
+    if #stale > 0 then redis.call('HDEL', KEYS[i], unpack(stale)) end
+    values[i] = count
+    if count > limit then return {i, values} end
+    admitted[#admitted+1] = i
+  else
+    local count = redis.call('INCR', KEYS[i])
+    if count == 1 then redis.call('EXPIRE', KEYS[i], ttl) end
+    values[i] = count
+    if count > limit then return {i, values} end
+  end
+end
+for _, i in ipairs(admitted) do
+  local base = 6 * (i - 1)
+  redis.call('HINCRBY', KEYS[i], ARGV[base+4], 1)
+  redis.call('EXPIRE', KEYS[i], ARGV[base+2])
+end
+return {0, values}
+"""
+
+
+class RedisCounterBackend:
+    """Runs a list of CounterSteps atomically as a single Lua script call."""
+
+    def __init__(self, cache_backend):
+        self.cache = cache_backend
+        self._script = cache_backend.client.get_client(write=True).register_script(_COUNTER_SCRIPT)
+
+    def run(self, steps):
+        if metrics.enabled():
+            metrics.CACHE_ROUND_TRIPS.inc()
+        keys, args = [], []
+        for step in steps:
+            keys.append(self.cache.make_key(step.key))
+            args.extend((step.kind, step.ttl, step.limit, step.bucket, step.buckets, step.payload))
+        failed, values = self._script(keys=keys, args=args)
+        return CounterResult(failed - 1 if failed else None, [int(v) for v in values])
+
+
+class LocalCounterBackend:
+    """Equivalent of the Redis script for in-process caches (LocMemCache).
+
+    A lock makes the step sequence atomic with respect to other threads of
+    this process, which is all a per-process cache can observe.
+    """
+
+    def __init__(self, cache_backend):
+        self.cache = cache_backend
+        self._lock = threading.Lock()
+
+    def run(self, steps):
+        if metrics.enabled():
+            metrics.CACHE_ROUND_TRIPS.inc()
+        values, admitted = [], []
+        with self._lock:
+            for index, step in enumerate(steps):
+                if step.kind == DEDUPE:
+                    seen = not self.cache.add(step.key, 1, timeout=step.ttl)
+                    values.append(int(seen))
+                    if seen:
+                        return CounterResult(index, values)
+                    continue
+                if step.kind == NEAR:
+                    sig, *fields = step.payload.split()
+                    near = self._near(step, int(sig, 16), fields)
+                    values.append(int(near))
+                    if near:
+                        return CounterResult(index, values)
+                    continue
+                if step.kind == WINDOW:
+                    oldest = step.bucket - step.buckets + 1
+                    counts = {b: n for b, n in (self.cache.get(step.key) or {}).items() if b >= oldest}
+                    count = sum(n for b, n in counts.items() if b <= step.bucket) + 1
+                    values.append(count)
+                    if count > step.limit:
+                        return CounterResult(index, values)
+                    admitted.append((step, counts))
+                    continue
+                try:
+                    count = self.cache.incr(step.key)
+                except ValueError:
+                    # Cache incr throws ValueError if key doesn't exist in LocMemCache
+                    self.cache.set(step.key, 1, timeout=step.ttl)
+                    count = 1
+                values.append(count)
+                if count > step.limit:
+                    return CounterResult(index, values)
+            for step, counts in admitted:
+                counts[step.bucket] = counts.get(step.bucket, 0) + 1
+                self.cache.set(step.key, counts, timeout=step.ttl)
+        return CounterResult(None, values)
+
+    def _near(self, step, sig, fields):
+        # One cache entry per band so a lookup touches len(fields) keys no
+        # matter how many signatures the user has; the cache expires them.
+        keys = [f"{step.key}:{field}" for field in fields]
+        cutoff = step.bucket - step.ttl
+        for other, seen in self.cache.get_many(keys).values():
+            if seen > cutoff and bin(sig ^ other).count('1') <= step.limit:
+                return True
+        self.cache.set_many({key: (sig, step.bucket) for key in keys}, timeout=step.ttl)
+        return False
+
+
+def make_counter_backend(cache_backend):
+    """Pick the pipelined implementation for ``cache_backend``."""
+    client = getattr(cache_backend, 'client', None)
+    if client is not None and hasattr(client, 'get_client'):
+        return RedisCounterBackend(cache_backend)
+    return LocalCounterBackend(cache_backend)
+
+
+_counter_backend = None
+
+def get_counter_backend():
+    """Process-wide counter backend bound to the default Django cache."""
+    global _counter_backend
+    if _counter_backend is None:
+        _counter_backend = make_counter_backend(cache)
+    return _counter_backend
+
+# -------------------------------------------------------------------
+# Awaitable counter backends (ASGI evaluate path)
+# -------------------------------------------------------------------
+class AsyncRedisCounterBackend:
+    """RedisCounterBackend for coroutines, on a ``redis.asyncio`` client.
+
+    The whole step list is still one script call; awaiting it frees the
+    event loop for other evaluations while the round trip is in flight.
+    """
+
+    def __init__(self, cache_backend, client):
+        self.cache = cache_backend
+        self._script = client.register_script(_COUNTER_SCRIPT)
+
+    async def run(self, steps):
+        if metrics.enabled():
+            metrics.CACHE_ROUND_TRIPS.inc()
+        keys, args = [], []
+        for step in steps:
+            keys.append(self.cache.make_key(step.key))
+            args.extend((step.kind, step.ttl, step.limit, step.bucket, step.buckets, step.payload))
+        failed, values = await self._script(keys=keys, args=args)
+        return CounterResult(failed - 1 if failed else None, [int(v) for v in values])
+
+
+class AsyncCounterBackend:
+    """Awaitable wrapper for a synchronous counter backend.
+
+    An in-process backend answers without I/O and runs inline; anything else
+    is sent to the engine's database/blocking pool.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.inline = isinstance(backend, LocalCounterBackend)
+
+    async def run(self, steps):
+        if self.inline:
+            return self.backend.run(steps)
+        return await run_db(self.backend.run, steps)
+
+
+def make_async_counter_backend(backend, client=None):
+    """Awaitable counterpart of the synchronous counter ``backend``.
+
+    Sharing ``backend`` keeps an in-process cache's lock common to sync and
+    async callers. For Redis, ``client`` is a ``redis.asyncio`` client on the
+    same server; without one the blocking script call goes to the pool.
+    """
+    if isinstance(backend, RedisCounterBackend) and client is not None:
+        return AsyncRedisCounterBackend(backend.cache, client)
+    return AsyncCounterBackend(backend)
+
+
+_async_counter_backends = weakref.WeakKeyDictionary()
+
+def get_async_counter_backend():
+    """Counter backend for coroutines bound to the default Django cache.
+
+    Async Redis connections belong to the event loop that opened them, so
+    there is one backend per running loop. Its pool holds at most
+    ENGINE_ASYNC_REDIS_CONNECTIONS connections; extra callers wait for one.
+    """
+    loop = asyncio.get_running_loop()
+    backend = _async_counter_backends.get(loop)
+    if backend is None:
+        backend, client = get_counter_backend(), None
+        if isinstance(backend, RedisCounterBackend) and redis_asyncio is not None:
+            location = settings.CACHES['default']['LOCATION']
+            pool = redis_asyncio.BlockingConnectionPool.from_url(
+                location[0] if isinstance(location, (list, tuple)) else location,
+                max_connections=getattr(settings, 'ENGINE_ASYNC_REDIS_CONNECTIONS', 50))
+            client = redis_asyncio.Redis(connection_pool=pool)
+        backend = _async_counter_backends[loop] = make_async_counter_backend(backend, client)
+    return backend
+
 # -------------------------------------------------------------------
 # Exact duplicate detection
 # -------------------------------------------------------------------
+def dedupe_step(fingerprint, window_seconds=600):
+    return CounterStep(DEDUPE, f"dup:{fingerprint}", window_seconds, 0)
+
+def dedupe_steps(event, snapshot=None, window_seconds=600):
+    """Dedupe steps for ``event``. In 'dual' fingerprint mode the legacy
+    key is checked and recorded as well, so processes still on legacy keys
+    and upgraded ones see each other's events during a rollout.
+    """
+    mode = getattr(settings, 'ENGINE_FINGERPRINT_MODE', 'fast')
+    if mode == 'legacy' or event.dedupe_key:
+        return [dedupe_step(legacy_fingerprint(event), window_seconds)]
+    if snapshot is None:
+        snapshot = get_rule_snapshot()
+    steps = [dedupe_step(fast_fingerprint(event, snapshot.fingerprint_for(event.event_type)), window_seconds)]
+    if mode == 'dual':
+        steps.append(dedupe_step(legacy_fingerprint(event), window_seconds))
+    return steps
+
 def is_exact_duplicate(fingerprint, window_seconds=600):
-    """Return True if the fingerprint exists in cache within the window."""
-    key = f"dup:{fingerprint}"
-    if cache.get(key):
-        return True
-    # Not seen – store it for future checks
-    cache.set(key, 1, timeout=window_seconds)
-    return False
+    """Return True if the fingerprint exists in cache within the window.
+    Not-seen fingerprints are recorded atomically (no get-then-set race).
+    """
+    result = get_counter_backend().run([dedupe_step(fingerprint, window_seconds)])
+    return result.failed is not None
 
 # -------------------------------------------------------------------
-# Near‑duplicate detection (Bypassed for simple caching backends)
+# Near‑duplicate detection (SimHash + per-user LSH band index)
 # -------------------------------------------------------------------
-def is_near_duplicate(event, similarity_threshold=0.85, recent_seconds=300):
-    """Near-duplicate detection logic built for Redis has been turned off
-    temporarily to support SQLite and LocMem cache environments.
+def simhash(event):
+    """64-bit SimHash of the event's normalised title (character 3-grams)
+    and its metadata key/value pairs.
     """
-    return False
+    title = ' '.join((event.title or '').lower().split())
+    features = [title[i:i + 3] for i in range(max(1, len(title) - 2))]
+    features.extend(f"{k}={v}" for k, v in sorted((event.metadata or {}).items()))
+    bits = [format(int.from_bytes(hashlib.blake2b(f.encode('utf-8'), digest_size=8).digest(), 'big'), '064b')
+            for f in features]
+    half = len(bits) / 2
+    return int(''.join('1' if col.count('1') > half else '0' for col in map(''.join, zip(*bits))), 2)
+
+@lru_cache(maxsize=None)
+def _band_layout(max_distance):
+    """Split 64 bits into max_distance + 1 bands: by pigeonhole, two
+    signatures within max_distance bits agree on at least one band.
+    """
+    bands = min(64, max_distance + 1)
+    layout, shift = [], 0
+    for i in range(bands):
+        width = 64 // bands + (1 if i < 64 % bands else 0)
+        layout.append((shift, (1 << width) - 1))
+        shift += width
+    return tuple(layout)
+
+def near_duplicate_step(event, now=None, similarity_threshold=0.85, recent_seconds=300):
+    """Counter step that checks and records the event's SimHash in the
+    user's LSH index. Cost is one hash lookup per band, independent of how
+    many recent events the user has.
+    """
+    max_distance = int((1 - similarity_threshold) * 64)
+    sig = simhash(event)
+    fields = [f"{i}:{(sig >> shift) & mask:x}" for i, (shift, mask) in enumerate(_band_layout(max_distance))]
+    seconds = epoch(now or get_clock().now(event))
+    return CounterStep(NEAR, f"near:{event.user_id}", recent_seconds, max_distance, seconds, 0,
+                       ' '.join([f"{sig:016x}"] + fields))
+
+def is_near_duplicate(event, similarity_threshold=0.85, recent_seconds=300, now=None):
+    """Return True if a signature within ``similarity_threshold`` of this
+    event was seen for the same user in the last ``recent_seconds``.
+    Works on both LocMemCache and Redis.
+    """
+    step = near_duplicate_step(event, now, similarity_threshold, recent_seconds)
+    return get_counter_backend().run([step]).failed is not None
 
 # -------------------------------------------------------------------
 # Rate‑limit / fatigue counters
 # -------------------------------------------------------------------
-def exceeds_rate_limits(user_id, event, max_per_10min=3, daily_cap=30):
-    """Check if the user has exceeded notification caps using simple cache framework.
-    """
-    key_10min = f"rate10:{user_id}"
-    
-    try:
-        count_10 = cache.incr(key_10min)
-    except ValueError:
-        # Cache incr throws ValueError if key doesn't exist in LocMemCache
-        cache.set(key_10min, 1, timeout=600)
-        count_10 = 1
-
-    if count_10 > max_per_10min:
-        return True
-
-    today = datetime.utcnow().strftime('%Y-%m-%d')
-    key_daily = f"rate_day:{user_id}:{today}"
-    
-    try:
-        count_day = cache.incr(key_daily)
-    except ValueError:
-        cache.set(key_daily, 1, timeout=86400)
-        count_day = 1
-
-    if count_day > daily_cap:
-        return True
-        
-    return False
+def rate_limit_steps(event, now=None, snapshot=None):
+    """Sliding-window counter steps for every rate window that applies to
+    the event's user, channel and event_type (see RuleSnapshot.rate_windows).
+    """
+    if snapshot is None:
+        snapshot = get_rule_snapshot()
+    seconds = epoch(now or get_clock().now(event))
+    return [_window_step(event, w, seconds) for w in snapshot.rate_windows(event.channel, event.event_type)]
+
+def _window_step(event, window, seconds):
+    if window.scope == 'channel':
+        scope = f"ch={event.channel}"
+    elif window.scope == 'event_type':
+        scope = f"et={event.event_type}"
+    else:
+        scope = "*"
+    return CounterStep(WINDOW, f"rl:{event.user_id}:{scope}:{window.seconds}", window.seconds,
+                       window.limit, seconds // window.bucket_seconds, window.buckets)
+
+def exceeds_rate_limits(user_id, event, now=None):
+    """Check if the user has exceeded any configured rate window.
+    Only admitted events are counted against the windows.
+    """
+    steps = rate_limit_steps(event, now)
+    return get_counter_backend().run(steps).failed is not None
 
 # -------------------------------------------------------------------
-# Dynamic rule evaluation stub (reads RuleConfig model)
+# Dynamic rule evaluation (reads the compiled RuleConfig snapshot)
 # -------------------------------------------------------------------
-from rules.models import RuleConfig
-import datetime as dt
-
-def evaluate_rules(event):
-    """Placeholder for rule engine.
-    Returns a tuple (action, description) where action is one of
-    'NOW', 'LATER', 'NEVER' or None if no rule matches.
+def match_rules(event, snapshot=None, now=None, evaluated=None):
+    """Evaluate the rules that need no cache access.
+    Returns (action, description, cap_step). When no local rule decides the
+    event, ``cap_step`` is the marketing-cap CounterStep still to be checked
+    (or None if the cap does not apply). If ``evaluated`` is a list, the key
+    of every rule checked is appended to it, the matching one last.
     """
-    now = datetime.utcnow()
-    action, description = None, None
+    now = now or get_clock().now(event)
+    if snapshot is None:
+        snapshot = get_rule_snapshot()
+    applicable = snapshot.keys_for(event.event_type)
+    seconds = epoch(now)
 
     # 1️⃣ Rule: System Alerts Bypass
-    if event.event_type == 'system_alert' and event.priority_hint == 'high':
-        # Check if the routing rule exists and allows bypass
-        rule_qs = RuleConfig.objects.filter(key='system_alert_routing').first()
-        if rule_qs and rule_qs.value.get('always_now'):
-            return "NOW", "Critical system alert forced immediate delivery (Rule Bypass)"
+    if 'system_alert_routing' in applicable and event.priority_hint == 'high':
+        if evaluated is not None:
+            evaluated.append('system_alert_routing')
+        # Check if the routing rule allows bypass
+        if snapshot.get('system_alert_routing').get('always_now'):
+            return "NOW", "Critical system alert forced immediate delivery (Rule Bypass)", None
 
     # 2️⃣ Rule: Quiet Hours (e.g., Suppress promotions during night)
-    rule_qh = RuleConfig.objects.filter(key='quiet_hours').first()
-    if rule_qh:
-        start_str = rule_qh.value.get('start', '22:00')
-        end_str = rule_qh.value.get('end', '08:00')
-        start_time = dt.datetime.strptime(start_str, '%H:%M').time()
-        end_time = dt.datetime.strptime(end_str, '%H:%M').time()
-        
-        current_time = now.time()
-        in_quiet_time = False
-        
-        if start_time <= end_time:
-            in_quiet_time = start_time <= current_time <= end_time
-        else:
-            in_quiet_time = current_time >= start_time or current_time <= end_time
-            
-        if in_quiet_time and event.priority_hint != 'high':
+    quiet = snapshot.quiet_hours
+    if quiet and 'quiet_hours' in applicable:
+        if evaluated is not None:
+            evaluated.append('quiet_hours')
+        in_quiet = quiet.quiet_until(seconds, user_timezone(event, quiet.timezone)) is not None
+        if in_quiet and event.priority_hint != 'high':
             # Send to deferred queue instead of NEVER
-            return "LATER", f"Currently in quiet hours ({start_str} - {end_str}). Scheduled for Later."
+            return "LATER", f"Currently in quiet hours ({quiet.start_str} - {quiet.end_str}). Scheduled for Later.", None
 
     # 3️⃣ Rule: Daily Cap specifically for Marketing
-    if event.event_type == 'promotional':
-        rule_mx = RuleConfig.objects.filter(key='max_daily_marketing').first()
-        if rule_mx:
-            limit = rule_mx.value.get('limit', 2)
-            today = now.strftime('%Y-%m-%d')
-            marketing_key = f"market_cap:{event.user_id}:{today}"
-            
-            try:
-                count = cache.incr(marketing_key)
-            except ValueError:
-                cache.set(marketing_key, 1, timeout=86400)
-                count = 1
-                
-            if count > limit:
-                return "NEVER", f"Max daily marketing limit of {limit} reached."
-
-    return None, None
+    if 'max_daily_marketing' in applicable:
+        if evaluated is not None:
+            evaluated.append('max_daily_marketing')
+        limit = snapshot.get('max_daily_marketing').get('limit', 2)
+        # The user's local day, so late or replayed events count against
+        # the day they belong to; the TTL leaves room for late arrivals.
+        today = local_date(user_timezone(event, snapshot.timezone), seconds)
+        return None, None, CounterStep(LIMIT, f"market_cap:{event.user_id}:{today}", 2 * 86400, limit)
+
+    return None, None, None
+
+def cap_exceeded(step):
+    """Rule outcome for a marketing-cap step that failed."""
+    return "NEVER", f"Max daily marketing limit of {step.limit} reached."
+
+def evaluate_rules(event, snapshot=None, now=None):
+    """Placeholder for rule engine.
+    Returns a tuple (action, description) where action is one of
+    'NOW', 'LATER', 'NEVER' or None if no rule matches.
+    Rules come from the process-local RuleSnapshot, so no query is issued
+    unless the rules changed since the snapshot was built.
+    """
+    action, description, cap_step = match_rules(event, snapshot, now)
+    if cap_step is not None and get_counter_backend().run([cap_step]).failed is not None:
+        return cap_exceeded(cap_step)
+    return action, description
@@ -0,0 +1,26 @@
+from django.http import HttpResponse, JsonResponse
+from . import metrics
+from .ingest import get_ingest_queue
+
+
+def queue_stats(request):
+    """Depth and lag of the ingestion queue, per partition."""
+    queue = get_ingest_queue()
+    return JsonResponse({'enabled': queue is not None, **(queue.stats() if queue else {})})
+
+
+def metrics_view(request):
+    """This process's metrics in Prometheus text format."""
+    body = metrics.render()
+    queue = get_ingest_queue()
+    if queue is not None:
+        stats = queue.stats()
+        body += ('# HELP engine_queue_depth Events accepted but not yet decided.\n'
+                 '# TYPE engine_queue_depth gauge\n'
+                 + ''.join(f'engine_queue_depth{{partition="{p["partition"]}"}} {p["depth"]}\n'
+                           for p in stats['partitions'])
+                 + '# HELP engine_queue_lag_oldest_seconds Age of the oldest undecided event.\n'
+                 '# TYPE engine_queue_lag_oldest_seconds gauge\n'
+                 + ''.join(f'engine_queue_lag_oldest_seconds{{partition="{p["partition"]}"}} {p["lag_seconds"]}\n'
+                           for p in stats['partitions']))
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
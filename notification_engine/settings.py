@@ -21,6 +21,7 @@ INSTALLED_APPS = [
     'scheduler',
     'audit',
     'dashboard',
+    'delivery',
     'rest_framework',
 ]
 
@@ -57,6 +58,7 @@ TEMPLATES = [{
 }]
 
 WSGI_APPLICATION = 'notification_engine.wsgi.application'
+ASGI_APPLICATION = 'notification_engine.asgi.application'
 
 # PostgreSQL Database Configuration
 # Uses environment variables for production, falls back to SQLite for local development if not set.
@@ -76,6 +78,10 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Concurrent workers wait this long for the write lock.
+                'timeout': 20,
+            },
         }
     }
 
@@ -96,9 +102,127 @@ else:
         'default': {
             'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
             'LOCATION': 'unique-snowflake',
+            'OPTIONS': {
+                # Dedupe, LSH band and rate-window keys are per event/user;
+                # the 300-entry default would evict them almost immediately.
+                'MAX_ENTRIES': int(os.getenv('LOCMEM_MAX_ENTRIES', '100000')),
+            }
         }
     }
 
+# Seconds a process trusts its rule snapshot before checking the shared
+# generation counter again.
+RULES_SNAPSHOT_TTL = float(os.getenv('RULES_SNAPSHOT_TTL', '5'))
+# Batch endpoint limit, and rows per INSERT for bulk writes.
+ENGINE_MAX_BATCH_SIZE = int(os.getenv('ENGINE_MAX_BATCH_SIZE', '50000'))
+ENGINE_BULK_BATCH_SIZE = int(os.getenv('ENGINE_BULK_BATCH_SIZE', '1000'))
+
+# Decision audit trail: when enabled, DecisionRecords are buffered in memory
+# and written in batches by a background thread instead of inline.
+ENGINE_AUDIT_ASYNC = os.getenv('ENGINE_AUDIT_ASYNC', 'False') == 'True'
+ENGINE_AUDIT_BUFFER_SIZE = int(os.getenv('ENGINE_AUDIT_BUFFER_SIZE', '10000'))
+ENGINE_AUDIT_BATCH_SIZE = int(os.getenv('ENGINE_AUDIT_BATCH_SIZE', '500'))
+ENGINE_AUDIT_FLUSH_INTERVAL = float(os.getenv('ENGINE_AUDIT_FLUSH_INTERVAL', '1.0'))
+# Retries (with backoff) of a failed audit batch write before it is spilled
+# to a JSONL file here; load it back with ``manage.py load_audit_spill``.
+ENGINE_AUDIT_WRITE_RETRIES = int(os.getenv('ENGINE_AUDIT_WRITE_RETRIES', '3'))
+ENGINE_AUDIT_SPILL_DIR = os.getenv('ENGINE_AUDIT_SPILL_DIR', str(BASE_DIR / 'audit_spill'))
+# Store the rules evaluated and counter values seen with each decision.
+ENGINE_DECISION_TRACE = os.getenv('ENGINE_DECISION_TRACE', 'True') == 'True'
+# Dashboard rollups: records folded per compaction step, and how old a
+# record must be before it is folded (covers out-of-order commits).
+ROLLUP_BATCH_SIZE = int(os.getenv('ROLLUP_BATCH_SIZE', '50000'))
+ROLLUP_SETTLE_SECONDS = int(os.getenv('ROLLUP_SETTLE_SECONDS', '60'))
+# Retention: days each table is kept before its rows are archived to
+# gzip JSONL under RETENTION_ARCHIVE_DIR and deleted in chunks.
+RETENTION_EVENT_DAYS = int(os.getenv('RETENTION_EVENT_DAYS', '90'))
+RETENTION_DECISION_DAYS = int(os.getenv('RETENTION_DECISION_DAYS', '90'))
+RETENTION_DEFERRED_DAYS = int(os.getenv('RETENTION_DEFERRED_DAYS', '30'))
+RETENTION_DELIVERY_DAYS = int(os.getenv('RETENTION_DELIVERY_DAYS', '30'))
+RETENTION_CHUNK_SIZE = int(os.getenv('RETENTION_CHUNK_SIZE', '5000'))
+RETENTION_ARCHIVE_DIR = os.getenv('RETENTION_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+# Largest page the audit API returns, whatever ``limit`` asks for.
+AUDIT_PAGE_MAX = int(os.getenv('AUDIT_PAGE_MAX', '500'))
+# ``since`` polls only return records at least this old, so ids committed
+# out of order are not skipped. Must exceed the audit sink's write delay.
+AUDIT_SETTLE_SECONDS = int(os.getenv('AUDIT_SETTLE_SECONDS', '10'))
+# Dedupe fingerprints: 'fast' (compact 128-bit hash over the fields chosen by
+# the ``fingerprint`` rule), 'legacy' (SHA-256 over JSON, the old keys) or
+# 'dual' (both, for rolling upgrades from legacy).
+ENGINE_FINGERPRINT_MODE = os.getenv('ENGINE_FINGERPRINT_MODE', 'fast')
+# Per-stage timings and decision counters served at /engine/metrics/.
+ENGINE_METRICS = os.getenv('ENGINE_METRICS', 'True') == 'True'
+# 'system' decides on the wall clock, 'event' on NotificationEvent.timestamp.
+ENGINE_CLOCK = os.getenv('ENGINE_CLOCK', 'system')
+# Timezone for users whose events carry no metadata['timezone'].
+ENGINE_DEFAULT_TIMEZONE = os.getenv('ENGINE_DEFAULT_TIMEZONE', 'UTC')
+# Async (ASGI) evaluate path: threads (and so database connections) shared
+# by all in-flight requests for their writes, and Redis connections per
+# event loop for their counter calls.
+ENGINE_ASYNC_DB_THREADS = int(os.getenv('ENGINE_ASYNC_DB_THREADS', '8'))
+ENGINE_ASYNC_REDIS_CONNECTIONS = int(os.getenv('ENGINE_ASYNC_REDIS_CONNECTIONS', '50'))
+# Accept-fast ingestion: POST /api/events/ appends to an on-disk queue
+# partitioned by user and answers 202; ``manage.py drain_queue`` decides.
+ENGINE_QUEUE = os.getenv('ENGINE_QUEUE', 'False') == 'True'
+ENGINE_QUEUE_DIR = os.getenv('ENGINE_QUEUE_DIR', str(BASE_DIR / 'queue'))
+ENGINE_QUEUE_PARTITIONS = int(os.getenv('ENGINE_QUEUE_PARTITIONS', '16'))
+ENGINE_QUEUE_SEGMENT_BYTES = int(os.getenv('ENGINE_QUEUE_SEGMENT_BYTES', str(64 << 20)))
+ENGINE_QUEUE_BATCH_SIZE = int(os.getenv('ENGINE_QUEUE_BATCH_SIZE', '500'))
+# fsync every append (and offset commit); off trades durability for latency.
+ENGINE_QUEUE_FSYNC = os.getenv('ENGINE_QUEUE_FSYNC', 'True') == 'True'
+# Drain workers keep each partition's counters in their own memory instead
+# of the shared cache, snapshotting them to disk this often.
+ENGINE_QUEUE_LOCAL_STATE = os.getenv('ENGINE_QUEUE_LOCAL_STATE', 'False') == 'True'
+ENGINE_QUEUE_SNAPSHOT_SECONDS = int(os.getenv('ENGINE_QUEUE_SNAPSHOT_SECONDS', '30'))
+
+# Deferred-delivery scheduler: rows claimed per batch and how long a claim
+# is held before another worker may take the row over.
+SCHEDULER_BATCH_SIZE = int(os.getenv('SCHEDULER_BATCH_SIZE', '500'))
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', '60'))
+# A row whose decision keeps failing is retried with exponential backoff
+# from BASE to MAX seconds, and marked FAILED after MAX_RETRIES attempts.
+SCHEDULER_MAX_RETRIES = int(os.getenv('SCHEDULER_MAX_RETRIES', '3'))
+SCHEDULER_RETRY_BASE_SECONDS = float(os.getenv('SCHEDULER_RETRY_BASE_SECONDS', '30'))
+SCHEDULER_RETRY_MAX_SECONDS = float(os.getenv('SCHEDULER_RETRY_MAX_SECONDS', '900'))
+# Digests: rate-limited events are held for ENGINE_DIGEST_HOLD_SECONDS
+# instead of dropped, and the scheduler folds ENGINE_DIGEST_MIN_ITEMS or
+# more due rows of one user and channel into a single ``digest`` event.
+ENGINE_DIGEST = os.getenv('ENGINE_DIGEST', 'False') == 'True'
+ENGINE_DIGEST_MIN_ITEMS = int(os.getenv('ENGINE_DIGEST_MIN_ITEMS', '2'))
+ENGINE_DIGEST_HOLD_SECONDS = int(os.getenv('ENGINE_DIGEST_HOLD_SECONDS', '600'))
+
+# Delivery: NOW decisions on the live paths (API, ingest queue, released
+# deferred rows and digests; never replays) get a Delivery outbox row,
+# sent by ``manage.py deliver`` through the channel's backend. Backends are
+# configured like CACHES, and only for channels whose
+# DELIVERY_<CHANNEL>_BACKEND is set: rows for any other channel fail with
+# "no delivery backend" rather than being marked SENT by a fake.
+# delivery.backends.LocmemBackend is for tests and local runs.
+ENGINE_DELIVERY = os.getenv('ENGINE_DELIVERY', 'False') == 'True'
+DELIVERY_BACKENDS = {
+    channel: {
+        'BACKEND': os.getenv(f'DELIVERY_{channel.upper()}_BACKEND'),
+        # Calls in flight at once (and connections kept open) per worker.
+        'CONCURRENCY': int(os.getenv(f'DELIVERY_{channel.upper()}_CONCURRENCY', '4')),
+        'OPTIONS': {'URL': os.getenv(f'DELIVERY_{channel.upper()}_URL', ''),
+                    'TOKEN': os.getenv(f'DELIVERY_{channel.upper()}_TOKEN', '')},
+    }
+    for channel in ('email', 'sms', 'push')
+    if os.getenv(f'DELIVERY_{channel.upper()}_BACKEND')
+}
+# Rows claimed per batch, and the lease, which must outlast a batch's
+# slowest provider call.
+DELIVERY_BATCH_SIZE = int(os.getenv('DELIVERY_BATCH_SIZE', '1000'))
+DELIVERY_LEASE_SECONDS = int(os.getenv('DELIVERY_LEASE_SECONDS', '120'))
+# Retries back off exponentially from BASE to MAX seconds, with jitter.
+DELIVERY_MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', '5'))
+DELIVERY_RETRY_BASE_SECONDS = float(os.getenv('DELIVERY_RETRY_BASE_SECONDS', '5'))
+DELIVERY_RETRY_MAX_SECONDS = float(os.getenv('DELIVERY_RETRY_MAX_SECONDS', '900'))
+# Consecutive failed calls that open a channel's circuit, and seconds
+# before a probe call is let through.
+DELIVERY_BREAKER_THRESHOLD = int(os.getenv('DELIVERY_BREAKER_THRESHOLD', '5'))
+DELIVERY_BREAKER_RESET_SECONDS = float(os.getenv('DELIVERY_BREAKER_RESET_SECONDS', '30'))
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -0,0 +1,12 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import RuleConfig
+from .snapshot import invalidate_rule_snapshot
+
+
+@receiver(post_save, sender=RuleConfig)
+@receiver(post_delete, sender=RuleConfig)
+def rule_changed(sender, **kwargs):
+    # Wait for commit so no process rebuilds from the pre-change rows.
+    transaction.on_commit(invalidate_rule_snapshot)
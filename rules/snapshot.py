@@ -0,0 +1,304 @@
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+from types import MappingProxyType
+from django.conf import settings
+from django.core.cache import cache
+from engine.aio import run_db
+from engine.clock import get_zone
+
+GENERATION_KEY = 'rules:generation'
+
+# Rules that only make sense for particular event types. A RuleConfig can
+# override the scope by storing an ``event_types`` list in its value.
+DEFAULT_EVENT_TYPES = {
+    'system_alert_routing': ('system_alert',),
+    'max_daily_marketing': ('promotional',),
+}
+
+
+# Fallback when no ``rate_limits`` rule exists: the historical per-user caps
+# of 3 notifications per 10 minutes and 30 per day.
+DEFAULT_RATE_LIMITS = {
+    'default': [{'window': 600, 'limit': 3}, {'window': 86400, 'limit': 30}],
+}
+
+# One sliding window. ``scope`` is 'user', 'channel' or 'event_type' and
+# decides which counter the window is keyed on.
+RateWindow = namedtuple('RateWindow', 'scope seconds limit buckets bucket_seconds')
+
+
+def _compile_windows(scope, specs, buckets):
+    windows = []
+    for spec in specs:
+        seconds = int(spec['window'])
+        n = max(1, min(int(spec.get('buckets', buckets)), seconds))
+        windows.append(RateWindow(scope, seconds, int(spec['limit']), n, seconds // n))
+    return tuple(windows)
+
+
+class RateLimits:
+    """Compiled ``rate_limits`` rule.
+
+    Value format::
+
+        {"buckets": 10,
+         "default": [{"window": 600, "limit": 3}, ...],
+         "channels": {"sms": [{"window": 3600, "limit": 5}]},
+         "event_types": {"promotional": [{"window": 86400, "limit": 2}]}}
+
+    Default windows count everything sent to a user; channel and event_type
+    windows count only that slice. All matching windows apply together.
+    """
+    __slots__ = ('default', 'channels', 'event_types', '_resolved')
+
+    def __init__(self, value):
+        buckets = int(value.get('buckets', 10))
+        self.default = _compile_windows('user', value.get('default', ()), buckets)
+        self.channels = {ch: _compile_windows('channel', specs, buckets)
+                         for ch, specs in value.get('channels', {}).items()}
+        self.event_types = {et: _compile_windows('event_type', specs, buckets)
+                            for et, specs in value.get('event_types', {}).items()}
+        self._resolved = {}
+
+    def windows(self, channel, event_type):
+        key = (channel, event_type)
+        windows = self._resolved.get(key)
+        if windows is None:
+            windows = self.default + self.channels.get(channel, ()) + self.event_types.get(event_type, ())
+            self._resolved[key] = windows
+        return windows
+
+
+# Near-duplicate settings; overridden by a ``near_duplicate`` rule such as
+# {"threshold": 0.85, "recent_seconds": 300, "enabled": true}.
+NearDuplicate = namedtuple('NearDuplicate', 'threshold recent_seconds')
+DEFAULT_NEAR_DUPLICATE = NearDuplicate(0.85, 300)
+
+
+# Fields that identify an event for exact-duplicate detection; overridden by
+# a ``fingerprint`` rule such as
+# {"fields": ["user_id", "event_type", "title", "source", "metadata"],
+#  "exclude_metadata": ["cpu_percent"],
+#  "per_event_type": {"system_alert": {"fields": ["user_id", "title", "metadata.host"]}}}.
+# ``metadata`` is True (every key), a tuple of keys, or False.
+FingerprintSpec = namedtuple('FingerprintSpec', 'fields metadata exclude_metadata')
+DEFAULT_FINGERPRINT_FIELDS = ('user_id', 'event_type', 'title', 'source', 'metadata')
+
+
+def _compile_fingerprint(value, base=None):
+    fields, metadata = [], False
+    for name in value.get('fields', DEFAULT_FINGERPRINT_FIELDS if base is None else ()):
+        if name == 'metadata':
+            metadata = True
+        elif name.startswith('metadata.'):
+            if metadata is not True:
+                metadata = (metadata or ()) + (name[len('metadata.'):],)
+        else:
+            fields.append(name)
+    if base is not None and 'fields' not in value:
+        fields, metadata = list(base.fields), base.metadata
+    exclude = value.get('exclude_metadata', base.exclude_metadata if base is not None else ())
+    return FingerprintSpec(tuple(fields), tuple(sorted(metadata)) if isinstance(metadata, tuple) else metadata,
+                           frozenset(exclude))
+
+
+class QuietHours:
+    """Daily quiet window, interpreted in each user's local time.
+
+    ``timezone`` applies to users whose events carry no valid timezone. The
+    window's UTC boundaries are computed once per (zone, UTC day) and cached,
+    so checking an event is a couple of float comparisons.
+    """
+    __slots__ = ('start', 'end', 'start_str', 'end_str', 'timezone', '_intervals')
+
+    def __init__(self, start_str, end_str, timezone='UTC'):
+        self.start_str = start_str
+        self.end_str = end_str
+        self.start = datetime.strptime(start_str, '%H:%M').time()
+        self.end = datetime.strptime(end_str, '%H:%M').time()
+        self.timezone = timezone if get_zone(timezone) is not None else 'UTC'
+        self._intervals = {}
+
+    def contains(self, current_time):
+        if self.start <= self.end:
+            return self.start <= current_time <= self.end
+        return current_time >= self.start or current_time <= self.end
+
+    def intervals(self, zone_name, utc_day):
+        """Quiet periods overlapping UTC day ``utc_day`` as (start, end)
+        epoch pairs, both ends inclusive.
+        """
+        key = (zone_name, utc_day)
+        found = self._intervals.get(key)
+        if found is None:
+            zone = get_zone(zone_name)
+            first = datetime.fromtimestamp(utc_day * 86400, zone).date()
+            overnight = self.start > self.end
+            found = []
+            for offset in range(-2, 2):
+                day = first + timedelta(days=offset)
+                start = datetime.combine(day, self.start, tzinfo=zone).timestamp()
+                end = datetime.combine(day + timedelta(days=overnight), self.end, tzinfo=zone).timestamp()
+                if end >= utc_day * 86400 and start < (utc_day + 1) * 86400:
+                    found.append((start, end))
+            found = tuple(found)
+            if len(self._intervals) >= 65536:
+                self._intervals.clear()
+            self._intervals[key] = found
+        return found
+
+    def quiet_until(self, seconds, zone_name=None):
+        """Epoch second at which the quiet window containing ``seconds`` is
+        over, or None if ``seconds`` is outside quiet hours.
+        """
+        for start, end in self.intervals(zone_name or self.timezone, int(seconds // 86400)):
+            if start <= seconds <= end:
+                return end + 1
+        return None
+
+    def release_after(self, now, zone_name=None):
+        """First second after ``now`` (naive UTC) at which the quiet window is over."""
+        zone_name = zone_name or self.timezone
+        seconds = now.replace(tzinfo=dt_timezone.utc).timestamp()
+        day = int(seconds // 86400)
+        for utc_day in (day, day + 1, day + 2):
+            for start, end in self.intervals(zone_name, utc_day):
+                if end + 1 > seconds:
+                    return datetime.utcfromtimestamp(end + 1)
+        return now + timedelta(days=1)
+
+
+class RuleSnapshot:
+    """Immutable, pre-parsed view of every RuleConfig row.
+
+    Built once per rules generation; evaluating an event against it needs no
+    database access.
+    """
+    __slots__ = ('version', 'values', 'timezone', 'quiet_hours', 'rate_limits', 'near_duplicate',
+                 'fingerprint', '_fingerprints', '_global', '_scoped', '_by_event_type')
+
+    def __init__(self, version, rows):
+        self.version = version
+        values, global_keys, scoped = {}, [], {}
+        for key, value in rows:
+            values[key] = MappingProxyType(dict(value or {}))
+            event_types = (value or {}).get('event_types', DEFAULT_EVENT_TYPES.get(key))
+            if isinstance(event_types, (list, tuple)) and event_types:
+                for event_type in event_types:
+                    scoped.setdefault(event_type, []).append(key)
+            else:
+                global_keys.append(key)
+        self.values = MappingProxyType(values)
+        self._global = frozenset(global_keys)
+        self._scoped = {et: frozenset(keys) for et, keys in scoped.items()}
+        self._by_event_type = {}
+
+        # Zone for users whose events do not say which timezone they are in.
+        self.timezone = getattr(settings, 'ENGINE_DEFAULT_TIMEZONE', 'UTC')
+        qh = values.get('quiet_hours')
+        self.quiet_hours = QuietHours(qh.get('start', '22:00'), qh.get('end', '08:00'),
+                                      qh.get('timezone', self.timezone)) if qh is not None else None
+        self.rate_limits = RateLimits(values.get('rate_limits') or DEFAULT_RATE_LIMITS)
+
+        fp = values.get('fingerprint') or {}
+        self.fingerprint = _compile_fingerprint(fp)
+        self._fingerprints = {et: _compile_fingerprint(spec, self.fingerprint)
+                              for et, spec in fp.get('per_event_type', {}).items()}
+
+        nd = values.get('near_duplicate')
+        if nd is None:
+            self.near_duplicate = DEFAULT_NEAR_DUPLICATE
+        elif nd.get('enabled', True):
+            self.near_duplicate = NearDuplicate(float(nd.get('threshold', DEFAULT_NEAR_DUPLICATE.threshold)),
+                                                int(nd.get('recent_seconds', DEFAULT_NEAR_DUPLICATE.recent_seconds)))
+        else:
+            self.near_duplicate = None
+
+    def get(self, key):
+        """Return the (read-only) value of rule ``key`` or None."""
+        return self.values.get(key)
+
+    def rate_windows(self, channel, event_type):
+        """Return the RateWindows that apply to a channel/event_type pair."""
+        return self.rate_limits.windows(channel, event_type)
+
+    def near_duplicate_for(self, event_type):
+        """Return the NearDuplicate settings for ``event_type`` or None."""
+        if self.near_duplicate is None:
+            return None
+        if 'near_duplicate' in self.values and 'near_duplicate' not in self.keys_for(event_type):
+            return None
+        return self.near_duplicate
+
+    def fingerprint_for(self, event_type):
+        """Return the FingerprintSpec used for ``event_type``."""
+        return self._fingerprints.get(event_type, self.fingerprint)
+
+    def keys_for(self, event_type):
+        """Return the set of rule keys that apply to ``event_type``."""
+        keys = self._by_event_type.get(event_type)
+        if keys is None:
+            keys = self._global | self._scoped.get(event_type, frozenset())
+            self._by_event_type[event_type] = keys
+        return keys
+
+
+_lock = threading.Lock()
+_snapshot = None
+_checked_at = 0.0
+
+
+def current_generation():
+    return cache.get(GENERATION_KEY, 0)
+
+
+def build_snapshot(version=None):
+    """Load every RuleConfig row and compile it into a RuleSnapshot."""
+    from .models import RuleConfig
+    if version is None:
+        version = current_generation()
+    rows = RuleConfig.objects.values_list('key', 'value')
+    return RuleSnapshot(version, rows)
+
+
+def get_rule_snapshot():
+    """Return the process-local RuleSnapshot, rebuilding it if stale.
+
+    The shared generation counter is consulted at most once every
+    ``RULES_SNAPSHOT_TTL`` seconds; local saves invalidate immediately.
+    """
+    global _snapshot, _checked_at
+    snapshot = _snapshot
+    now = time.monotonic()
+    if snapshot is not None and now - _checked_at < getattr(settings, 'RULES_SNAPSHOT_TTL', 5):
+        return snapshot
+    with _lock:
+        generation = current_generation()
+        if _snapshot is None or _snapshot.version != generation:
+            _snapshot = build_snapshot(generation)
+        _checked_at = now
+        return _snapshot
+
+
+async def aget_rule_snapshot():
+    """get_rule_snapshot for coroutines.
+
+    A fresh snapshot is returned without leaving the event loop; only a
+    generation check or rebuild goes to the database pool.
+    """
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - _checked_at < getattr(settings, 'RULES_SNAPSHOT_TTL', 5):
+        return snapshot
+    return await run_db(get_rule_snapshot)
+
+
+def invalidate_rule_snapshot():
+    """Bump the shared generation and drop this process's snapshot."""
+    global _snapshot
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 1, timeout=None)
+    _snapshot = None
@@ -0,0 +1,60 @@
+from datetime import time
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from api.models import NotificationEvent
+from engine.utils import evaluate_rules
+from .models import RuleConfig
+from .snapshot import GENERATION_KEY, RuleSnapshot, get_rule_snapshot, invalidate_rule_snapshot
+
+
+class RuleSnapshotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        invalidate_rule_snapshot()
+
+    def save_rule(self, key, value):
+        # The signal invalidates on commit, which TestCase never reaches.
+        with self.captureOnCommitCallbacks(execute=True):
+            RuleConfig.objects.update_or_create(key=key, defaults={'value': value})
+
+    def test_rules_are_compiled_once(self):
+        snapshot = RuleSnapshot(1, [
+            ('quiet_hours', {'start': '22:00', 'end': '08:00'}),
+            ('max_daily_marketing', {'limit': 2}),
+            ('system_alert_routing', {'always_now': True, 'event_types': ['system_alert', 'security']}),
+        ])
+        self.assertEqual((snapshot.quiet_hours.start, snapshot.quiet_hours.end), (time(22, 0), time(8, 0)))
+        self.assertTrue(snapshot.quiet_hours.contains(time(23, 30)))
+        self.assertFalse(snapshot.quiet_hours.contains(time(12, 0)))
+        self.assertEqual(snapshot.keys_for('promotional'), {'quiet_hours', 'max_daily_marketing'})
+        self.assertEqual(snapshot.keys_for('security'), {'quiet_hours', 'system_alert_routing'})
+        with self.assertRaises(TypeError):
+            snapshot.get('max_daily_marketing')['limit'] = 3
+
+    def test_decisions_issue_no_queries(self):
+        self.save_rule('system_alert_routing', {'always_now': True})
+        event = NotificationEvent(user_id='u1', event_type='system_alert', title='Disk full', channel='push',
+                                  priority_hint='high', timestamp=timezone.now())
+        get_rule_snapshot()
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                self.assertEqual(evaluate_rules(event)[0], 'NOW')
+
+    def test_saving_a_rule_invalidates_the_snapshot(self):
+        before = get_rule_snapshot()
+        self.assertIsNone(before.get('max_daily_marketing'))
+        self.save_rule('max_daily_marketing', {'limit': 5})
+        after = get_rule_snapshot()
+        self.assertGreater(after.version, before.version)
+        self.assertEqual(after.get('max_daily_marketing')['limit'], 5)
+        self.assertIs(get_rule_snapshot(), after)
+
+    @override_settings(RULES_SNAPSHOT_TTL=0)
+    def test_other_processes_notice_a_new_generation(self):
+        snapshot = get_rule_snapshot()
+        RuleConfig.objects.create(key='max_daily_marketing', value={'limit': 5})
+        # What another process's invalidate_rule_snapshot leaves behind.
+        cache.incr(GENERATION_KEY)
+        self.assertEqual(get_rule_snapshot().get('max_daily_marketing')['limit'], 5)
+        self.assertIsNone(snapshot.get('max_daily_marketing'))
@@ -0,0 +1,81 @@
+"""Coalescing of released deferred notifications into digests.
+
+With ENGINE_DIGEST on, the scheduler groups each claimed batch of due rows
+by (user, channel). A group of at least ENGINE_DIGEST_MIN_ITEMS rows is
+replaced by a single ``digest`` NotificationEvent listing the items: the
+digest is decided (and sent) once and the rows are marked DIGESTED, instead
+of re-deciding and sending every one of them. Events held back by rate
+limits (see engine.services) reach the scheduler the same way as those
+deferred for quiet hours.
+"""
+import logging
+from collections import Counter
+from django.conf import settings
+from api.models import NotificationEvent
+from engine.clock import SystemClock
+from engine.services import record_decisions
+
+logger = logging.getLogger(__name__)
+
+DIGEST_EVENT_TYPE = 'digest'
+
+
+def build_digest(group, now):
+    """Unsaved digest event for a list of DeferredNotifications of one user
+    and channel. Items that are themselves digests are flattened.
+    """
+    items, event_types = [], Counter()
+    for defer in group:
+        event = defer.event
+        metadata = event.metadata if isinstance(event.metadata, dict) else {}
+        if event.event_type == DIGEST_EVENT_TYPE and 'items' in metadata:
+            items.extend(metadata['items'])
+            event_types.update(metadata.get('event_types', {}))
+        else:
+            items.append(event.id)
+            event_types[event.event_type] += 1
+    first = group[0].event
+    metadata = {'items': items, 'items_included': len(items), 'event_types': dict(event_types)}
+    if isinstance(first.metadata, dict) and first.metadata.get('timezone'):
+        metadata['timezone'] = first.metadata['timezone']
+    return NotificationEvent(
+        user_id=first.user_id,
+        event_type=DIGEST_EVENT_TYPE,
+        title=f'{len(items)} new notifications',
+        source='digest',
+        priority_hint='low',
+        timestamp=now,
+        channel=first.channel,
+        metadata=metadata,
+    )
+
+
+def coalesce(rows, now):
+    """Fold groups of ``rows`` into digests.
+
+    Returns (remaining, digested): the rows still to be decided one by one,
+    and the rows now marked DIGESTED (in memory; the caller saves them).
+    The digests are created with one bulk insert and decided in one batch;
+    a digest that is itself held back gets its own DeferredNotification.
+    """
+    min_items = getattr(settings, 'ENGINE_DIGEST_MIN_ITEMS', 2)
+    groups = {}
+    for defer in rows:
+        groups.setdefault((defer.event.user_id, defer.event.channel), []).append(defer)
+    folded = [group for group in groups.values() if len(group) >= min_items]
+    if not folded:
+        return rows, []
+
+    digests = NotificationEvent.objects.bulk_create([build_digest(group, now) for group in folded])
+    # Items were deduped on arrival; the digest itself is new by construction.
+    decisions = record_decisions(digests, dedupe=False, clock=SystemClock(), deliver=True)
+    digested = []
+    for digest, decision, group in zip(digests, decisions, folded):
+        for defer in group:
+            defer.status = 'DIGESTED'
+            defer.digest = digest
+        digested.extend(group)
+        logger.info(f'Digest {digest.id} for {digest.user_id}/{digest.channel}: '
+                    f'{len(group)} deferred -> {decision.classification}')
+    remaining = [defer for defer in rows if defer.status != 'DIGESTED']
+    return remaining, digested
@@ -0,0 +1,11 @@
+from engine.management.workers import WorkerCommand
+from scheduler.tasks import process_due_deferred
+
+
+class Command(WorkerCommand):
+    help = 'Process due deferred notifications in leased batches.'
+    default_interval = 5.0
+    report = '{worker_id}: processed {count} deferred notifications'
+
+    def drain(self, resource, worker_id, options):
+        return process_due_deferred(options['batch_size'], worker_id, options['lease_seconds'])
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_event_indexes'),
+        ('scheduler', '0002_deferred_lease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='deferrednotification',
+            index=models.Index(condition=models.Q(('status', 'PENDING')), fields=['scheduled_for'], name='deferred_pending_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='deferrednotification',
+            index=models.Index(condition=models.Q(('claimed_by__isnull', False)), fields=['claimed_by'], name='deferred_claimed_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_event_indexes'),
+        ('scheduler', '0003_deferred_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deferrednotification',
+            name='digest',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='digested', to='api.notificationevent'),
+        ),
+        migrations.AlterField(
+            model_name='deferrednotification',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('EXPIRED', 'Expired'), ('DELIVERED', 'Delivered'), ('DROPPED', 'Dropped'), ('DIGESTED', 'Digested')], default='PENDING', max_length=10),
+        ),
+    ]
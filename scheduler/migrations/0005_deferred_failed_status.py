@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0004_deferred_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='deferrednotification',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('EXPIRED', 'Expired'), ('DELIVERED', 'Delivered'), ('DROPPED', 'Dropped'), ('DIGESTED', 'Digested'), ('FAILED', 'Failed')], default='PENDING', max_length=10),
+        ),
+    ]
@@ -1,5 +1,4 @@
 from django.db import models
-from django.utils import timezone
 from api.models import NotificationEvent
 
 class DeferredNotification(models.Model):
@@ -8,12 +7,31 @@ class DeferredNotification(models.Model):
         ('EXPIRED', 'Expired'),
         ('DELIVERED', 'Delivered'),
         ('DROPPED', 'Dropped'),
+        ('DIGESTED', 'Digested'),
+        ('FAILED', 'Failed'),
     ]
 
     event = models.ForeignKey(NotificationEvent, on_delete=models.CASCADE, related_name='deferred')
     scheduled_for = models.DateTimeField()
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
     retry_count = models.PositiveIntegerField(default=0)
+    # Lease held by the scheduler worker currently processing the row.
+    claimed_by = models.CharField(max_length=64, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    # The ``digest`` event this row was folded into (status DIGESTED).
+    digest = models.ForeignKey(NotificationEvent, on_delete=models.SET_NULL, blank=True, null=True,
+                               related_name='digested')
+
+    class Meta:
+        indexes = [
+            # Scheduler claims and the deferred dashboard only ever look at
+            # PENDING rows ordered by due time; the partial index stays as
+            # small as the live queue however many rows have been delivered.
+            models.Index(fields=['scheduled_for'], name='deferred_pending_due_idx',
+                         condition=models.Q(status='PENDING')),
+            models.Index(fields=['claimed_by'], name='deferred_claimed_idx',
+                         condition=models.Q(claimed_by__isnull=False)),
+        ]
 
     def __str__(self):
         return f'Deferred {self.event.id} - {self.scheduled_for} [{self.status}]'
@@ -1,29 +1,221 @@
+import copy
 import logging
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
 from django.utils import timezone
+from .digest import coalesce
 from .models import DeferredNotification
-from engine.services import decide_notification
+from engine import leasing, metrics
+from engine.clock import SystemClock
+from engine.leasing import make_worker_id, release as _release
+from engine.services import record_decisions
 
 logger = logging.getLogger(__name__)
 
-def process_due_deferred():
+UPDATE_FIELDS = ['status', 'scheduled_for', 'retry_count', 'claimed_by', 'lease_expires_at', 'digest']
+
+
+class LeaseLost(Exception):
+    """The worker's lease on a row ran out and another worker may own it."""
+
+
+def claim_due(worker_id, batch_size=500, lease_seconds=60, now=None):
+    """Lease up to ``batch_size`` due rows to ``worker_id`` and return them
+    (see engine.leasing).
+    """
+    return leasing.claim_due(DeferredNotification, 'scheduled_for', worker_id, batch_size, lease_seconds, now,
+                             related=('event',))
+
+
+def process_due_deferred(batch_size=None, worker_id=None, lease_seconds=None):
+    """Drain every due deferred notification in leased batches.
+
+    Safe to run from several processes at once. Returns the number of rows
+    processed.
+    """
+    batch_size = batch_size or getattr(settings, 'SCHEDULER_BATCH_SIZE', 500)
+    lease_seconds = lease_seconds or getattr(settings, 'SCHEDULER_LEASE_SECONDS', 60)
+    worker_id = worker_id or make_worker_id()
+    processed = 0
+    while True:
+        batch = claim_due(worker_id, batch_size, lease_seconds)
+        if not batch:
+            return processed
+        started = time.perf_counter()
+        _process_batch(batch, worker_id)
+        if metrics.enabled():
+            metrics.SCHEDULER_BATCH_SECONDS.observe(time.perf_counter() - started)
+            for defer in batch:
+                metrics.SCHEDULER_ROWS.inc(defer.status)
+        processed += len(batch)
+
+
+def _process_batch(batch, worker_id):
+    """Decide a batch claimed by ``worker_id`` and save the outcome.
+
+    Decisions are applied to copies of the rows, which are copied back only
+    once saved, so a failed batch leaves the rows as claimed for the
+    row-by-row retry. Every write is conditional on the lease still being
+    held: a worker whose lease ran out rolls back and leaves the rows to
+    whoever claimed them next.
+    """
     now = timezone.now()
-    due = DeferredNotification.objects.filter(status='PENDING', scheduled_for__lte=now)
-    for defer in due:
+    live, expired = [], []
+    for defer in batch:
+        if defer.event.expires_at and defer.event.expires_at <= now:
+            row = copy.copy(defer)
+            row.status = 'EXPIRED'
+            _release(row)
+            expired.append((defer, row))
+        else:
+            live.append(defer)
+    try:
+        if expired:
+            # Saved on their own, so a failing batch below cannot leave them leased.
+            with _write_transaction():
+                _save([row for _, row in expired], worker_id)
+            for defer, row in expired:
+                _copy_back(row, defer)
+                logger.info(f'Expired deferred event {defer.event_id}')
+        if live and getattr(settings, 'ENGINE_DIGEST', False):
+            live = _digest(live, now, worker_id)
+        if not live:
+            return
         try:
-            classification, explanation = decide_notification(defer.event)
-            if classification == 'NOW':
-                defer.status = 'DELIVERED'
-                logger.info(f'Delivered deferred event {defer.event.id}')
-            elif classification == 'NEVER':
-                defer.status = 'DROPPED'
-                logger.info(f'Dropped deferred event {defer.event.id}')
-            else:
-                defer.scheduled_for = now + timezone.timedelta(minutes=5)
-                defer.retry_count += 1
-                logger.info(f'Rescheduled deferred event {defer.event.id}')
-            defer.save()
+            with _write_transaction():
+                # Released events are judged on the wall clock: under an
+                # event clock they would stay inside quiet hours forever.
+                decisions = record_decisions([defer.event for defer in live], schedule_later=False,
+                                             dedupe=False, clock=SystemClock(), deliver=True)
+                rows = [_apply(copy.copy(defer), decision, now) for defer, decision in zip(live, decisions)]
+                _save(rows, worker_id)
+        except LeaseLost:
+            raise
         except Exception as exc:
-            logger.exception(f'Error processing deferred {defer.id}: {exc}')
-            if defer.retry_count >= 3:
-                defer.status = 'EXPIRED'
-                defer.save()
+            logger.exception(f'Batch of {len(live)} deferred failed, retrying row by row: {exc}')
+            for defer in live:
+                _process_one(defer, now, worker_id)
+            return
+        for defer, row in zip(live, rows):
+            _copy_back(row, defer)
+    except LeaseLost as exc:
+        logger.warning(f'Worker {worker_id} lost its lease, leaving the rest of the batch: {exc}')
+
+
+def _digest(rows, now, worker_id):
+    """Fold ``rows`` into digests and save the folded rows together with
+    their digests; returns the rows still to be decided. If that fails, no
+    digest exists and every row is returned to be decided on its own.
+    """
+    copies = [copy.copy(defer) for defer in rows]
+    try:
+        with _write_transaction():
+            _, digested = coalesce(copies, now)
+            for row in digested:
+                _release(row)
+            _save(digested, worker_id)
+    except LeaseLost:
+        raise
+    except Exception as exc:
+        logger.exception(f'Digest of {len(rows)} deferred failed, deciding them one by one: {exc}')
+        return rows
+    for defer, row in zip(rows, copies):
+        _copy_back(row, defer)
+    return [defer for defer in rows if defer.status != 'DIGESTED']
+
+
+def _process_one(defer, now, worker_id):
+    row = copy.copy(defer)
+    try:
+        with _write_transaction():
+            decision, = record_decisions([defer.event], schedule_later=False, dedupe=False,
+                                         clock=SystemClock(), deliver=True)
+            _save([_apply(row, decision, now)], worker_id)
+    except LeaseLost:
+        raise
+    except Exception as exc:
+        logger.exception(f'Error processing deferred {defer.id}: {exc}')
+        row = copy.copy(defer)
+        _fail(row, now)
+        _save([row], worker_id)
+    _copy_back(row, defer)
+
+
+def _fail(defer, now):
+    """Back a row off after a failed decision, or give up on it.
+
+    Pushing ``scheduled_for`` out keeps the row from being claimed again
+    straight away, so one bad row cannot spin the scheduler loop.
+    """
+    defer.retry_count += 1
+    if defer.retry_count > getattr(settings, 'SCHEDULER_MAX_RETRIES', 3):
+        defer.status = 'FAILED'
+        logger.warning(f'Deferred {defer.id} failed after {defer.retry_count - 1} retries')
+    else:
+        delay = min(getattr(settings, 'SCHEDULER_RETRY_MAX_SECONDS', 900),
+                    getattr(settings, 'SCHEDULER_RETRY_BASE_SECONDS', 30) * 2 ** (defer.retry_count - 1))
+        defer.scheduled_for = now + timedelta(seconds=delay)
+    _release(defer)
+
+
+def _apply(defer, decision, now):
+    if decision.classification == 'NOW':
+        # Sent by the delivery dispatcher when ENGINE_DELIVERY is on: the
+        # decision above created its Delivery row.
+        defer.status = 'DELIVERED'
+        logger.info(f'Released deferred event {defer.event_id} for delivery')
+    elif decision.classification == 'NEVER':
+        defer.status = 'DROPPED'
+        logger.info(f'Dropped deferred event {defer.event_id}')
+    else:
+        # Still held back: wait for the rule's release time rather than polling.
+        defer.scheduled_for = decision.release_at or now + timedelta(minutes=5)
+        defer.retry_count += 1
+        logger.info(f'Rescheduled deferred event {defer.event_id} for {defer.scheduled_for}')
+    _release(defer)
+    return defer
+
+
+@contextmanager
+def _write_transaction():
+    """transaction.atomic() that takes SQLite's write lock at BEGIN.
+
+    A batch reads (the rule snapshot) before it writes, and a deferred
+    SQLite transaction that has to upgrade its lock while another worker
+    writes fails at once instead of waiting out the busy timeout. Other
+    databases lock per row and get a plain atomic block.
+    """
+    if connection.vendor != 'sqlite' or connection.in_atomic_block:
+        with transaction.atomic():
+            yield
+        return
+    connection.ensure_connection()
+    mode, connection.transaction_mode = connection.transaction_mode, 'IMMEDIATE'
+    try:
+        with transaction.atomic():
+            # BEGIN has been issued; nested blocks are savepoints.
+            connection.transaction_mode = mode
+            yield
+    finally:
+        connection.transaction_mode = mode
+
+
+def _save(rows, worker_id):
+    """bulk_update ``rows`` where ``worker_id`` still holds an unexpired
+    lease; raises LeaseLost (rolling back the enclosing transaction) if any
+    row was not written.
+    """
+    if not rows:
+        return
+    saved = leasing.leased(DeferredNotification, worker_id).bulk_update(rows, UPDATE_FIELDS)
+    if saved != len(rows):
+        raise LeaseLost(f'{len(rows) - saved} of {len(rows)} rows are no longer leased to {worker_id}')
+
+
+def _copy_back(row, defer):
+    for field in UPDATE_FIELDS:
+        setattr(defer, field, getattr(row, field))
+
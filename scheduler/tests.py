@@ -0,0 +1,193 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from api.models import NotificationEvent
+from audit.models import DecisionRecord
+from engine.clock import FixedClock
+from engine.services import decide_notification
+from rules.models import RuleConfig
+from rules.snapshot import invalidate_rule_snapshot
+from .digest import DIGEST_EVENT_TYPE
+from . import tasks
+from .models import DeferredNotification
+from .tasks import _process_batch, claim_due, process_due_deferred
+
+NIGHT = datetime(2026, 1, 5, 23, 0, tzinfo=dt_timezone.utc)
+NOON = datetime(2026, 1, 5, 12, 0, tzinfo=dt_timezone.utc)
+TITLES = ['Your invoice is ready', 'Password changed on a new device', 'Weekly team digest',
+          'Build 4821 failed on main']
+
+
+class SchedulerTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        RuleConfig.objects.create(key='quiet_hours', value={'start': '22:00', 'end': '08:00'})
+        invalidate_rule_snapshot()
+
+    def defer(self, title, user_id='u1', scheduled_for=None, expires_at=None):
+        event = NotificationEvent.objects.create(user_id=user_id, event_type='update', title=title,
+                                                 channel='push', timestamp=timezone.now(), expires_at=expires_at)
+        return DeferredNotification.objects.create(
+            event=event, scheduled_for=scheduled_for or timezone.now() - timedelta(minutes=1))
+
+    def process(self, when):
+        """Claim and process one batch, deciding as of ``when``."""
+        clock = mock.Mock(return_value=FixedClock(when))
+        with mock.patch('scheduler.tasks.SystemClock', clock), mock.patch('scheduler.digest.SystemClock', clock):
+            batch = claim_due('test-worker')
+            _process_batch(batch, 'test-worker')
+        return batch
+
+    def status(self, defer):
+        defer.refresh_from_db()
+        return defer.status
+
+
+class ClaimTests(SchedulerTestCase):
+    def test_workers_claim_disjoint_batches(self):
+        rows = [self.defer(title) for title in TITLES[:3]]
+        first = claim_due('w1', batch_size=2)
+        second = claim_due('w2', batch_size=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual({d.id for d in first} | {d.id for d in second}, {d.id for d in rows})
+        self.assertEqual(claim_due('w3'), [])
+
+    def test_only_due_rows_are_claimed(self):
+        self.defer(TITLES[0], scheduled_for=timezone.now() + timedelta(minutes=5))
+        self.assertEqual(claim_due('w1'), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        defer = self.defer(TITLES[0])
+        now = timezone.now()
+        self.assertEqual(len(claim_due('w1', lease_seconds=60, now=now)), 1)
+        self.assertEqual(claim_due('w2', now=now + timedelta(seconds=30)), [])
+        self.assertEqual([d.id for d in claim_due('w2', now=now + timedelta(seconds=61))], [defer.id])
+
+    def test_command_drains_the_queue(self):
+        rows = [self.defer(title) for title in TITLES[:2]]
+        out = StringIO()
+        with mock.patch('scheduler.tasks.SystemClock', mock.Mock(return_value=FixedClock(NOON))):
+            call_command('process_deferred', '--batch-size', '1', stdout=out)
+        self.assertRegex(out.getvalue(), r': processed 2 deferred notifications')
+        self.assertEqual({self.status(defer) for defer in rows}, {'DELIVERED'})
+
+
+class ReleaseTests(SchedulerTestCase):
+    def test_release_outside_quiet_hours(self):
+        defer = self.defer(TITLES[0])
+        self.process(NOON)
+        self.assertEqual(self.status(defer), 'DELIVERED')
+        self.assertIsNone(defer.claimed_by)
+        self.assertEqual(DecisionRecord.objects.get(event=defer.event).classification, 'NOW')
+
+    def test_rescheduled_while_still_quiet(self):
+        defer = self.defer(TITLES[0])
+        self.process(NIGHT)
+        self.assertEqual(self.status(defer), 'PENDING')
+        self.assertEqual(defer.retry_count, 1)
+        # The first second after the quiet window.
+        self.assertEqual(defer.scheduled_for, datetime(2026, 1, 6, 8, 0, 1, tzinfo=dt_timezone.utc))
+        self.assertIsNone(defer.lease_expires_at)
+
+    def test_released_event_is_not_a_duplicate_of_itself(self):
+        defer = self.defer(TITLES[0])
+        self.assertEqual(decide_notification(defer.event)[0], 'NOW')
+        self.process(NOON)
+        self.assertEqual(self.status(defer), 'DELIVERED')
+
+    def test_expired_event_is_not_decided(self):
+        defer = self.defer(TITLES[0], expires_at=timezone.now() - timedelta(seconds=1))
+        self.process(NOON)
+        self.assertEqual(self.status(defer), 'EXPIRED')
+        self.assertFalse(DecisionRecord.objects.filter(event=defer.event).exists())
+
+    def test_expired_rows_are_saved_when_the_batch_fails(self):
+        expired = self.defer(TITLES[0], expires_at=timezone.now() - timedelta(seconds=1))
+        live = self.defer(TITLES[1])
+        with mock.patch('scheduler.tasks.record_decisions', side_effect=RuntimeError('db down')), \
+                self.assertLogs('scheduler.tasks', 'ERROR'):
+            self.process(NOON)
+        self.assertEqual(self.status(expired), 'EXPIRED')
+        self.assertEqual(self.status(live), 'PENDING')
+        self.assertIsNone(live.claimed_by)
+
+    def test_row_by_row_retry_starts_from_the_claimed_row(self):
+        rows = [self.defer(title, user_id=f'u{i}') for i, title in enumerate(TITLES[:2])]
+        save = tasks._save
+        calls = iter([RuntimeError('db down')])
+
+        def fail_once(rows, worker_id):
+            # Fails the batch write after the rows have been rescheduled.
+            error = next(calls, None)
+            if error:
+                raise error
+            save(rows, worker_id)
+
+        with mock.patch('scheduler.tasks._save', side_effect=fail_once), \
+                self.assertLogs('scheduler.tasks', 'ERROR'):
+            self.process(NIGHT)
+        for defer in rows:
+            self.assertEqual(self.status(defer), 'PENDING')
+            self.assertEqual(defer.retry_count, 1)
+
+    def test_lost_lease_is_not_written(self):
+        defer = self.defer(TITLES[0])
+        clock = mock.Mock(return_value=FixedClock(NOON))
+        with mock.patch('scheduler.tasks.SystemClock', clock):
+            batch = claim_due('test-worker')
+            # The lease ran out and another worker claimed the row.
+            DeferredNotification.objects.update(claimed_by='other-worker')
+            with self.assertLogs('scheduler.tasks', 'WARNING'):
+                _process_batch(batch, 'test-worker')
+        self.assertEqual(self.status(defer), 'PENDING')
+        self.assertEqual(defer.claimed_by, 'other-worker')
+        self.assertFalse(DecisionRecord.objects.filter(event=defer.event).exists())
+
+    @override_settings(SCHEDULER_MAX_RETRIES=1, SCHEDULER_RETRY_BASE_SECONDS=30)
+    def test_failing_row_backs_off_then_fails(self):
+        defer = self.defer(TITLES[0])
+        with mock.patch('scheduler.tasks.record_decisions', side_effect=RuntimeError('db down')), \
+                self.assertLogs('scheduler.tasks', 'ERROR'):
+            before = timezone.now()
+            # One claim: the backed-off row is not due again in this run.
+            self.assertEqual(process_due_deferred(worker_id='test-worker'), 1)
+            self.assertEqual(self.status(defer), 'PENDING')
+            self.assertEqual(defer.retry_count, 1)
+            self.assertGreaterEqual(defer.scheduled_for, before + timedelta(seconds=30))
+
+            DeferredNotification.objects.update(scheduled_for=timezone.now())
+            self.process(NOON)
+        self.assertEqual(self.status(defer), 'FAILED')
+        self.assertEqual(defer.retry_count, 2)
+
+
+@override_settings(ENGINE_DIGEST=True, ENGINE_DIGEST_MIN_ITEMS=2)
+class DigestTests(SchedulerTestCase):
+    def test_rows_of_one_user_and_channel_are_coalesced(self):
+        rows = [self.defer(title) for title in TITLES[:3]]
+        other = self.defer(TITLES[3], user_id='u2')
+        self.process(NOON)
+
+        for defer in rows:
+            self.assertEqual(self.status(defer), 'DIGESTED')
+        self.assertEqual(len({defer.digest_id for defer in rows}), 1)
+        digest = rows[0].digest
+        self.assertEqual(digest.event_type, DIGEST_EVENT_TYPE)
+        self.assertEqual(digest.metadata['items'], [defer.event_id for defer in rows])
+        self.assertEqual(DecisionRecord.objects.get(event=digest).classification, 'NOW')
+        self.assertFalse(DecisionRecord.objects.filter(event__in=[defer.event for defer in rows]).exists())
+        self.assertEqual(self.status(other), 'DELIVERED')
+
+    def test_failed_digest_falls_back_to_single_rows(self):
+        rows = [self.defer(title) for title in TITLES[:2]]
+        with mock.patch('scheduler.digest.record_decisions', side_effect=RuntimeError('db down')), \
+                self.assertLogs('scheduler.tasks', 'ERROR'):
+            self.process(NOON)
+        self.assertFalse(NotificationEvent.objects.filter(event_type=DIGEST_EVENT_TYPE).exists())
+        for defer in rows:
+            self.assertEqual(self.status(defer), 'DELIVERED')
+            self.assertIsNone(defer.digest_id)